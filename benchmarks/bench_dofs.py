@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for Dofs.x, Dofs.set and Dofs.jac as the number of
+parameters and the number of owner objects grow.
+
+Usage: python bench_dofs.py [--output dofs.json] [--quick]
+"""
+
+import numpy as np
+from common import timeit, result, write_results, parse_args
+from simsopt.core.dofs import Dofs
+from simsopt.core.functions import Affine
+
+
+def main():
+    args = parse_args('dofs')
+    np.random.seed(0)
+    if args.quick:
+        cases = [(10, 1), (10, 10)]
+    else:
+        cases = [(10, 1), (100, 1), (1000, 1), (100, 10), (1000, 10), (1000, 100)]
+
+    results = []
+    for nparams, nowners in cases:
+        owners = [Affine(nparams // nowners, 3) for j in range(nowners)]
+        dofs = Dofs([o.J for o in owners])
+        x = np.random.rand(dofs.nparams)
+        params = {'nparams': dofs.nparams, 'nowners': nowners}
+        results.append(result('Dofs.x', params,
+                              timeit(lambda: dofs.x, args.min_time)))
+        results.append(result('Dofs.set', params,
+                              timeit(lambda: dofs.set(x), args.min_time)))
+        results.append(result('Dofs.jac', params,
+                              timeit(dofs.jac, args.min_time)))
+
+    write_results(args.output, 'dofs', results)
+
+
+if __name__ == "__main__":
+    main()
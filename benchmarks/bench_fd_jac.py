@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the serial finite-difference Jacobian Dofs.fd_jac,
+using the Rosenbrock and Affine functions from core/functions.py.
+
+Usage: python bench_fd_jac.py [--output fd_jac.json] [--quick]
+"""
+
+import numpy as np
+from common import timeit, result, write_results, parse_args
+from simsopt.core.dofs import Dofs
+from simsopt.core.functions import Rosenbrock, Affine
+
+
+def main():
+    args = parse_args('fd_jac')
+    np.random.seed(0)
+    if args.quick:
+        sizes = [10]
+    else:
+        sizes = [10, 100, 1000]
+
+    results = []
+    r = Rosenbrock()
+    dofs = Dofs([r.term1, r.term2])
+    for centered in [False, True]:
+        params = {'function': 'Rosenbrock', 'nparams': 2, 'centered': centered}
+        results.append(result('fd_jac', params,
+                              timeit(lambda: dofs.fd_jac(centered=centered),
+                                     args.min_time)))
+
+    for nparams in sizes:
+        a = Affine(nparams, 10)
+        dofs = Dofs([a.J])
+        for centered in [False, True]:
+            params = {'function': 'Affine', 'nparams': nparams, 'centered': centered}
+            results.append(result('fd_jac', params,
+                                  timeit(lambda: dofs.fd_jac(centered=centered),
+                                         args.min_time)))
+
+    write_results(args.output, 'fd_jac', results)
+
+
+if __name__ == "__main__":
+    main()
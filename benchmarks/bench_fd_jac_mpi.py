@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the parallel finite-difference Jacobian fd_jac_mpi,
+for every number of groups from 1 to the number of MPI processes.
+An Affine function from core/functions.py is used, with an optional
+artificial delay in each evaluation to mimic an expensive code.
+
+Usage: mpiexec -n 4 python bench_fd_jac_mpi.py [--output fd_jac_mpi.json]
+       [--quick] [--delay 0.01]
+"""
+
+import time
+import argparse
+import numpy as np
+from mpi4py import MPI
+from common import result, write_results
+from simsopt.core.dofs import Dofs
+from simsopt.core.functions import Affine
+from simsopt.core.mpi import MpiPartition
+from simsopt.core.mpi_solve import fd_jac_mpi
+
+
+class SlowAffine(Affine):
+    """
+    An Affine function whose evaluation takes at least delay seconds.
+    """
+    def __init__(self, nparams, nvals, delay):
+        Affine.__init__(self, nparams, nvals)
+        self.delay = delay
+
+    def J(self):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        return Affine.J(self)
+
+
+def time_collective(func, mpi, number, repeat):
+    """
+    Time a function that all processes must call together. The time of
+    each repeat is the maximum over processes. Every process does the
+    same number of calls, so no process waits forever.
+    """
+    times = []
+    func()
+    for k in range(repeat):
+        mpi.comm_world.Barrier()
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        times.append(mpi.comm_world.allreduce(elapsed, op=MPI.MAX))
+    return {'best': min(times), 'median': float(np.median(times)),
+            'number': number, 'repeat': repeat}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='simsopt benchmarks: fd_jac_mpi')
+    parser.add_argument('--output', default='fd_jac_mpi.json')
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--delay', type=float, default=0.001,
+                        help='Time in seconds added to each function evaluation')
+    parser.add_argument('--number', type=int, default=5,
+                        help='Number of Jacobian evaluations per repeat')
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    nprocs = comm.Get_size()
+    np.random.seed(0)
+    sizes = [10] if args.quick else [10, 100]
+
+    results = []
+    for nparams in sizes:
+        a = SlowAffine(nparams, 10, args.delay)
+        dofs = Dofs([a.J])
+        for ngroups in range(1, nprocs + 1):
+            mpi = MpiPartition(ngroups=ngroups)
+            timing = time_collective(lambda: fd_jac_mpi(dofs, mpi), mpi,
+                                     args.number, 3)
+            params = {'nparams': nparams, 'nprocs': nprocs,
+                      'ngroups': ngroups, 'delay': args.delay}
+            if mpi.proc0_world:
+                results.append(result('fd_jac_mpi', params, timing))
+
+    if comm.Get_rank() == 0:
+        write_results(args.output, 'fd_jac_mpi', results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for SurfaceRZFourier.area_volume and darea_volume across
+mpol, ntor and the resolution (ntheta, nphi) of the quadrature grid.
+
+Usage: python bench_surface.py [--output surface.json] [--quick]
+"""
+
+from common import timeit, result, write_results, parse_args
+from simsopt.core.surface import SurfaceRZFourier
+
+
+def main():
+    args = parse_args('surface')
+    if args.quick:
+        cases = [(1, 0, 31, 30), (3, 3, 31, 30)]
+    else:
+        cases = [(1, 0, 63, 62), (3, 3, 63, 62), (6, 6, 63, 62),
+                 (12, 12, 63, 62), (6, 6, 127, 126), (6, 6, 255, 254)]
+
+    results = []
+    for mpol, ntor, ntheta, nphi in cases:
+        s = SurfaceRZFourier(nfp=3, mpol=mpol, ntor=ntor)
+        s.ntheta = ntheta
+        s.nphi = nphi
+        params = {'mpol': mpol, 'ntor': ntor, 'ntheta': ntheta, 'nphi': nphi}
+
+        # Force a recalculation on every call, as happens when the
+        # dofs change:
+        def area_volume():
+            s.dofs_changed()
+            s.area_volume()
+
+        def darea_volume():
+            s.dofs_changed()
+            s.darea_volume()
+
+        results.append(result('SurfaceRZFourier.area_volume', params,
+                              timeit(area_volume, args.min_time)))
+        results.append(result('SurfaceRZFourier.darea_volume', params,
+                              timeit(darea_volume, args.min_time)))
+
+    write_results(args.output, 'surface', results)
+
+
+if __name__ == "__main__":
+    main()
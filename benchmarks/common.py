@@ -0,0 +1,114 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+Utilities shared by the benchmark scripts: timing a function, and
+reading and writing results as JSON, so results from different
+versions of the code can be compared with compare.py.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+
+def timeit(func, min_time=0.2, repeat=5):
+    """
+    Time func(). The number of calls per repeat is chosen so each
+    repeat takes at least min_time seconds. Returns a dict with the
+    best and median time per call over the repeats, in seconds.
+    """
+    # Warm up, e.g. for jax compilation:
+    func()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    times = [elapsed / number]
+    for k in range(repeat - 1):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {'best': min(times), 'median': float(np.median(times)),
+            'number': number, 'repeat': repeat}
+
+
+def git_commit():
+    """
+    Return the hash of the git commit of the source tree, or None.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata():
+    """
+    Return a dict describing the environment of a benchmark run.
+    """
+    import scipy
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.node(),
+            'processor': platform.processor()}
+
+
+def write_results(filename, suite, results):
+    """
+    Write the results of a benchmark suite to a JSON file. Each result
+    is a dict with a 'name', a dict of 'params', and the timing dict
+    returned by timeit().
+    """
+    data = {'suite': suite, 'metadata': metadata(), 'results': results}
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=1)
+    print('Wrote ' + filename)
+
+
+def read_results(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def result(name, params, timing):
+    """
+    Form one result, and print it.
+    """
+    print('{:<28} {:<44} {:>12.4g} s'.format(
+        name, ' '.join('{}={}'.format(k, v) for k, v in params.items()),
+        timing['best']))
+    r = {'name': name, 'params': params}
+    r.update(timing)
+    return r
+
+
+def parse_args(suite, argv=None):
+    """
+    Parse the command-line arguments common to all benchmark scripts.
+    """
+    parser = argparse.ArgumentParser(description='simsopt benchmarks: ' + suite)
+    parser.add_argument('--output', default=suite + '.json',
+                        help='JSON file for the results')
+    parser.add_argument('--quick', action='store_true',
+                        help='Use fewer and smaller cases')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Minimum time in seconds for each repeat')
+    return parser.parse_args(argv)
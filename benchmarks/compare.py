@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+Compare two benchmark result files written by the bench_*.py scripts,
+e.g. from before and after a change. Cases are matched by name and
+parameters. Prints the ratio of the new time to the old time for each
+case, and exits with status 1 if any case is slower by more than the
+given threshold.
+
+Usage: python compare.py old.json new.json [--threshold 1.2]
+"""
+
+import sys
+import json
+import argparse
+from common import read_results
+
+
+def key(r):
+    return (r['name'], json.dumps(r['params'], sort_keys=True))
+
+
+def compare(old, new, threshold):
+    """
+    Print a comparison of two result dicts, and return the list of cases
+    that are slower by more than threshold.
+    """
+    old_results = {key(r): r for r in old['results']}
+    regressions = []
+    print('{:<28} {:<44} {:>11} {:>11} {:>7}'.format(
+        'Benchmark', 'Parameters', 'Old (s)', 'New (s)', 'Ratio'))
+    for r in new['results']:
+        k = key(r)
+        if k not in old_results:
+            continue
+        old_time = old_results[k]['best']
+        ratio = r['best'] / old_time
+        flag = ''
+        if ratio > threshold:
+            flag = '  SLOWER'
+            regressions.append(k)
+        params = ' '.join('{}={}'.format(a, b) for a, b in r['params'].items())
+        print('{:<28} {:<44} {:>11.4g} {:>11.4g} {:>7.2f}{}'.format(
+            r['name'], params, old_time, r['best'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare simsopt benchmark results')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Ratio of new to old time above which a case '
+                        'counts as a regression')
+    args = parser.parse_args()
+    old = read_results(args.old)
+    new = read_results(args.new)
+    print('Old: commit {}, {}'.format(old['metadata']['commit'], old['metadata']['time']))
+    print('New: commit {}, {}'.format(new['metadata']['commit'], new['metadata']['time']))
+    regressions = compare(old, new, args.threshold)
+    if regressions:
+        print('{} case(s) slower by more than a factor {}'.format(
+            len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
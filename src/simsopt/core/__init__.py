@@ -4,9 +4,12 @@ from .surface import *
 from .functions import *
 from .dofs import *
 from .least_squares_problem import LeastSquaresTerm, LeastSquaresProblem
-from .serial_solve import least_squares_serial_solve
-from .mpi import MpiPartition
-from .mpi_solve import least_squares_mpi_solve, fd_jac_mpi
+from .optimization_problem import OptimizationProblem
+from .serial_solve import least_squares_serial_solve, serial_solve
+from .mpi import MpiPartition, MpiHierarchy
+from .mpi_solve import least_squares_mpi_solve, mpi_solve, fd_jac_mpi
+from .population_solve import differential_evolution_mpi_solve, cmaes_mpi_solve
+from .multistart import multistart_mpi_solve, uniform_sampler
 
 # This next bit is to suppress a Jax warning:
 import warnings
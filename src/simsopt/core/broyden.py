@@ -0,0 +1,124 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides the BroydenJacobian class, which lets an
+optimization reuse the previous Jacobian with rank-one Broyden
+corrections instead of evaluating a new Jacobian at every iteration.
+
+This module should not depend on anything involving communication
+(e.g. MPI). In parallel runs, only proc0_world should use it.
+"""
+
+import logging
+import numpy as np
+from mpi4py import MPI
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+
+def broyden_update(jac, dx, df):
+    """
+    Return the Jacobian jac corrected by Broyden's rank-one update for
+    a step dx in the state vector that changed the residuals by df.
+    The result is the matrix closest to jac that satisfies the secant
+    condition J dx = df.
+    """
+    return jac + np.outer(df - jac @ dx, dx) / np.dot(dx, dx)
+
+
+class BroydenJacobian:
+    """
+    This class wraps the residual and Jacobian functions passed to
+    scipy.optimize.least_squares so that a full Jacobian, which for
+    finite differences costs nparams function evaluations, is only
+    computed occasionally. At other iterations, the Jacobian at the
+    previous point is corrected using the change in the residuals
+    along the accepted step.
+
+    A full Jacobian is computed at the first iteration, after
+    max_updates consecutive Broyden updates, and whenever progress
+    stalls, i.e. when the last accepted step reduced the sum of
+    squares of the residuals by less than the fraction min_reduction.
+    """
+    def __init__(self, max_updates=10, min_reduction=0.01):
+        """
+        max_updates: Maximum number of consecutive Broyden updates
+        before a full Jacobian is computed again.
+
+        min_reduction: A full Jacobian is computed if the last accepted
+        step reduced the objective by less than this fraction.
+        """
+        self.max_updates = max_updates
+        self.min_reduction = min_reduction
+        self.nupdates = 0
+        self.nfull = 0
+        self.nbroyden = 0
+        # Point, residuals and Jacobian at the most recent Jacobian
+        # evaluation:
+        self.x = None
+        self.f = None
+        self.jac = None
+        # Most recent function evaluation:
+        self.last_x = None
+        self.last_f = None
+
+    def need_full(self, x, f):
+        """
+        Return True if a full Jacobian should be computed at x, where
+        the residuals are f (or None if they are not known).
+        """
+        if self.jac is None or self.f is None or f is None:
+            return True
+        if self.nupdates >= self.max_updates:
+            logger.info('Computing a full Jacobian after %d Broyden updates',
+                        self.nupdates)
+            return True
+        if np.array_equal(x, self.x):
+            return True
+        old_objective = np.dot(self.f, self.f)
+        if np.dot(f, f) > (1 - self.min_reduction) * old_objective:
+            logger.info('Computing a full Jacobian since progress stalled')
+            return True
+        return False
+
+    def wrap_fun(self, fun):
+        """
+        Given a function fun(x, *args) that returns the residuals, return
+        a function that also remembers the most recent evaluation.
+        """
+        def wrapped(x, *args):
+            f = fun(x, *args)
+            self.last_x = np.array(x, dtype=float)
+            self.last_f = np.array(f, dtype=float)
+            return f
+        return wrapped
+
+    def wrap_jac(self, jac):
+        """
+        Given a function jac(x, *args) that returns the full Jacobian,
+        return a function that returns a Broyden update of the
+        previous Jacobian instead, when possible.
+        """
+        def wrapped(x, *args):
+            x = np.array(x, dtype=float)
+            # scipy evaluates the residuals at a point before the
+            # Jacobian, so they are usually available:
+            f = None
+            if self.last_x is not None and np.array_equal(self.last_x, x):
+                f = self.last_f
+
+            if self.need_full(x, f):
+                self.jac = np.array(jac(x, *args), dtype=float)
+                self.nfull += 1
+                self.nupdates = 0
+            else:
+                logger.info('Using a Broyden update of the Jacobian')
+                self.jac = broyden_update(self.jac, x - self.x, f - self.f)
+                self.nbroyden += 1
+                self.nupdates += 1
+            self.x = x
+            self.f = f
+            return np.copy(self.jac)
+        return wrapped
@@ -0,0 +1,204 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides the Checkpoint class, used to save the progress
+of an optimization periodically so it can be resumed later.
+
+This module should not depend on anything involving communication
+(e.g. MPI). In parallel runs, only proc0_world should use it.
+"""
+
+import os
+import logging
+import numpy as np
+from mpi4py import MPI
+from .history import EvaluationHistory, read_history, HEADER_SIZE
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+
+def _fsync_dir(filename):
+    """
+    Flush the directory entry of filename to disk, where the operating
+    system supports it.
+    """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Checkpoint:
+    """
+    This class records every function and Jacobian evaluation of an
+    optimization, so the optimization can be resumed later.
+
+    The function evaluations are appended to the file filename +
+    '.history', in the format of EvaluationHistory, so the cost of
+    saving does not grow with the length of the run. They are flushed
+    to disk after every interval evaluations. A record torn by a crash
+    at the end of this file is discarded when it is loaded.
+
+    The most recent Jacobian is stored in the numpy .npz file
+    filename. It is first written to a temporary file in the same
+    directory and flushed to disk, and then replaces the old file, so
+    a crash during writing never leaves a corrupted Jacobian.
+
+    If the files already exist, the saved history is loaded, so
+    evaluations at points in the history are not repeated when an
+    interrupted optimization is resumed.
+    """
+    def __init__(self, filename, nparams, interval=1):
+        """
+        filename: The name of the checkpoint file.
+
+        nparams: Number of elements in the state vector.
+
+        interval: The function evaluations are flushed to disk after
+        every interval evaluations.
+        """
+        self.filename = filename
+        self.history_filename = filename + '.history'
+        self.nparams = nparams
+        self.interval = interval
+        self.nevals = 0
+        self.x = None
+        self.best_x = None
+        self.best_objective = np.inf
+        self.jac = None
+        self.jac_x = None
+        self.f_lookup = {}
+        self.load()
+        self.history = EvaluationHistory(self.history_filename, nparams,
+                                         batch_size=interval, fsync=True)
+
+    def load(self):
+        """
+        Read the checkpoint files, if they exist.
+        """
+        if os.path.exists(self.history_filename):
+            logger.info('Reading checkpoint file %s', self.history_filename)
+            records = read_history(self.history_filename)
+            if records.dtype['x'].shape != (self.nparams,):
+                raise ValueError('Checkpoint file {} has {} parameters, but the '
+                                 'problem has {}'.format(self.history_filename,
+                                                         records.dtype['x'].shape[0],
+                                                         self.nparams))
+            for record in records:
+                self._record_f(record['x'], record['f'])
+            # Remove any partial record left by a crash, so new records
+            # are appended at the right place:
+            size = HEADER_SIZE + len(records) * records.dtype.itemsize
+            if os.path.getsize(self.history_filename) > size:
+                logger.warning('Discarding a partial record at the end of %s',
+                               self.history_filename)
+                os.truncate(self.history_filename, size)
+            logger.info('Loaded %d evaluations from the checkpoint', self.nevals)
+        if os.path.exists(self.filename):
+            with np.load(self.filename) as data:
+                if data['jac_x'].shape != (self.nparams,):
+                    raise ValueError('Checkpoint file {} has {} parameters, but the '
+                                     'problem has {}'.format(self.filename,
+                                                             len(data['jac_x']),
+                                                             self.nparams))
+                self.jac = data['jac']
+                self.jac_x = data['jac_x']
+
+    def write(self):
+        """
+        Flush any function evaluations that are not yet on disk.
+        """
+        self.history.flush()
+
+    def _write_jac(self):
+        """
+        Write the Jacobian file atomically.
+        """
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, jac=self.jac, jac_x=self.jac_x)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        _fsync_dir(self.filename)
+        logger.debug('Wrote checkpoint file %s', self.filename)
+
+    def _record_f(self, x, f):
+        x = np.array(x, dtype=float)
+        f = np.array(f, dtype=float)
+        self.nevals += 1
+        self.f_lookup[x.tobytes()] = f
+        self.x = x
+        objective = float(np.dot(f, f))
+        if objective < self.best_objective:
+            self.best_objective = objective
+            self.best_x = x
+
+    def record_f(self, x, f):
+        """
+        Add a function evaluation to the history.
+        """
+        self._record_f(x, f)
+        self.history.record(x, f, float(np.dot(f, f)))
+
+    def record_jac(self, x, jac):
+        """
+        Store the most recent Jacobian, and write it to disk.
+        """
+        self.jac_x = np.array(x, dtype=float)
+        self.jac = np.array(jac, dtype=float)
+        self._write_jac()
+
+    def lookup_f(self, x):
+        """
+        Return the function values at x if x is in the history, or None
+        otherwise.
+        """
+        return self.f_lookup.get(np.array(x, dtype=float).tobytes())
+
+    def lookup_jac(self, x):
+        """
+        Return the stored Jacobian if it was evaluated at x, or None
+        otherwise.
+        """
+        if self.jac is not None and np.array_equal(self.jac_x, x):
+            return self.jac
+        return None
+
+    def wrap_fun(self, fun):
+        """
+        Given a function fun(x, *args) that returns the residuals, return
+        a function that looks x up in the history before calling fun, and
+        records any new evaluation.
+        """
+        def wrapped(x, *args):
+            f = self.lookup_f(x)
+            if f is not None:
+                logger.info('Reusing function evaluation from checkpoint')
+                return np.copy(f)
+            f = fun(x, *args)
+            self.record_f(x, f)
+            return f
+        return wrapped
+
+    def wrap_jac(self, jac):
+        """
+        Same as wrap_fun(), but for a function that returns the Jacobian.
+        """
+        def wrapped(x, *args):
+            j = self.lookup_jac(x)
+            if j is not None:
+                logger.info('Reusing Jacobian from checkpoint')
+                return np.copy(j)
+            j = jac(x, *args)
+            self.record_jac(x, j)
+            return j
+        return wrapped
@@ -14,8 +14,9 @@ import logging
 import numpy as np
 from mpi4py import MPI
 
+from . import timer
 from .optimizable import function_from_user
-from .util import unique
+from .util import unique, ObjectiveFailure
 
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
 
@@ -38,6 +39,325 @@ def get_owners(obj, owners_so_far=[]):
     return owners
 
 
+def combined_version(obj):
+    """
+    Return a tuple with the version counters of obj and of every object
+    it depends on, as found by get_owners(). A result computed from the
+    dofs of these objects is still valid as long as this tuple is
+    unchanged. Replacing a dependency by another object changes the
+    version of the object that depends on it, see Optimizable.
+    """
+    return tuple(getattr(owner, '_version', 0) for owner in get_owners(obj))
+
+
+# Nodes of the named finite-difference stencils, in units of the step
+# size. 'richardson' combines forward differences with steps h and 2h,
+# and '4-point' combines centered differences with steps h and 2h.
+STENCILS = {'forward': [0, 1],
+            'centered': [-1, 1],
+            'richardson': [0, 1, 2],
+            '4-point': [-2, -1, 1, 2]}
+
+
+def stencil_nodes(stencil=None, centered=False):
+    """
+    Return the nodes of a finite-difference stencil, in units of the
+    step size. stencil is either a key of STENCILS or a sequence of
+    distinct numbers. If stencil is None, the 'centered' stencil is used
+    if centered is True, and the 'forward' stencil otherwise.
+    """
+    if stencil is None:
+        stencil = 'centered' if centered else 'forward'
+    if isinstance(stencil, str):
+        if stencil not in STENCILS:
+            raise ValueError('Unknown stencil {}. Options are {}'.format(
+                stencil, list(STENCILS)))
+        stencil = STENCILS[stencil]
+    nodes = np.array(stencil, dtype=float)
+    if len(nodes) < 2 or len(np.unique(nodes)) < len(nodes):
+        raise ValueError('A stencil must have at least 2 distinct nodes')
+    return nodes
+
+
+def stencil_order(nodes):
+    """
+    Return the order of accuracy of the derivative from a stencil with
+    the given nodes: one less than the number of nodes, plus one if
+    the stencil is symmetric about 0.
+    """
+    order = len(nodes) - 1
+    if np.array_equal(np.sort(nodes), np.sort(-nodes)):
+        order += 1
+    return order
+
+
+def fd_weights(offsets):
+    """
+    Return the weights w such that sum_i w[i] f(x0 + offsets[i])
+    approximates the derivative of f at x0, exactly for polynomials
+    of degree less than len(offsets).
+    """
+    # Solve in units of the largest offset for better conditioning:
+    scale = np.max(np.abs(offsets))
+    n = len(offsets)
+    vandermonde = np.vander(offsets / scale, n, increasing=True).T
+    rhs = np.zeros(n)
+    rhs[1] = 1.0
+    return np.linalg.solve(vandermonde, rhs) / scale
+
+
+def fd_offsets(x0, eps, mins, maxs, nodes, rel_eps=0.0):
+    """
+    Return a 2D array whose row j has the displacements of dof j at the
+    nodes of a finite-difference stencil about the state vector x0,
+    keeping all evaluation points within the bounds mins and maxs.
+
+    The step size for dof j is the larger of eps and rel_eps *
+    abs(x0[j]). eps can be a scalar or an array with one entry per
+    dof, so dofs with very different magnitudes can be given steps to
+    match.
+
+    If the stencil does not fit within the bounds, its mirror image is
+    tried, followed by the 1-sided stencil with nodes 0, 1, ..., n - 1
+    and its mirror image, so the same number of points is used. If
+    none of these fit, the 1-sided stencil is shrunk to fit on the
+    side of x0 with more room. ValueError is raised if there is no room
+    on either side, e.g. if mins == maxs.
+    """
+    x0 = np.asarray(x0, dtype=float)
+    mins = np.broadcast_to(np.asarray(mins, dtype=float), x0.shape)
+    maxs = np.broadcast_to(np.asarray(maxs, dtype=float), x0.shape)
+    h = np.broadcast_to(np.maximum(eps, rel_eps * np.abs(x0)), x0.shape)
+    one_sided = np.arange(len(nodes), dtype=float)
+    offsets = np.zeros((len(x0), len(nodes)))
+    done = np.zeros(len(x0), dtype=bool)
+    for candidate in [nodes, -nodes, one_sided, -one_sided]:
+        trial = np.outer(h, candidate)
+        points = x0.reshape((-1, 1)) + trial
+        fits = np.all((points >= mins.reshape((-1, 1)))
+                      & (points <= maxs.reshape((-1, 1))), axis=1) & ~done
+        offsets[fits] = trial[fits]
+        done |= fits
+
+    for j in np.nonzero(~done)[0]:
+        room_up = maxs[j] - x0[j]
+        room_down = x0[j] - mins[j]
+        room = max(room_up, room_down)
+        if not room > 0:
+            raise ValueError('The bounds of dof {} leave no room for a finite-difference '
+                             'step: x = {}, min = {}, max = {}'.format(
+                                 j, x0[j], mins[j], maxs[j]))
+        step = room / one_sided[-1]
+        logger.warning('Reducing the finite-difference step of dof %d from %s to %s '
+                       'to stay within its bounds', j, h[j], step)
+        offsets[j] = step * (one_sided if room_up >= room_down else -one_sided)
+    return offsets
+
+
+def fd_steps(x0, eps, mins, maxs, centered=False, rel_eps=0.0):
+    """
+    Return the steps (hplus, hminus) used for 1-sided or centered
+    finite differencing about the state vector x0 with step size eps,
+    keeping all evaluation points within the bounds mins and maxs. The
+    derivative with respect to dof j is
+
+    (f(x0 + hplus[j] e_j) - f(x0 - hminus[j] e_j)) / (hplus[j] + hminus[j]).
+
+    eps and rel_eps are as in fd_offsets(). For 1-sided differences,
+    hminus is 0, and hplus[j] is negative if a forward step would
+    exceed maxs[j]. For centered differences, a step that would leave
+    the bounds is replaced by 0, giving a 1-sided difference for that
+    dof.
+    """
+    offsets = fd_offsets(x0, eps, mins, maxs, stencil_nodes(centered=centered),
+                         rel_eps)
+    if centered:
+        return np.max(offsets, axis=1), -np.min(offsets, axis=1)
+    return offsets[:, 1], np.zeros(len(x0))
+
+
+def noise_points(x0, mins, maxs, h=1e-6, npoints=8, seed=0):
+    """
+    Return a 2D array whose npoints columns are equally spaced state
+    vectors along a random direction from x0, used to estimate the
+    noise in the functions with ecnoise(). Each dof j moves by up to
+    h * (npoints - 1) * abs(x0[j]), or by the same amount times 1 if
+    x0[j] is 0, upward unless that would exceed maxs[j], and downward
+    unless that would go below mins[j]. If neither direction has room,
+    the dof moves toward the farther bound, by a smaller amount that
+    ends at that bound.
+    """
+    rng = np.random.default_rng(seed)
+    p = rng.uniform(0.5, 1.0, len(x0)) * np.where(x0 == 0, 1.0, np.abs(x0)) * h
+    span = p * (npoints - 1)
+    room_up = maxs - x0
+    room_down = x0 - mins
+    up = (span <= room_up) | ((span > room_down) & (room_up >= room_down))
+    room = np.where(up, room_up, room_down)
+    for j in np.nonzero(span > room)[0]:
+        logger.warning('Reducing the spacing of the noise points for dof %d from '
+                       '%s to %s to stay within its bounds', j, p[j],
+                       room[j] / (npoints - 1))
+    p = np.minimum(p, room / (npoints - 1))
+    p = np.where(up, p, -p)
+    return x0.reshape((-1, 1)) + np.outer(p, np.arange(npoints))
+
+
+def ecnoise(fvals):
+    """
+    Estimate the noise in function values at equally spaced points,
+    using the ECnoise method of More & Wild, SIAM J. Sci. Comput. 33,
+    1292 (2011). fvals is a 2D array with one row per function and one
+    column per point. The return value has the estimated standard
+    deviation of the noise of each function, or nan where it cannot be
+    determined, e.g. because the spacing of the points was too large
+    or too small.
+    """
+    fvals = np.atleast_2d(fvals)
+    nrows, npoints = fvals.shape
+    noise = np.full(nrows, np.nan)
+    for i in range(nrows):
+        f = np.array(fvals[i], dtype=float)
+        fmin = np.min(f)
+        fmax = np.max(f)
+        if fmax - fmin > 0.1 * max(abs(fmin), abs(fmax)):
+            # The points are too far apart.
+            continue
+        levels = np.zeros(npoints - 1)
+        sign_change = np.zeros(npoints - 1, dtype=bool)
+        gamma = 1.0
+        for k in range(1, npoints):
+            f = np.diff(f)
+            if k == 1 and np.sum(f == 0) >= npoints / 2:
+                # The points are too close together.
+                break
+            gamma *= 0.5 * k / (2 * k - 1)
+            levels[k - 1] = np.sqrt(gamma * np.mean(f * f))
+            sign_change[k - 1] = np.min(f) * np.max(f) < 0
+        else:
+            # Use the lowest order of differences at which the
+            # estimates settle down:
+            for k in range(npoints - 3):
+                window = levels[k:k + 3]
+                if np.max(window) <= 4 * np.min(window) and sign_change[k]:
+                    noise[i] = levels[k]
+                    break
+    return noise
+
+
+def relative_noise(fvals):
+    """
+    Return the typical relative noise level of the functions whose
+    values at the points from noise_points() are fvals, or nan if the
+    noise cannot be estimated for any function. The median over the
+    functions is used.
+    """
+    fvals = np.atleast_2d(fvals)
+    scale = np.mean(np.abs(fvals), axis=1)
+    rel = ecnoise(fvals) / np.where(scale == 0, np.nan, scale)
+    rel = rel[np.isfinite(rel)]
+    if len(rel) == 0:
+        return np.nan
+    return max(float(np.median(rel)), np.finfo(float).eps)
+
+
+def fd_rel_eps(noise, centered=False, order=None):
+    """
+    Return the relative finite-difference step that balances truncation
+    and noise errors for functions with the given relative noise level:
+    noise ** (1 / (order + 1)) for a stencil with the given order of
+    accuracy. If order is None, it is 2 if centered is True, and 1
+    otherwise, so the step is the square root of the noise for 1-sided
+    differences, and the cube root for centered differences. If the
+    noise is nan, 0 is returned, so only the absolute step is used.
+    """
+    if not np.isfinite(noise):
+        return 0.0
+    if order is None:
+        order = 2 if centered else 1
+    return noise ** (1.0 / (order + 1))
+
+
+def color_columns(dependence):
+    """
+    Given a 2D boolean array dependence, in which dependence[i, j] is
+    True if row i of a Jacobian may be nonzero in column j, partition
+    the columns into groups such that no two columns in a group have a
+    nonzero in the same row. All columns in a group can then be
+    perturbed together in a single finite-difference evaluation. A
+    greedy coloring is used. Returns a list of 1D arrays of column
+    indices, one for each group.
+    """
+    nrows, ncols = dependence.shape
+    groups = []
+    group_rows = []
+    for j in range(ncols):
+        for k in range(len(groups)):
+            if not np.any(group_rows[k] & dependence[:, j]):
+                groups[k].append(j)
+                group_rows[k] |= dependence[:, j]
+                break
+        else:
+            groups.append([j])
+            group_rows.append(np.array(dependence[:, j], dtype=bool))
+    return [np.array(g, dtype=int) for g in groups]
+
+
+def fd_points(x0, groups, offsets):
+    """
+    Return the state vectors at which functions are evaluated for a
+    finite-difference Jacobian, given the column groups from
+    color_columns() and the displacements from fd_offsets(). The return
+    value is a tuple (xs, columns, point_groups). xs is a 2D array with
+    one state vector per column. columns[k][i] is the column of xs at
+    which the dofs in group k are displaced by offsets[:, i].
+    point_groups has, for each column of xs, the indices of the dofs
+    that are displaced, or None for x0 itself.
+
+    Points at which no dof of a group is displaced, e.g. the node 0 of a
+    1-sided stencil, all share a single column with x0, which is the
+    first column of xs.
+    """
+    xs = [x0]
+    point_groups = [None]
+    columns = []
+    for group in groups:
+        group_columns = []
+        for i in range(offsets.shape[1]):
+            if np.all(offsets[group, i] == 0):
+                group_columns.append(0)
+            else:
+                x = np.copy(x0)
+                x[group] += offsets[group, i]
+                xs.append(x)
+                point_groups.append(group)
+                group_columns.append(len(xs) - 1)
+        columns.append(group_columns)
+    if not any(0 in group_columns for group_columns in columns):
+        # x0 is not needed:
+        xs = xs[1:]
+        point_groups = point_groups[1:]
+        columns = [[c - 1 for c in group_columns] for group_columns in columns]
+    return np.array(xs).T, columns, point_groups
+
+
+def fd_assemble(evals, groups, columns, offsets, sparsity):
+    """
+    Form the finite-difference Jacobian from the function values evals
+    (one column per state vector returned by fd_points()). sparsity is
+    the boolean array returned by Dofs.sparsity(). Entries outside the
+    sparsity pattern are zero.
+    """
+    nvals = evals.shape[0]
+    nparams = offsets.shape[0]
+    jac = np.zeros((nvals, nparams))
+    for group, group_columns in zip(groups, columns):
+        for j in group:
+            derivative = evals[:, group_columns] @ fd_weights(offsets[j])
+            jac[:, j] = np.where(sparsity[:, j], derivative, 0.0)
+    return jac
+
+
 class Dofs:
     """
     This class holds data related to the vector of degrees of freedom
@@ -176,6 +496,9 @@ class Dofs:
         self.nfuncs = len(funcs)
         self.nparams = len(x)
         self.nvals = None  # We won't know this until the first function eval.
+        # Relative noise level of the functions, set the first time it
+        # is needed for automatic finite-difference steps:
+        self.fd_noise = None
         self.nvals_per_func = np.full(self.nfuncs, 0)
         self.dof_owners = dof_owners
         self.indices = np.array(indices)
@@ -189,6 +512,44 @@ class Dofs:
         self.grad_avail = grad_avail
         self.grad_funcs = grad_funcs
 
+        # The dependency graph: func_owners[i] is the list of objects
+        # that funcs[i] depends on, found by following depends_on.
+        # func_dependence[i, j] is True if funcs[i] depends on dof j,
+        # i.e. if the owner of dof j is among these objects:
+        self.func_owners = [unique(f_dof_owners) for f_dof_owners in func_dof_owners]
+        func_dependence = np.full((self.nfuncs, self.nparams), False)
+        for i in range(self.nfuncs):
+            for j in range(self.nparams):
+                func_dependence[i, j] = any(dof_owners[j] is o for o in self.func_owners[i])
+        self.func_dependence = func_dependence
+        # Groups of dofs that can be perturbed together for finite
+        # differences, since no function depends on more than one dof
+        # in a group:
+        self.fd_groups = color_columns(func_dependence)
+
+    def column_groups(self, grouped=True):
+        """
+        Return the groups of dofs that are perturbed together for finite
+        differences: fd_groups if grouped is True, otherwise one group
+        per dof.
+        """
+        if grouped:
+            return self.fd_groups
+        return [np.array([j]) for j in range(self.nparams)]
+
+    def sparsity(self):
+        """
+        Return the sparsity pattern of the Jacobian, derived from the
+        objects that each function depends on, as a 2D boolean array
+        of shape (nvals, nparams). Since the number of values returned
+        by each function must be known, f() must have been called
+        first.
+        """
+        if self.nvals is None:
+            raise RuntimeError('The sparsity pattern is not known until f() has '
+                               'been evaluated')
+        return np.repeat(self.func_dependence, self.nvals_per_func, axis=0)
+
     @property
     def x(self):
         """
@@ -206,7 +567,8 @@ class Dofs:
                     x[j] = objx[self.indices[j]]
         return x
 
-    def f(self, x=None):
+    @timer.timed('Dofs.f')
+    def f(self, x=None, mask=None, cache=None):
         """
         Return the vector of function values. Result is a 1D numpy array.
 
@@ -214,6 +576,11 @@ class Dofs:
         evaluated for the present state vector. If x is supplied, then
         first set_dofs() will be called for each object to set the
         global state vector to x.
+
+        If mask is supplied, only the functions j for which mask[j] is
+        True are evaluated. For the other functions, the values in
+        cache[j] are used, or if cache is None they are left out of the
+        result.
         """
         if x is not None:
             self.set(x)
@@ -224,6 +591,10 @@ class Dofs:
         # doing it the first time (if self.nvals is None.)
         val_list = []
         for j, func in enumerate(self.funcs):
+            if mask is not None and not mask[j]:
+                if cache is not None:
+                    val_list.append(cache[j])
+                continue
             f = func()
             if isinstance(f, (np.ndarray, list, tuple)):
                 self.nvals_per_func[j] = len(f)
@@ -232,10 +603,43 @@ class Dofs:
                 self.nvals_per_func[j] = 1
                 val_list.append(np.array([f]))
 
-        logger.debug('Detected nvals_per_func={}'.format(self.nvals_per_func))
+        logger.debug('Detected nvals_per_func=%s', self.nvals_per_func)
         self.nvals = np.sum(self.nvals_per_func)
+        if not val_list:
+            return np.zeros(0)
         return np.concatenate(val_list)
 
+    def fd_eval_mask(self, group, cache):
+        """
+        Return a boolean array indicating which functions must be
+        evaluated at a finite-difference point at which the dofs with
+        indices in group are perturbed (or no dofs, if group is
+        None). These are the functions downstream of the perturbed dofs
+        in the dependency graph, plus any function whose value at the
+        unperturbed state is not yet in cache.
+        """
+        if group is None:
+            return np.full(self.nfuncs, True)
+        downstream = np.any(self.func_dependence[:, group], axis=1)
+        return downstream | np.array([c is None for c in cache])
+
+    def fd_update_cache(self, group, cache, f):
+        """
+        Given the function values f at a finite-difference point at
+        which the dofs in group are perturbed, store the values of the
+        functions that do not depend on those dofs, which equal their
+        values at the unperturbed state, in cache.
+        """
+        if group is None:
+            downstream = np.full(self.nfuncs, False)
+        else:
+            downstream = np.any(self.func_dependence[:, group], axis=1)
+        end_indices = np.cumsum(self.nvals_per_func)
+        for j in range(self.nfuncs):
+            if not downstream[j]:
+                cache[j] = f[end_indices[j] - self.nvals_per_func[j]:end_indices[j]]
+
+    @timer.timed('Dofs.jac')
     def jac(self, x=None):
         """
         Return the Jacobian, i.e. the gradients of all the functions that
@@ -320,6 +724,7 @@ class Dofs:
         # print(fd_jac - results)
         return results
 
+    @timer.timed('Dofs.set')
     def set(self, x):
         """
         Call set_dofs() for each object, given a global state vector x.
@@ -337,29 +742,104 @@ class Dofs:
                     objx[self.indices[j]] = x[j]
             owner.set_dofs(objx)
 
-    def fd_jac(self, x=None, eps=1e-7, centered=False):
+    def _f_or_fail(self, fail, callback=None, mask=None, cache=None):
+        """
+        Evaluate f(). If the evaluation raises ObjectiveFailure and fail
+        is not None, return a vector filled with fail instead. If
+        callback is not None, it is called as callback(x, f, success).
+        Returns f and a flag indicating success.
+        """
+        success = True
+        if fail is None:
+            f = self.f(mask=mask, cache=cache)
+        else:
+            try:
+                f = self.f(mask=mask, cache=cache)
+            except ObjectiveFailure as err:
+                if self.nvals is None:
+                    raise
+                logger.warning('Function evaluation failed during finite '
+                               'differencing: %s', err)
+                f = np.full(self.nvals, fail)
+                success = False
+        if callback is not None:
+            callback(self.x, f, success)
+        return f, success
+
+    def fd_estimate_noise(self, fail=None, callback=None, **kwargs):
+        """
+        Estimate the relative noise level of the functions about the
+        present state vector from a few extra evaluations, using
+        noise_points() and relative_noise(). The result is stored in
+        the fd_noise attribute and returned. kwargs is passed to
+        noise_points(). fail and callback are as in fd_jac().
+        """
+        x0 = self.x
+        xs = noise_points(x0, self.mins, self.maxs, **kwargs)
+        evals = []
+        for j in range(xs.shape[1]):
+            self.set(xs[:, j])
+            f, success = self._f_or_fail(fail, callback)
+            evals.append(f)
+        self.set(x0)
+        self.fd_noise = relative_noise(np.array(evals).T)
+        logger.info('Estimated relative noise level %s', self.fd_noise)
+        return self.fd_noise
+
+    @timer.timed('fd_jac')
+    def fd_jac(self, x=None, eps=1e-7, centered=False, fail=None, callback=None,
+               grouped=True, reuse=True, rel_eps=0.0, stencil=None):
         """
         Compute the finite-difference Jacobian of the functions with
-        respect to all non-fixed degrees of freedom. Either a 1-sided
-        or centered-difference approximation is used, with step size
-        eps.
+        respect to all non-fixed degrees of freedom.
+
+        stencil is the name of a stencil in STENCILS, such as
+        'richardson' or '4-point', or a list of nodes in units of the
+        step size. If stencil is None, a 1-sided difference is used,
+        or a centered difference if centered is True. Wider stencils
+        are more accurate for a given step, so they tolerate larger
+        steps with noisy functions, at the cost of more evaluations.
+
+        The step size for each dof is the larger of eps, which may be a
+        scalar or an array with one entry per dof, and rel_eps times
+        the magnitude of the dof. If rel_eps is 'auto', it is chosen
+        from the noise level of the functions, which is estimated with
+        fd_estimate_noise() the first time it is needed. See
+        fd_rel_eps().
 
         If the argument x is not supplied, the Jacobian will be
         evaluated for the present state vector. If x is supplied, then
         first get_dofs() will be called for each object to set the
         global state vector to x.
 
+        If fail is not None, any function evaluation that raises
+        ObjectiveFailure is replaced by a vector filled with fail.
+
+        If callback is not None, it is called as callback(x, f,
+        success) after each function evaluation.
+
+        If grouped is True, dofs that no function depends on together
+        are perturbed together in a single function evaluation (see
+        color_columns()), and Jacobian entries for a function and a dof
+        it does not depend on are exactly zero. If grouped is False,
+        each dof is perturbed separately.
+
+        If reuse is True, at each finite-difference point only the
+        functions that depend on the perturbed dofs are evaluated. The
+        other functions have the same values as at the unperturbed
+        state vector, which are reused.
+
         No parallelization is used here.
         """
 
         if x is not None:
             self.set(x)
 
-        logger.info('Beginning finite difference gradient calculation for functions ' + str(self.funcs))
+        logger.info('Beginning finite difference gradient calculation for functions %s', self.funcs)
 
         x0 = self.x
-        logger.info('  nparams: {}, nfuncs: {}, nvals: {}'.format(self.nparams, self.nfuncs, self.nvals))
-        logger.info('  x0: ' + str(x0))
+        logger.info('  nparams: %s, nfuncs: %s, nvals: %s', self.nparams, self.nfuncs, self.nvals)
+        logger.debug('  x0: %s', x0)
 
         # Handle the rare case in which nparams==0, so the Jacobian
         # has size (nvals, 0):
@@ -374,38 +854,34 @@ class Dofs:
             jac = np.zeros((self.nvals, self.nparams))
             return jac
 
-        if centered:
-            # Centered differences:
-            jac = None
-            for j in range(self.nparams):
-                x = np.copy(x0)
-
-                x[j] = x0[j] + eps
-                self.set(x)
-                # fplus = np.array([f() for f in self.funcs])
-                fplus = self.f()
-                if jac is None:
-                    # After the first function evaluation, we now know
-                    # the size of the Jacobian.
-                    jac = np.zeros((self.nvals, self.nparams))
-
-                x[j] = x0[j] - eps
-                self.set(x)
-                fminus = self.f()
-
-                jac[:, j] = (fplus - fminus) / (2 * eps)
-
-        else:
-            # 1-sided differences
-            f0 = self.f()
-            jac = np.zeros((self.nvals, self.nparams))
-            for j in range(self.nparams):
-                x = np.copy(x0)
-                x[j] = x0[j] + eps
-                self.set(x)
-                fplus = self.f()
-
-                jac[:, j] = (fplus - f0) / eps
+        nodes = stencil_nodes(stencil, centered)
+        if rel_eps == 'auto':
+            if self.fd_noise is None:
+                self.fd_estimate_noise(fail, callback)
+            rel_eps = fd_rel_eps(self.fd_noise, order=stencil_order(nodes))
+        offsets = fd_offsets(x0, eps, self.mins, self.maxs, nodes, rel_eps)
+        groups = self.column_groups(grouped)
+        xs, columns, point_groups = fd_points(x0, groups, offsets)
+        nevals = xs.shape[1]
+        logger.info('  %d function evaluations for %d column groups', nevals, len(groups))
+
+        cache = [None] * self.nfuncs
+        mask = None
+        evals = None
+        for j in range(nevals):
+            self.set(xs[:, j])
+            if reuse:
+                mask = self.fd_eval_mask(point_groups[j], cache)
+            f, success = self._f_or_fail(fail, callback, mask, cache)
+            if reuse and success:
+                self.fd_update_cache(point_groups[j], cache, f)
+            if evals is None:
+                # After the first function evaluation, we now know
+                # the size of the Jacobian.
+                evals = np.zeros((self.nvals, nevals))
+            evals[:, j] = f
+
+        jac = fd_assemble(evals, groups, columns, offsets, self.sparsity())
 
         # Weird things may happen if we do not reset the state vector
         # to x0:
@@ -0,0 +1,86 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides a channel for structured per-evaluation events,
+which is separate from the usual log messages. Events are written as
+one JSON object per line by the 'simsopt.events' logger, which does
+not propagate to the root logger. The channel is off by default, in
+which case emit() returns immediately, so the usual logging can be
+made fully quiet in production runs while events are still
+available when they are switched on.
+"""
+
+import json
+import time
+import logging
+import numpy as np
+from mpi4py import MPI
+
+event_logger = logging.getLogger('simsopt.events')
+event_logger.propagate = False
+
+_enabled = False
+
+
+def enabled():
+    """
+    Return True if the event channel is switched on. Callers should
+    check this before doing any work to build the fields of an event.
+    """
+    return _enabled
+
+
+def enable(filename=None, handler=None):
+    """
+    Switch on the event channel. Events are appended to filename if it
+    is given, otherwise they are sent to the supplied logging handler,
+    otherwise to stderr. Returns the handler.
+    """
+    global _enabled
+    if handler is None:
+        if filename is None:
+            handler = logging.StreamHandler()
+        else:
+            handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    event_logger.addHandler(handler)
+    event_logger.setLevel(logging.INFO)
+    _enabled = True
+    return handler
+
+
+def disable():
+    """
+    Switch off the event channel and close its handlers.
+    """
+    global _enabled
+    _enabled = False
+    for handler in list(event_logger.handlers):
+        event_logger.removeHandler(handler)
+        handler.close()
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def emit(event, **fields):
+    """
+    Write one event, with the given name and fields, if the channel is
+    switched on. numpy arrays and scalars are converted to lists and
+    python scalars.
+    """
+    if not _enabled:
+        return
+    record = {'event': event,
+              'time': time.time(),
+              'rank': MPI.COMM_WORLD.Get_rank()}
+    for key, value in fields.items():
+        record[key] = _jsonable(value)
+    event_logger.info(json.dumps(record))
@@ -11,6 +11,7 @@ import numpy as np
 import logging
 from mpi4py import MPI
 from .optimizable import Optimizable
+from .util import ObjectiveFailure
 
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
 
@@ -310,3 +311,30 @@ class Affine(Optimizable):
     def dJ(self):
         return self.A
     
+
+
+class Failer(Optimizable):
+    """
+    This class is used for testing failures of the objective
+    function. J() returns a vector of length nvals with all entries
+    equal to 1.0, except that ObjectiveFailure is raised on the
+    evaluations whose (0-based) indices are in fail_indices.
+    """
+    def __init__(self, nparams=2, nvals=3, fail_indices=(2,)):
+        self.nparams = nparams
+        self.nvals = nvals
+        self.fail_indices = fail_indices
+        self.nevals = 0
+        self.x = np.zeros(nparams)
+
+    def get_dofs(self):
+        return self.x
+
+    def set_dofs(self, x):
+        self.x = x
+
+    def J(self):
+        self.nevals += 1
+        if self.nevals - 1 in self.fail_indices:
+            raise ObjectiveFailure("Failer object failed on purpose")
+        return np.full(self.nvals, 1.0)
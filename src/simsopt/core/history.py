@@ -0,0 +1,121 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides the EvaluationHistory class, an append-only
+binary record of function evaluations, and read_history() for
+reading it back.
+
+This module should not depend on anything involving communication
+(e.g. MPI). In parallel runs, only proc0_world should write the
+history.
+"""
+
+import os
+import time
+import logging
+import numpy as np
+from mpi4py import MPI
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+# The file begins with a header of HEADER_SIZE bytes: the magic
+# string followed by nparams and nvals as 64-bit integers. Fixed-size
+# records with dtype history_dtype(nparams, nvals) follow.
+MAGIC = b'SOHIST01'
+HEADER_SIZE = 24
+
+
+def history_dtype(nparams, nvals):
+    """
+    Return the numpy structured dtype of one record in a history file.
+    """
+    return np.dtype([('time', 'f8'),
+                     ('objective', 'f8'),
+                     ('group', 'i4'),
+                     ('success', 'i4'),
+                     ('x', 'f8', (nparams,)),
+                     ('f', 'f8', (nvals,))])
+
+
+def _read_header(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+        raise ValueError(filename + ' is not a simsopt evaluation history file')
+    nparams, nvals = np.frombuffer(header[len(MAGIC):], dtype='<i8')
+    return int(nparams), int(nvals)
+
+
+def read_history(filename):
+    """
+    Return the records in a history file as a read-only numpy memmap
+    with a structured dtype, so e.g. read_history(filename)['x'] is a
+    2D array of all the state vectors. Nothing is read into memory
+    until it is used, so this is practical for very large files.
+    """
+    nparams, nvals = _read_header(filename)
+    dtype = history_dtype(nparams, nvals)
+    nrecords = (os.path.getsize(filename) - HEADER_SIZE) // dtype.itemsize
+    if nrecords == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=HEADER_SIZE,
+                     shape=(nrecords,))
+
+
+class EvaluationHistory:
+    """
+    This class keeps an append-only record of function evaluations:
+    the state vector, function values (e.g. residuals), objective,
+    wall-clock time, MPI group, and success flag of each
+    evaluation. Records are buffered in memory and appended to the
+    file in batches of batch_size. If the file already exists, new
+    records are appended to it.
+
+    If fsync is True, every batch is flushed to disk before flush()
+    returns, so it survives a crash of the machine.
+    """
+    def __init__(self, filename, nparams, batch_size=100, fsync=False):
+        self.filename = filename
+        self.nparams = nparams
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.nvals = None
+        self.buffer = []
+        if os.path.exists(filename):
+            nparams_file, self.nvals = _read_header(filename)
+            if nparams_file != nparams:
+                raise ValueError('History file {} has {} parameters, but the '
+                                 'problem has {}'.format(filename, nparams_file,
+                                                         nparams))
+
+    def record(self, x, f, objective, group=0, success=True):
+        """
+        Add one function evaluation to the history.
+        """
+        if self.nvals is None:
+            self.nvals = len(f)
+        self.buffer.append((time.time(), objective, group, int(success),
+                            np.array(x, dtype=float), np.array(f, dtype=float)))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Append all buffered records to the file.
+        """
+        if not self.buffer:
+            return
+        records = np.array(self.buffer, dtype=history_dtype(self.nparams, self.nvals))
+        if not os.path.exists(self.filename):
+            header = MAGIC + np.array([self.nparams, self.nvals], dtype='<i8').tobytes()
+            with open(self.filename, 'wb') as f:
+                f.write(header)
+        with open(self.filename, 'ab') as f:
+            f.write(records.tobytes())
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        logger.debug('Wrote %d records to %s', len(self.buffer), self.filename)
+        self.buffer = []
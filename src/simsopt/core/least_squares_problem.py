@@ -11,10 +11,11 @@ import numpy as np
 import logging
 import warnings
 
-from scipy.optimize import least_squares
 from mpi4py import MPI
+from . import events
+from . import timer
 from .dofs import Dofs
-from .util import isnumber
+from .util import isnumber, ObjectiveFailure
 from .optimizable import function_from_user, Target
 
 
@@ -69,13 +70,17 @@ class LeastSquaresProblem:
     problem. The class stores a list of LeastSquaresTerm objects.
     """
 
-    def __init__(self, terms):
+    def __init__(self, terms, fail=1.0e12):
         """
         The argument "terms" must be convertable to a list by the list()
         subroutine. Each entry of the resulting list must either have
         type LeastSquaresTerm or else be a list or tuple of the form
         (function, goal, weight) or (object, attribute_str, goal,
         weight).
+
+        fail is the value given to every residual when a function
+        evaluation raises ObjectiveFailure, e.g. if VMEC does not
+        converge.
         """
 
         #try:
@@ -104,6 +109,11 @@ class LeastSquaresProblem:
         if not len(self.terms):
             raise ValueError("At least 1 LeastSquaresTerm must be as argument")
 
+        self.fail = fail
+        self.nfailures = 0
+        # If history is set to an EvaluationHistory, every function
+        # evaluation is recorded in it:
+        self.history = None
         self._init()
 
     def _init(self):
@@ -143,7 +153,7 @@ class LeastSquaresProblem:
         first set_dofs() will be called for each object to set the
         global state vector to x.
         """
-        logger.info("objective() called with x=" + str(x))
+        logger.debug("objective() called with x=%s", x)
         self.x = x
 
         return sum(t.f_out() for t in self.terms)
@@ -161,13 +171,34 @@ class LeastSquaresProblem:
         first set_dofs() will be called for each object to set the
         global state vector to x.
         """
-        logger.info("residuals() called with x=" + str(x))
+        logger.debug("residuals() called with x=%s", x)
         self.x = x
 
         # Importantly for MPI, the next line calls the functions in
         # the same order that Dofs.f() does. Proc0 calls this function
         # whereas worker procs call Dofs.f().
-        f_unscaled = self.dofs.f()
+        try:
+            f_unscaled = self.dofs.f()
+        except ObjectiveFailure as err:
+            self.nfailures += 1
+            if self.dofs.nvals is None:
+                # We do not know how many residuals there are, so we
+                # cannot form the penalty vector.
+                raise
+            logger.warning('Function evaluation failed: %s', err)
+            residuals = np.full(self.dofs.nvals, self.fail)
+            self.record(self.x, residuals, success=False)
+            return residuals
+
+        residuals = self.residuals(f_unscaled)
+        self.record(self.x, residuals)
+        return residuals
+
+    def residuals(self, f_unscaled):
+        """
+        Given the vector of function values returned by Dofs.f(), shift
+        and scale the terms to form the vector of residuals.
+        """
         residuals = np.zeros(len(f_unscaled))
         start_index = 0
         for j in range(self.dofs.nfuncs):
@@ -181,7 +212,36 @@ class LeastSquaresProblem:
         #               term in self.terms]
         # return np.array(residuals)
         return residuals
+
+    def record(self, x, residuals, success=True, group=0):
+        """
+        Add a function evaluation to the history, if there is one, and
+        to the event channel, if it is switched on.
+        """
+        if self.history is None and not events.enabled():
+            return
+        objective = np.dot(residuals, residuals)
+        if self.history is not None:
+            self.history.record(x, residuals, objective,
+                                group=group, success=success)
+        events.emit('evaluation', x=x, objective=objective, success=success,
+                    group=group)
+
+    def record_dofs_f(self, x, f_unscaled, success=True, group=0):
+        """
+        Same as record(), but given the vector of function values
+        returned by Dofs.f(). This method can be passed as the callback
+        argument of Dofs.fd_jac() and fd_jac_mpi().
+        """
+        if self.history is None and not events.enabled():
+            return
+        if success:
+            residuals = self.residuals(f_unscaled)
+        else:
+            residuals = np.full(len(f_unscaled), self.fail)
+        self.record(x, residuals, success=success, group=group)
         
+    @timer.timed('Jacobian assembly')
     def scale_dofs_jac(self, jmat):
         """
         Given a Jacobian matrix j for the Dofs() associated to this
@@ -192,7 +252,7 @@ class LeastSquaresProblem:
         with serial or parallel finite differences. The provided jmat
         is scaled in-place.
         """
-        logger.info("scale_dofs_jac() called")
+        logger.debug("scale_dofs_jac() called")
 
         # Scale rows by sqrt(weight):
         start_index = 0
@@ -221,7 +281,7 @@ class LeastSquaresProblem:
 
         kwargs is passed to Dofs.fd_jac().
         """
-        logger.info("jac() called with x=" + str(x))
+        logger.debug("jac() called with x=%s", x)
 
         self.x = x
 
@@ -234,7 +294,12 @@ class LeastSquaresProblem:
             jmat = self.dofs.jac()
         else:
             logger.debug('Calling finite_difference Jacobian')
+            kwargs.setdefault('fail', self.fail)
+            kwargs.setdefault('callback', self.record_dofs_f)
             jmat = self.dofs.fd_jac(**kwargs)
 
+        if events.enabled():
+            events.emit('jacobian', x=self.dofs.x, grad_avail=self.dofs.grad_avail)
+
         # Scale by sqrt(weight) factor:
         return self.scale_dofs_jac(jmat)
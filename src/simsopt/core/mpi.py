@@ -3,7 +3,7 @@
 # Distributed under the terms of the LGPL License
 
 """
-This module contains the MpiPartition class.
+This module contains the MpiPartition and MpiHierarchy classes.
 
 This module should be completely self-contained, depending only on
 mpi4py and numpy, not on any other simsopt components.
@@ -12,22 +12,130 @@ mpi4py and numpy, not on any other simsopt components.
 import numpy as np
 from mpi4py import MPI
 import logging
+from . import timer
 
 STOP = 0
 
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
 
+def node_aware_groups(nodes, ngroups):
+    """
+    Given the index of the node (shared-memory domain) of every process,
+    ordered by rank, return the group of every process, such that no
+    group spans more than one node if ngroups is at least the number
+    of nodes. In that case each node gets a number of groups
+    proportional to its number of processes, so the group sizes are
+    as even as possible. If there are fewer groups than nodes, each
+    group consists of whole nodes instead.
+
+    Within each node, groups are formed from consecutive ranks.
+    """
+    nodes = np.asarray(nodes)
+    nnodes = np.max(nodes) + 1
+    sizes = np.bincount(nodes, minlength=nnodes)
+    groups = np.zeros(len(nodes), dtype=int)
+    if ngroups >= nnodes:
+        # Start with 1 group per node, then repeatedly give another
+        # group to the node with the most processes per group:
+        counts = np.ones(nnodes, dtype=int)
+        for j in range(ngroups - nnodes):
+            procs_per_group = np.where(counts < sizes, sizes / counts, -1.0)
+            counts[np.argmax(procs_per_group)] += 1
+        offset = 0
+        for node in range(nnodes):
+            ranks = np.nonzero(nodes == node)[0]
+            groups[ranks] = offset + (np.arange(len(ranks)) * counts[node]) // len(ranks)
+            offset += counts[node]
+    else:
+        groups = (nodes * ngroups) // nnodes
+    return groups
+
+
+def sizes_from_weights(weights, nprocs):
+    """
+    Divide nprocs processes into groups with sizes as close as possible
+    to proportional to weights, with at least 1 process per group.
+    """
+    weights = np.array(weights, dtype=float)
+    if len(weights) > nprocs:
+        raise ValueError('There are more groups than processes')
+    if np.any(weights <= 0):
+        raise ValueError('Group weights must be positive')
+    ideal = weights * nprocs / np.sum(weights)
+    sizes = np.ones(len(weights), dtype=int)
+    for j in range(nprocs - len(weights)):
+        sizes[np.argmax(ideal - sizes)] += 1
+    return sizes
+
+
 class MpiPartition():
     """
     This module contains functions related to dividing up the set of
     MPI processors into groups, each of which can work together.
+
+    If node_aware is True, groups are formed so that no group spans
+    two nodes when possible, see node_aware_groups(). Otherwise
+    groups are formed from consecutive ranks.
+
+    Groups of different sizes can be requested with group_sizes, a
+    list with the number of processes in each group, or with
+    group_weights, a list of relative sizes. In either case ngroups
+    is ignored.
+
+    throughput is the relative speed at which each group evaluates
+    functions, and is used by schedule() to share evaluations among
+    the groups, e.g. in fd_jac_mpi(). By default it is proportional
+    to the group sizes if group_sizes or group_weights is given, and
+    equal for all groups otherwise.
+
+    eval_timeout is the wall-clock limit in seconds for each function
+    evaluation in the parallel solvers. In fd_jac_mpi() and
+    evaluate_mpi(), proc0_world keeps the deadline: points of a group
+    that has not reported a result within eval_timeout are given to
+    other groups, and the first result to arrive is used. A late group
+    cannot be interrupted, so it still holds up the next collective
+    operation of the leaders, see _evaluate_points() in mpi_solve. The
+    evaluations of proc0_world's own group, such as those of the
+    objective in least_squares_mpi_solve(), cannot be given away, so a
+    warning is logged if they take longer, and their results are kept.
     """
-    def __init__(self, ngroups=None, comm_world=MPI.COMM_WORLD):
+    def __init__(self, ngroups=None, comm_world=MPI.COMM_WORLD, node_aware=False,
+                 group_sizes=None, group_weights=None, throughput=None,
+                 eval_timeout=None):
         self.is_apart = False
+        self.eval_timeout = eval_timeout
+        # Number of times the group leaders have shared a set of
+        # evaluations, used to recognize late results from an earlier
+        # set:
+        self.eval_round = 0
         self.comm_world = comm_world
         self.rank_world = comm_world.Get_rank()
         self.nprocs_world = comm_world.Get_size()
         self.proc0_world = (self.rank_world == 0)
+
+        # Find which processes share a node. Nodes are numbered in
+        # order of their lowest rank.
+        self.comm_node = comm_world.Split_type(MPI.COMM_TYPE_SHARED, key=self.rank_world)
+        self.rank_node = self.comm_node.Get_rank()
+        self.nprocs_node = self.comm_node.Get_size()
+        node_leader = self.comm_node.bcast(self.rank_world, root=0)
+        node_leaders = np.array(comm_world.allgather(node_leader))
+        self.nodes = np.unique(node_leaders, return_inverse=True)[1]
+        self.node = int(self.nodes[self.rank_world])
+        self.nnodes = int(np.max(self.nodes)) + 1
+        
+        if group_sizes is not None and group_weights is not None:
+            raise ValueError('Only one of group_sizes and group_weights can be given')
+        if group_weights is not None:
+            group_sizes = sizes_from_weights(group_weights, self.nprocs_world)
+        if group_sizes is not None:
+            if node_aware:
+                raise ValueError('node_aware cannot be used with group_sizes or group_weights')
+            group_sizes = np.array(group_sizes, dtype=int)
+            if np.any(group_sizes < 1) or np.sum(group_sizes) != self.nprocs_world:
+                raise ValueError('group_sizes must be positive and add up to the '
+                                 'number of processes, {}'.format(self.nprocs_world))
+            ngroups = len(group_sizes)
         
         if ngroups is None:
             ngroups = self.nprocs_world
@@ -37,10 +145,33 @@ class MpiPartition():
             logger.info('Raising ngroups to 1')
         if ngroups > self.nprocs_world:
             ngroups = self.nprocs_world
-            logger.info('Lowering ngroups to {}'.format(ngroups))
+            logger.info('Lowering ngroups to %d', ngroups)
         self.ngroups = ngroups
 
-        self.group = int(np.floor((self.rank_world * ngroups) / self.nprocs_world))
+        # Group of every process:
+        ranks = np.arange(self.nprocs_world)
+        if group_sizes is not None:
+            groups = np.searchsorted(np.cumsum(group_sizes), ranks, side='right')
+        elif node_aware:
+            groups = node_aware_groups(self.nodes, ngroups)
+        else:
+            groups = (ranks * ngroups) // self.nprocs_world
+        self.group = int(groups[self.rank_world])
+        self.group_sizes = np.bincount(groups, minlength=ngroups)
+
+        # Groups in the order of the ranks of their leaders in
+        # comm_leaders:
+        first_ranks = np.array([np.min(ranks[groups == j]) for j in range(ngroups)])
+        self.leaders_groups = np.argsort(first_ranks)
+
+        if throughput is None:
+            if group_sizes is None:
+                throughput = np.ones(ngroups)
+            else:
+                throughput = self.group_sizes
+        if len(throughput) != ngroups:
+            raise ValueError('throughput must have one entry per group')
+        self.throughput = np.array(throughput, dtype=float)
 
         # Set up the "groups" communicator:
         self.comm_groups = self.comm_world.Split(color=self.group, key=self.rank_world)
@@ -63,38 +194,174 @@ class MpiPartition():
             self.rank_leaders = -1
             self.nprocs_leaders = -1
 
-    def write(self):
-        """ Dump info about the MPI configuration """
-        columns = ["rank_world","nprocs_world","group","ngroups","rank_groups","nprocs_groups","rank_leaders","nprocs_leaders"]
-        data = [self.rank_world , self.nprocs_world , self.group , self.ngroups , self.rank_groups , self.nprocs_groups , self.rank_leaders , self.nprocs_leaders]
+    def shared_array(self, shape, dtype='d', data=None):
+        """
+        Return a numpy array of the given shape and dtype that is stored
+        only once on each node, in memory shared by all the processes
+        of comm_world on that node. This is meant for large read-mostly
+        data, such as field or basis tables, that every process needs.
+        All processes of comm_world must call this function.
 
-        # Each processor sends their data to proc0_world, and
-        # proc0_world writes the result to the file in order.
-        if self.proc0_world:
-            # Print header row
-            width = max(len(s) for s in columns) + 1
-            print(",".join(s.rjust(width) for s in columns))
-            print(",".join(str(s).rjust(width) for s in data))
-            for tag in range(1, self.nprocs_world):
-                data = self.comm_world.recv(tag=tag)
-                print(",".join(str(s).rjust(width) for s in data))
+        If data is given on proc0_world, it is copied into the array,
+        and sent to the other nodes. Otherwise the array is
+        uninitialized. Processes that write to the array later should
+        call comm_node.Barrier() before other processes on the node
+        read it.
+
+        The memory is released by free_shared().
+        """
+        dtype = np.dtype(dtype)
+        shape = tuple(np.atleast_1d(shape))
+        # Only the first process on each node allocates memory:
+        if self.rank_node == 0:
+            nbytes = int(np.prod(shape)) * dtype.itemsize
         else:
-            tag = self.rank_world
-            self.comm_world.send(data, 0, tag)
-            
+            nbytes = 0
+        win = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=self.comm_node)
+        if not hasattr(self, '_windows'):
+            self._windows = []
+            # Communicator connecting the first process of each node:
+            color = 0 if self.rank_node == 0 else MPI.UNDEFINED
+            self._comm_node_leaders = self.comm_world.Split(color=color, key=self.rank_world)
+        self._windows.append(win)
+        buf, itemsize = win.Shared_query(0)
+        array = np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+
+        # Fill the array on the first process of each node. proc0_world
+        # is always the first process on its node.
+        if self.comm_world.bcast(data is not None and self.proc0_world, root=0):
+            if self.rank_node == 0:
+                if self.proc0_world:
+                    array[...] = data
+                with timer.section('MPI communication'):
+                    self._comm_node_leaders.Bcast(array, root=0)
+            self.comm_node.Barrier()
+        return array
+
+    def free_shared(self):
+        """
+        Release the memory of all arrays created by shared_array(), which
+        must not be used afterwards. All processes of comm_world must
+        call this function.
+        """
+        if not hasattr(self, '_windows'):
+            return
+        for win in self._windows:
+            win.Free()
+        if self._comm_node_leaders != MPI.COMM_NULL:
+            self._comm_node_leaders.Free()
+        # shared_array() creates these again when next called:
+        del self._windows
+        del self._comm_node_leaders
+
+    def schedule(self, nevals):
+        """
+        Return an array giving, for each of nevals evaluations, the rank
+        in comm_leaders of the group that should do it. Each evaluation
+        goes to the group that would finish it soonest, given the
+        throughput of each group, so faster groups do more
+        evaluations. With equal throughput this is round-robin,
+        evaluation j going to rank j % ngroups. Evaluation 0 is always
+        done by proc0_world's group.
+        """
+        throughput = self.throughput[self.leaders_groups]
+        if np.all(throughput == throughput[0]):
+            return np.mod(np.arange(nevals), self.ngroups)
+        owners = np.zeros(nevals, dtype=int)
+        counts = np.zeros(self.ngroups)
+        for j in range(nevals):
+            if j > 0:
+                owners[j] = np.argmin((counts + 1) / throughput)
+            counts[owners[j]] += 1
+        return owners
+
+    _columns = ["rank_world", "nprocs_world", "group", "ngroups", "rank_groups",
+                "nprocs_groups", "rank_leaders", "nprocs_leaders", "node",
+                "nnodes", "rank_node"]
+
+    def _gather(self):
+        """
+        Collect a row of the values in _columns, and the processor name,
+        from every process onto proc0_world, in a single gather. The
+        return value is a list of (row, name) in rank order on
+        proc0_world, and None on other processes.
+        """
+        row = [getattr(self, column) for column in self._columns]
+        with timer.section('MPI communication'):
+            return self.comm_world.gather((row, MPI.Get_processor_name()), root=0)
+
+    def _summary(self, gathered):
+        """
+        Format the data returned by _gather() as a summary of the
+        nodes, group sizes and placement of the group leaders.
+        """
+        group = np.array([row[2] for row, name in gathered])
+        node = np.array([row[8] for row, name in gathered])
+        leader = np.array([row[4] == 0 for row, name in gathered])
+        sizes = np.bincount(group, minlength=self.ngroups)
+        lines = ['MPI partition: {} processes on {} nodes in {} groups'.format(
+            self.nprocs_world, self.nnodes, self.ngroups)]
+        for j in range(self.nnodes):
+            on_node = (node == j)
+            lines.append('  node {} ({}): {} processes, {} groups, {} leaders'.format(
+                j, gathered[np.argmax(on_node)][1], np.sum(on_node),
+                len(np.unique(group[on_node])), np.sum(leader & on_node)))
+        values, counts = np.unique(sizes, return_counts=True)
+        lines.append('  groups of each size: ' + ', '.join(
+            '{} of {}'.format(c, v) for v, c in zip(values, counts)))
+        # Count groups whose processes are on more than one node:
+        nodes_per_group = [len(np.unique(node[group == j])) for j in range(self.ngroups)]
+        lines.append('  groups spanning more than one node: {}'.format(
+            np.sum(np.array(nodes_per_group) > 1)))
+        lines.append('  leaders (rank_world): {}'.format(
+            ' '.join(str(rank) for rank in np.nonzero(leader)[0])))
+        return '\n'.join(lines)
+
+    def summary(self):
+        """
+        Return a short description of the partition: the number of
+        processes, groups and leaders on each node, the distribution of
+        group sizes, and the ranks of the group leaders. All processes
+        of comm_world must call this function. The result is a string
+        on proc0_world, and None on other processes.
+        """
+        gathered = self._gather()
+        if self.proc0_world:
+            return self._summary(gathered)
+        return None
+
+    def write(self, per_process=True):
+        """
+        Dump info about the MPI configuration. If per_process is True,
+        proc0_world prints a table with one row per process, followed
+        by the summary(). All processes of comm_world must call this
+        function.
+        """
+        gathered = self._gather()
+        if not self.proc0_world:
+            return
+        if per_process:
+            width = max(len(s) for s in self._columns) + 1
+            print(",".join(s.rjust(width) for s in self._columns))
+            for row, name in gathered:
+                print(",".join(str(s).rjust(width) for s in row))
+        print(self._summary(gathered))
+
     def mobilize_leaders(self, action_const):
-        logger.debug('mobilize_leaders, action_const={}'.format(action_const))
+        logger.debug('mobilize_leaders, action_const=%s', action_const)
         if not self.proc0_world:
             raise RuntimeError('Only proc0_world should call mobilize_leaders()')
 
-        self.comm_leaders.bcast(action_const, root=0)
+        with timer.section('MPI communication'):
+            self.comm_leaders.bcast(action_const, root=0)
 
     def mobilize_workers(self, action_const):
-        logger.debug('mobilize_workers, action_const={}'.format(action_const))
+        logger.debug('mobilize_workers, action_const=%s', action_const)
         if not self.proc0_groups:
             raise RuntimeError('Only group leaders should call mobilize_workers()')
 
-        self.comm_groups.bcast(action_const, root=0)
+        with timer.section('MPI communication'):
+            self.comm_groups.bcast(action_const, root=0)
 
     def stop_leaders(self):
         logger.debug('stop_leaders')
@@ -129,7 +396,7 @@ class MpiPartition():
             # Wait for proc 0 to send us something:
             data = None
             data = self.comm_leaders.bcast(data, root=0)
-            logger.debug('leaders_loop received {}'.format(data))
+            logger.debug('leaders_loop received %s', data)
             if data == STOP:
                 # Tell workers to stop
                 break
@@ -156,7 +423,7 @@ class MpiPartition():
             # Wait for the group leader to send us something:
             data = None
             data = self.comm_groups.bcast(data, root=0)
-            logger.debug('worker_loop worker received {}'.format(data))
+            logger.debug('worker_loop worker received %s', data)
             if data == STOP:
                 break
 
@@ -190,3 +457,67 @@ class MpiPartition():
             self.stop_workers() # All group leaders stop their workers.
 
         self.is_apart = False
+
+
+class MpiHierarchy():
+    """
+    This class divides the MPI processes into nested levels of groups,
+    for combining several kinds of parallelism, e.g. multiple starts
+    or a population of points, each evaluated with a parallel
+    finite-difference gradient, each function evaluation of which
+    uses several processes.
+
+    ngroups is a list with the number of groups at each level. The
+    processes of comm_world are divided into ngroups[0] groups, each
+    of these is divided into ngroups[1] groups, and so on. Each level
+    is an ordinary MpiPartition, whose comm_world is the group of the
+    level above, so each level has its own communicators and its own
+    leaders and worker loops. For instance, levels[1] is the partition
+    of this process's level-0 group into level-1 groups, and can be
+    passed to fd_jac_mpi() or least_squares_mpi_solve().
+
+    node_aware is passed to the MpiPartition of every level.
+    """
+    def __init__(self, ngroups, comm_world=MPI.COMM_WORLD, node_aware=False):
+        if len(ngroups) < 1:
+            raise ValueError('ngroups must have at least 1 entry')
+        self.comm_world = comm_world
+        self.levels = []
+        comm = comm_world
+        for n in ngroups:
+            partition = MpiPartition(ngroups=n, comm_world=comm,
+                                     node_aware=node_aware)
+            self.levels.append(partition)
+            comm = partition.comm_groups
+        self.nlevels = len(self.levels)
+        self.rank_world = comm_world.Get_rank()
+        self.nprocs_world = comm_world.Get_size()
+        self.proc0_world = (self.rank_world == 0)
+
+    def __len__(self):
+        return self.nlevels
+
+    def __getitem__(self, level):
+        return self.levels[level]
+
+    @property
+    def ngroups(self):
+        """
+        The number of groups at each level, after any adjustment to
+        the number of processes available.
+        """
+        return [m.ngroups for m in self.levels]
+
+    @property
+    def groups(self):
+        """
+        The index of the group containing this process at each level.
+        """
+        return tuple(m.group for m in self.levels)
+
+    @property
+    def comm_groups(self):
+        """
+        The communicator of the innermost group containing this process.
+        """
+        return self.levels[-1].comm_groups
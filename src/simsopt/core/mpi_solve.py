@@ -3,17 +3,24 @@
 # Distributed under the terms of the LGPL License
 
 """
-This module provides two main functions, fd_jac_mpi and
-least_squares_mpi_solve. Also included are some functions that help in
-the operation of these main functions.
+This module provides four main functions, fd_jac_mpi, evaluate_mpi,
+least_squares_mpi_solve and mpi_solve. Also included are some
+functions that help in the operation of these main functions.
 """
 
+import time
 from mpi4py import MPI
 import numpy as np
-from scipy.optimize import least_squares
 import logging
-from .dofs import Dofs
-from .util import isnumber
+from . import events
+from . import timer
+from .dofs import Dofs, fd_offsets, fd_points, fd_assemble, noise_points, \
+    relative_noise, fd_rel_eps, stencil_nodes, stencil_order
+from .checkpoint import Checkpoint
+from .history import EvaluationHistory
+from .broyden import BroydenJacobian
+from .serial_solve import _minimize_bounds, _least_squares_bounds
+from .util import isnumber, ObjectiveFailure
 from .optimizable import function_from_user, Target
 
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
@@ -22,27 +29,60 @@ logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
 CALCULATE_F = 1
 CALCULATE_JAC = 2
 CALCULATE_FD_JAC = 3
+CALCULATE_F_MASKED = 4
+CALCULATE_POPULATION = 5
 
-def mpi_leaders_task(mpi, dofs, data):
+# Status of a function evaluation that did not succeed:
+FAILED = 1
+TIMED_OUT = 2
+
+# Tags of the messages between proc0_world and the other group leaders
+# in _evaluate_points():
+RESULT_TAG = 101
+TASK_TAG = 102
+
+# Seconds between checks for results and deadlines on proc0_world:
+POLL_INTERVAL = 1e-3
+
+def _bcast_x(comm, x):
+    """
+    Broadcast the state vector x from rank 0 of comm, and return it. The
+    array is sent as a raw buffer rather than as a pickled object, so
+    on the other ranks x must be a float array of the same size, into
+    which the data is received.
+    """
+    x = np.ascontiguousarray(x, dtype='d')
+    comm.Bcast(x, root=0)
+    return x
+
+
+def mpi_leaders_task(mpi, dofs, data, fd_kwargs=None):
     """
     This function is called by group leaders when
     MpiPartition.leaders_loop() receives a signal to do something.
 
-    We have to take a "data" argument, but there is only 1 task we
-    would do, so we don't use it.
+    data is either CALCULATE_FD_JAC, for a finite-difference Jacobian,
+    or CALCULATE_POPULATION, for evaluating a set of points.
+
+    fd_kwargs is a dict of arguments for fd_jac_mpi(), such as eps and
+    rel_eps, which must be the same as on proc0_world.
     """
     logger.debug('mpi_leaders_task')
 
+    if data == CALCULATE_POPULATION:
+        # The points are sent inside evaluate_mpi:
+        evaluate_mpi(dofs, mpi)
+        return
+
     # x is a buffer for receiving the state vector:
     x = np.empty(dofs.nparams, dtype='d')
     # If we make it here, we must be doing a fd_jac_par
-    # calculation, so receive the state vector: mpi4py has
-    # separate bcast and Bcast functions!!  comm.Bcast(x,
-    # root=0)
-    x = mpi.comm_leaders.bcast(x, root=0)
-    logger.debug('mpi_leaders_loop x={}'.format(x))
+    # calculation, so receive the state vector:
+    with timer.section('MPI communication'):
+        x = _bcast_x(mpi.comm_leaders, x)
+    logger.debug('mpi_leaders_loop x=%s', x)
     dofs.set(x)
-    fd_jac_mpi(dofs, mpi)
+    fd_jac_mpi(dofs, mpi, **(fd_kwargs or {}))
     
             
 def mpi_workers_task(mpi, dofs, data):
@@ -55,29 +95,301 @@ def mpi_workers_task(mpi, dofs, data):
     # x is a buffer for receiving the state vector:
     x = np.empty(dofs.nparams, dtype='d')
     # If we make it here, we must be doing a fd_jac_par
-    # calculation, so receive the state vector: mpi4py has
-    # separate bcast and Bcast functions!!  comm.Bcast(x,
-    # root=0)
-    x = mpi.comm_groups.bcast(x, root=0)
-    logger.debug('worker_loop worker x={}'.format(x))
+    # calculation, so receive the state vector:
+    with timer.section('MPI communication'):
+        x = _bcast_x(mpi.comm_groups, x)
+    logger.debug('worker_loop worker x=%s', x)
     dofs.set(x)
 
     # We don't store or do anything with f() or jac(), because
-    # the group leader will handle that.
-    if data == CALCULATE_F:
-        dofs.f()
-    elif data == CALCULATE_JAC:
-        dofs.jac()
-    else:
-        raise ValueError('Unexpected data in worker_loop')    
+    # the group leader will handle that. Failures are also handled
+    # by the group leader.
+    try:
+        if data == CALCULATE_F:
+            dofs.f()
+        elif data == CALCULATE_F_MASKED:
+            # Evaluate only the functions the group leader evaluates:
+            with timer.section('MPI communication'):
+                mask = mpi.comm_groups.bcast(None, root=0)
+            dofs.f(mask=mask)
+        elif data == CALCULATE_JAC:
+            dofs.jac()
+        else:
+            raise ValueError('Unexpected data in worker_loop')
+    except ObjectiveFailure:
+        logger.debug('worker_loop function evaluation failed')
 
     
-def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
+def _evaluate_point(dofs, mpi, x, j, reuse, point_groups, cache):
+    """
+    Evaluate the functions in dofs at x, together with the workers of
+    this group. This function is called only by group leaders. The
+    return value is a tuple (f, status), where status is 0 on success,
+    or FAILED if ObjectiveFailure was raised, in which case f is 0.
+    """
+    if reuse:
+        mask = dofs.fd_eval_mask(point_groups[j], cache)
+        mpi.mobilize_workers(CALCULATE_F_MASKED)
+        with timer.section('MPI communication'):
+            _bcast_x(mpi.comm_groups, x)
+            mpi.comm_groups.bcast(mask, root=0)
+    else:
+        mask = None
+        mpi.mobilize_workers(CALCULATE_F)
+        with timer.section('MPI communication'):
+            _bcast_x(mpi.comm_groups, x)
+    dofs.set(x)
+    try:
+        f = dofs.f(mask=mask, cache=cache)
+    except ObjectiveFailure as err:
+        if dofs.nvals is None:
+            raise
+        logger.warning('Function evaluation %d failed: %s', j, err)
+        return np.zeros(dofs.nvals), FAILED
+    if reuse:
+        dofs.fd_update_cache(point_groups[j], cache, f)
+    return f, 0
+
+
+def _evaluate_points(dofs, mpi, xs, owners, reuse=False, point_groups=None):
+    """
+    Evaluate the functions in dofs at the columns of xs, with column j
+    handled by the group with rank_leaders equal to owners[j]. This
+    function is called by all group leaders, while the workers are in
+    their loop.
+
+    Each group leader sends its results to proc0_world as soon as it
+    has them, without waiting for the other groups. If mpi.eval_timeout
+    is set, proc0_world gives the points of a group that has not
+    reported a result within this time to idle groups, or evaluates
+    them itself, and uses whichever result arrives first. A point that
+    is also late in the group it was given to is treated as failed.
+    owners is updated on proc0_world to the group whose result was
+    used. Once every point has a result, proc0_world tells the other
+    leaders to return. A leader that is still evaluating a point then
+    drops its result, and each leader waits for its messages of the
+    round to complete before it returns. A result sent just before the
+    leader is told to return is discarded by proc0_world when it next
+    collects results.
+
+    The evaluation of a late group cannot be interrupted, so the round
+    ends without it, but the group only returns once its evaluation
+    does. The next collective operation on mpi.comm_leaders, such as
+    the next mobilize_leaders(), waits for it. The time limit therefore
+    keeps a slow group from holding up one round, but an evaluation
+    that never returns, e.g. a hung VMEC run, still stops the whole
+    job, one round later.
+
+    If reuse is True, functions that do not depend on the dofs
+    perturbed at point j, according to point_groups, are not evaluated
+    again, as in fd_jac_mpi().
+
+    On proc0_world, the return value is a tuple (evals, failed), where
+    failed[j] is nonzero if evaluation j did not succeed. Other
+    processes return (None, None).
+    """
+    mpi.eval_round += 1
+    cache = [None] * dofs.nfuncs
+    if mpi.proc0_world:
+        return _coordinate_points(dofs, mpi, xs, owners, reuse, point_groups, cache)
+
+    # proc0_world is responsible for detecting nvals, since it always
+    # does the first function evaluation:
+    with timer.section('MPI communication'):
+        dofs.nvals = mpi.comm_leaders.bcast(dofs.nvals)
+    todo = list(np.nonzero(owners == mpi.rank_leaders)[0])
+    comm = mpi.comm_leaders
+    control = comm.irecv(source=0, tag=TASK_TAG)
+    sends = []
+    while True:
+        # Check for instructions from proc0_world between evaluations,
+        # and wait for them once this group's own points are done:
+        if todo:
+            received, message = control.test()
+        else:
+            with timer.section('MPI communication'):
+                message = control.wait()
+            received = True
+        if received:
+            j = message[1]
+            if j is None:
+                # All the points have results.
+                break
+            logger.info('Evaluating point %d, which is late in another group', j)
+            todo.append(j)
+            control = comm.irecv(source=0, tag=TASK_TAG)
+            continue
+        j = todo.pop(0)
+        f, status = _evaluate_point(dofs, mpi, xs[:, j], j, reuse, point_groups, cache)
+        # A result that proc0_world no longer needs is not sent, so it
+        # cannot be left unreceived:
+        received, message = control.test()
+        if received and message[1] is None:
+            break
+        if received:
+            todo.append(message[1])
+            control = comm.irecv(source=0, tag=TASK_TAG)
+        sends.append(comm.isend((mpi.eval_round, j, f, status), dest=0, tag=RESULT_TAG))
+    with timer.section('MPI communication'):
+        MPI.Request.Waitall(sends)
+    return None, None
+
+
+def _coordinate_points(dofs, mpi, xs, owners, reuse, point_groups, cache):
+    """
+    The part of _evaluate_points() done by proc0_world: evaluate the
+    points of its own group, collect the results of the other groups,
+    and keep their deadlines.
+    """
+    nevals = xs.shape[1]
+    comm = mpi.comm_leaders
+    nleaders = mpi.nprocs_leaders
+    timeout = mpi.eval_timeout
+    evals = None
+    failed = np.zeros(nevals)
+    done = np.zeros(nevals, dtype=bool)
+    # Points each of the other groups will report, in order, and the
+    # time they last reported one:
+    expected = [list(np.nonzero(owners == rank)[0]) for rank in range(nleaders)]
+    own = expected[0]
+    expected[0] = []
+    heard = np.zeros(nleaders)
+    # Points given to another group because they were late, the point
+    # each group was given, and points waiting for an idle group:
+    retried = set()
+    given = [None] * nleaders
+    waiting = []
+    sends = []
+
+    def accept(j, f, status, rank):
+        if not done[j]:
+            evals[:, j] = f
+            failed[j] = status
+            owners[j] = rank
+            done[j] = True
+
+    def receive():
+        # Collect the results that have arrived:
+        status = MPI.Status()
+        while comm.Iprobe(source=MPI.ANY_SOURCE, tag=RESULT_TAG, status=status):
+            rank = status.Get_source()
+            with timer.section('MPI communication'):
+                eval_round, j, f, fstatus = comm.recv(source=rank, tag=RESULT_TAG)
+            if eval_round != mpi.eval_round:
+                logger.debug('Discarding a late result from group %d', rank)
+                continue
+            expected[rank].remove(j)
+            if given[rank] == j:
+                given[rank] = None
+            heard[rank] = time.time()
+            accept(j, f, fstatus, rank)
+
+    def check_deadlines():
+        now = time.time()
+        for rank in range(1, nleaders):
+            if not expected[rank] or now - heard[rank] <= timeout:
+                continue
+            j = given[rank]
+            if j is not None and not done[j]:
+                logger.warning('Evaluation %d was late in group %d too', j, rank)
+                accept(j, np.zeros(dofs.nvals), TIMED_OUT, rank)
+            for j in expected[rank]:
+                if not (done[j] or j in retried or j in waiting):
+                    logger.info('Evaluation %d is late in group %d', j, rank)
+                    waiting.append(j)
+        # Give the late points to idle groups:
+        for rank in range(1, nleaders):
+            while waiting and not expected[rank]:
+                j = waiting.pop(0)
+                if done[j]:
+                    continue
+                retried.add(j)
+                given[rank] = j
+                expected[rank].append(j)
+                heard[rank] = now
+                sends.append(comm.isend((mpi.eval_round, j), dest=rank, tag=TASK_TAG))
+
+    for j in own:
+        f, status = _evaluate_point(dofs, mpi, xs[:, j], j, reuse, point_groups, cache)
+        if evals is None:
+            with timer.section('MPI communication'):
+                dofs.nvals = comm.bcast(dofs.nvals)
+            evals = np.zeros((dofs.nvals, nevals))
+            heard[:] = time.time()
+        accept(j, f, status, 0)
+        receive()
+        if timeout is not None:
+            check_deadlines()
+
+    while not np.all(done):
+        receive()
+        if timeout is None:
+            if not np.all(done):
+                # Nothing can be late, so wait for the next result:
+                with timer.section('MPI communication'):
+                    comm.Probe(source=MPI.ANY_SOURCE, tag=RESULT_TAG)
+            continue
+        check_deadlines()
+        waiting[:] = [j for j in waiting if not done[j]]
+        if waiting:
+            # No other group is idle, so evaluate a late point here:
+            j = waiting.pop(0)
+            retried.add(j)
+            logger.info('Evaluating point %d, which is late in another group', j)
+            f, status = _evaluate_point(dofs, mpi, xs[:, j], j, reuse, point_groups, cache)
+            accept(j, f, status, 0)
+        elif not np.all(done):
+            time.sleep(POLL_INTERVAL)
+
+    # Let the other leaders return, even if they are still evaluating
+    # late points. Each leader has a receive posted for these messages,
+    # so the sends complete without waiting for the evaluations:
+    for rank in range(1, nleaders):
+        sends.append(comm.isend((mpi.eval_round, None), dest=rank, tag=TASK_TAG))
+    with timer.section('MPI communication'):
+        MPI.Request.Waitall(sends)
+    return evals, failed
+
+
+def _estimate_noise_mpi(dofs, mpi, x0, fail, callback):
+    """
+    Estimate the relative noise level of the functions in dofs about
+    x0, as in Dofs.fd_estimate_noise(), with the evaluations shared
+    among the groups. This function is called by all group leaders,
+    while the workers are in their loop, and sets dofs.fd_noise on all
+    of them.
+    """
+    xs = noise_points(x0, dofs.mins, dofs.maxs)
+    owners = mpi.schedule(xs.shape[1])
+    evals, failed = _evaluate_points(dofs, mpi, xs, owners)
+    noise = None
+    if mpi.proc0_world:
+        evals[:, failed > 0] = fail
+        if callback is not None:
+            for j in range(xs.shape[1]):
+                callback(xs[:, j], evals[:, j], failed[j] == 0, owners[j])
+        noise = relative_noise(evals)
+        logger.info('Estimated relative noise level %s', noise)
+    with timer.section('MPI communication'):
+        dofs.fd_noise = mpi.comm_leaders.bcast(noise, root=0)
+
+
+@timer.timed('fd_jac_mpi')
+def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False, fail=1.0e12,
+               callback=None, grouped=True, reuse=True, rel_eps=0.0,
+               stencil=None):
     """
     Compute the finite-difference Jacobian of the functions in dofs
     with respect to all non-fixed degrees of freedom. Parallel
     function evaluations will be used.
 
+    The stencil and steps are set by centered, stencil, eps and
+    rel_eps as in Dofs.fd_jac(). All the points of the stencil are
+    shared among the groups, so wider stencils such as 'richardson'
+    or '4-point' make use of more groups. If rel_eps is 'auto', the
+    evaluations for estimating the noise level are also shared among
+    the groups. These arguments must be the same on all group leaders.
+
     If the argument x is not supplied, the Jacobian will be
     evaluated for the present state vector. If x is supplied, then
     first get_dofs() will be called for each object to set the
@@ -85,6 +397,25 @@ def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
 
     The mpi argument should be an MpiPartition.
 
+    Any function evaluation that raises ObjectiveFailure is replaced
+    by a vector filled with fail. Only the value of fail on
+    proc0_world is used. If mpi.eval_timeout is set, points that are
+    late in one group are given to another, see _evaluate_points().
+
+    If callback is not None, proc0_world calls it as callback(x, f,
+    success, group) for every function evaluation, after the results
+    from all groups have been combined.
+
+    If grouped is True, dofs that no function depends on together are
+    perturbed together in a single function evaluation, as in
+    Dofs.fd_jac(). This argument must be the same on all group leaders.
+
+    If reuse is True, each group evaluates only the functions that
+    depend on the dofs perturbed at each point, reusing the values of
+    the other functions at the unperturbed state, as in Dofs.fd_jac().
+    Workers are told which functions to evaluate, so functions that
+    communicate within a group stay in step.
+
     There are 2 ways to call this function. In method 1, all procs
     (including workers) call this function (so mpi.is_apart is
     False). In this case, the worker loop will be started
@@ -105,63 +436,33 @@ def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
     if x is not None:
         dofs.set(x)
 
-    logger.info('Beginning parallel finite difference gradient calculation for functions ' + str(dofs.funcs))
+    logger.info('Beginning parallel finite difference gradient calculation for functions %s', dofs.funcs)
 
     x0 = dofs.x
     # Make sure all leaders have the same x0.
-    mpi.comm_leaders.Bcast(x0)
-    logger.info('  nparams: {}, nfuncs: {}'.format(dofs.nparams, dofs.nfuncs))
-    logger.info('  x0: ' + str(x0))
-
-    # Set up the list of parameter values to try
-    if centered:
-        nevals = 2 * dofs.nparams
-        xs = np.zeros((dofs.nparams, nevals))
-        for j in range(dofs.nparams):
-            xs[:, 2 * j] = x0[:] # I don't think I need np.copy(), but not 100% sure.
-            xs[j, 2 * j] = x0[j] + eps
-            xs[:, 2 * j + 1] = x0[:]
-            xs[j, 2 * j + 1] = x0[j] - eps
-    else:
-        # 1-sided differences
-        nevals = dofs.nparams + 1
-        xs = np.zeros((dofs.nparams, nevals))
-        xs[:, 0] = x0[:]
-        for j in range(dofs.nparams):
-            xs[:, j + 1] = x0[:]
-            xs[j, j + 1] = x0[j] + eps
-
-    # proc0_world will be responsible for detecting nvals, since
-    #proc0_world always does at least 1 function evaluation. Other
-    #procs cannot be trusted to evaluate nvals because they may
-    #not have any function evals, in which case they never create
-    #"evals", so the MPI reduce would fail.
-
-    #evals = np.zeros((dofs.nfuncs, nevals))
-    evals = None
-    if not mpi.proc0_world:
-        # All procs other than proc0_world should initialize evals
-        # before the nevals loop, since they may not have any
-        # evals.
-        dofs.nvals = mpi.comm_leaders.bcast(dofs.nvals)
-        evals = np.zeros((dofs.nvals, nevals))
-    # Do the hard work of evaluating the functions.
-    for j in range(nevals):
-        # Handle only this group's share of the work:
-        if np.mod(j, mpi.ngroups) == mpi.rank_leaders:
-            mpi.mobilize_workers(CALCULATE_F)
-            x = xs[:, j]
-            mpi.comm_groups.bcast(x, root=0)
-            dofs.set(x)
-            f = dofs.f()
-            if evals is None and mpi.proc0_world:
-                dofs.nvals = mpi.comm_leaders.bcast(dofs.nvals)
-                evals = np.zeros((dofs.nvals, nevals))
-            evals[:, j] = f
-            #evals[:, j] = np.array([f() for f in dofs.funcs])
-
-    # Combine the results from all groups:
-    evals = mpi.comm_leaders.reduce(evals, op=MPI.SUM, root=0)
+    with timer.section('MPI communication'):
+        mpi.comm_leaders.Bcast(x0)
+    logger.info('  nparams: %s, nfuncs: %s', dofs.nparams, dofs.nfuncs)
+    logger.debug('  x0: %s', x0)
+
+    # Set up the list of parameter values to try, respecting any
+    # bound constraints:
+    nodes = stencil_nodes(stencil, centered)
+    if rel_eps == 'auto':
+        if dofs.fd_noise is None:
+            _estimate_noise_mpi(dofs, mpi, x0, fail, callback)
+        rel_eps = fd_rel_eps(dofs.fd_noise, order=stencil_order(nodes))
+    offsets = fd_offsets(x0, eps, dofs.mins, dofs.maxs, nodes, rel_eps)
+    # Dofs that no function depends on together are perturbed together:
+    groups = dofs.column_groups(grouped)
+    xs, columns, point_groups = fd_points(x0, groups, offsets)
+    nevals = xs.shape[1]
+    # Share the evaluations among the groups according to their
+    # throughput:
+    owners = mpi.schedule(nevals)
+
+    evals, failed = _evaluate_points(dofs, mpi, xs, owners, reuse=reuse,
+                                     point_groups=point_groups)
 
     if not apart_at_start:
         mpi.stop_workers()
@@ -170,15 +471,15 @@ def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
     if not mpi.proc0_world:
         return None
 
+    # Replace failed evaluations by the penalty value:
+    evals[:, failed > 0] = fail
+
+    if callback is not None:
+        for j in range(nevals):
+            callback(xs[:, j], evals[:, j], failed[j] == 0, owners[j])
+
     # Use the evals to form the Jacobian
-    jac = np.zeros((dofs.nvals, dofs.nparams))
-    if centered:
-        for j in range(dofs.nparams):
-            jac[:, j] = (evals[:, 2 * j] - evals[:, 2 * j + 1]) / (2 * eps)
-    else:
-        # 1-sided differences:
-        for j in range(dofs.nparams):
-            jac[:, j] = (evals[:, j + 1] - evals[:, 0]) / eps
+    jac = fd_assemble(evals, groups, columns, offsets, dofs.sparsity())
 
     # Weird things may happen if we do not reset the state vector
     # to x0:
@@ -186,6 +487,72 @@ def fd_jac_mpi(dofs, mpi, x=None, eps=1e-7, centered=False):
     return jac
 
 
+@timer.timed('evaluate_mpi')
+def evaluate_mpi(dofs, mpi, xs=None, callback=None):
+    """
+    Evaluate the functions in dofs at each column of the matrix xs,
+    sharing the evaluations among the worker groups. This is used by
+    population-based optimizers, for which the points of a generation
+    can all be evaluated at once.
+
+    xs needs to be supplied only on proc0_world; it is sent to the
+    other group leaders.
+
+    On proc0_world, the return value is a tuple (evals, failed), where
+    evals[:, j] is the vector returned by dofs.f() at xs[:, j], and
+    failed[j] is True if this evaluation raised ObjectiveFailure, in
+    which case evals[:, j] is 0. Points that are late in one group are
+    given to another if mpi.eval_timeout is set, as in fd_jac_mpi().
+    Other processes return None.
+
+    If callback is not None, proc0_world calls it as callback(x, f,
+    success, group) for every evaluation, as in fd_jac_mpi().
+
+    As with fd_jac_mpi, either all procs call this function, or the
+    worker loop has already been started and only the group leaders
+    call it.
+    """
+    apart_at_start = mpi.is_apart
+    if not apart_at_start:
+        mpi.worker_loop(lambda mpi2, data: mpi_workers_task(mpi2, dofs, data))
+    if not mpi.proc0_groups:
+        return
+
+    # Only group leaders execute this next section.
+    with timer.section('MPI communication'):
+        xs = mpi.comm_leaders.bcast(xs, root=0)
+    nevals = xs.shape[1]
+    owners = mpi.schedule(nevals)
+    logger.info('Evaluating %d points in parallel', nevals)
+
+    evals, failed = _evaluate_points(dofs, mpi, xs, owners)
+
+    if not apart_at_start:
+        mpi.stop_workers()
+
+    if not mpi.proc0_world:
+        return None
+
+    failed = failed > 0
+    if callback is not None:
+        for j in range(nevals):
+            callback(xs[:, j], evals[:, j], not failed[j], owners[j])
+    return evals, failed
+
+
+def _log_if_slow(mpi, start):
+    """
+    Log a warning if an evaluation by proc0_world's group, which started
+    at time start, took longer than mpi.eval_timeout. Such an evaluation
+    cannot be given to another group, and its result is still valid, so
+    it is kept.
+    """
+    elapsed = time.time() - start
+    if mpi.eval_timeout is not None and elapsed > mpi.eval_timeout:
+        logger.warning('Evaluation on proc0_world took %.3g s, longer than '
+                       'eval_timeout = %s s', elapsed, mpi.eval_timeout)
+
+
 def _f_proc0(x, prob, mpi):
     """
     This function is used for least_squares_mpi_solve.  It is similar
@@ -194,12 +561,16 @@ def _f_proc0(x, prob, mpi):
     """
     mpi.mobilize_workers(CALCULATE_F)
     # Send workers the state vector:
-    mpi.comm_groups.bcast(x, root=0)
-    
-    return prob.f(x)
+    with timer.section('MPI communication'):
+        _bcast_x(mpi.comm_groups, x)
 
+    start = time.time()
+    f = prob.f(x)
+    _log_if_slow(mpi, start)
+    return f
 
-def _jac_proc0(x, prob, mpi):
+
+def _jac_proc0(x, prob, mpi, fd_kwargs=None):
     """
     This function is used for least_squares_mpi_solve.  It is similar
     to LeastSquaresProblem.jac, except this version is called only by
@@ -209,7 +580,8 @@ def _jac_proc0(x, prob, mpi):
         # proc0_world calling mobilize_workers will mobilize only group 0.
         mpi.mobilize_workers(CALCULATE_JAC)
         # Send workers the state vector:
-        mpi.comm_groups.bcast(x, root=0)
+        with timer.section('MPI communication'):
+            _bcast_x(mpi.comm_groups, x)
         
         return prob.jac(x)
     
@@ -217,12 +589,19 @@ def _jac_proc0(x, prob, mpi):
         # Evaluate Jacobian using fd_jac_mpi
         mpi.mobilize_leaders(CALCULATE_FD_JAC)
         # Send leaders the state vector:
-        mpi.comm_leaders.bcast(x, root=0)
+        with timer.section('MPI communication'):
+            _bcast_x(mpi.comm_leaders, x)
 
-        return prob.scale_dofs_jac(fd_jac_mpi(prob.dofs, mpi, x))
+        jmat = fd_jac_mpi(prob.dofs, mpi, x, fail=prob.fail,
+                          callback=prob.record_dofs_f, **(fd_kwargs or {}))
+        events.emit('jacobian', x=x, grad_avail=False)
+        return prob.scale_dofs_jac(jmat)
 
 
-def least_squares_mpi_solve(prob, mpi, grad=None):
+def least_squares_mpi_solve(prob, mpi, grad=None, checkpoint_file=None,
+                            checkpoint_interval=1, history_file=None,
+                            broyden=False, broyden_max_updates=10,
+                            fd_kwargs=None):
     """
     Solve a nonlinear-least-squares minimization problem using
     MPI. All MPI processes (including group leaders and workers)
@@ -231,16 +610,47 @@ def least_squares_mpi_solve(prob, mpi, grad=None):
     prob should be an instance of LeastSquaresProblem.
 
     mpi should be an instance of MpiPartition.
+
+    The bound constraints given by the mins and maxs attributes of the
+    optimizable objects are respected, both by the optimizer and by the
+    finite-difference Jacobian.
+
+    If checkpoint_file is given, proc0_world saves the progress to this
+    file and to checkpoint_file + '.history', flushing to disk after
+    every checkpoint_interval evaluations. See Checkpoint. If the files
+    already exist, the optimization resumes from the best point in
+    them, and points in their history are not evaluated again.
+
+    If history_file is given, proc0_world appends a record of every
+    function evaluation to this file. See EvaluationHistory.
+
+    If broyden is True, a full Jacobian (analytic, or by parallel
+    finite differences if no gradient is available) is computed only
+    at the first iteration, after broyden_max_updates iterations, or
+    when progress stalls. At other iterations, the previous Jacobian
+    is corrected with a rank-one Broyden update. See BroydenJacobian.
+
+    fd_kwargs is a dict of arguments for fd_jac_mpi(), such as eps,
+    rel_eps or stencil, to control the finite-difference steps.
+
+    If timing is switched on (see the timer module), the times from all
+    processes are combined at the end, and proc0_world logs a summary
+    table.
     """
+    # scipy.optimize is imported here rather than at the top of the
+    # module to keep "import simsopt" fast:
+    from scipy.optimize import least_squares
     logger.info("Beginning solve.")
     prob._init()
     if grad is None:
         grad = prob.dofs.grad_avail
 
     x = np.copy(prob.x) # For use in Bcast later.
+    # Every process checks the bounds, so they all raise together:
+    bounds = _least_squares_bounds(prob)
 
     # Send group leaders and workers into their respective loops:
-    leaders_action = lambda mpi2, data: mpi_leaders_task(mpi, prob.dofs, data)
+    leaders_action = lambda mpi2, data: mpi_leaders_task(mpi, prob.dofs, data, fd_kwargs)
     workers_action = lambda mpi2, data: mpi_workers_task(mpi, prob.dofs, data)
     mpi.apart(leaders_action, workers_action)
 
@@ -248,28 +658,189 @@ def least_squares_mpi_solve(prob, mpi, grad=None):
         # proc0_world does this block, running the optimization.
         x0 = np.copy(prob.dofs.x)
         #print("x0:",x0)
+        fun = _f_proc0
+        jac = lambda x, prob, mpi: _jac_proc0(x, prob, mpi, fd_kwargs)
+        if checkpoint_file is not None:
+            checkpoint = Checkpoint(checkpoint_file, prob.dofs.nparams,
+                                    interval=checkpoint_interval)
+            if checkpoint.best_x is not None:
+                logger.info("Resuming from checkpoint.")
+                x0 = np.copy(checkpoint.best_x)
+            fun = checkpoint.wrap_fun(fun)
+            jac = checkpoint.wrap_jac(jac)
+        if history_file is not None:
+            prob.history = EvaluationHistory(history_file, prob.dofs.nparams)
+        if broyden:
+            updater = BroydenJacobian(max_updates=broyden_max_updates)
+            fun = updater.wrap_fun(fun)
+            jac = updater.wrap_jac(jac)
+
         # Call scipy.optimize:
-        if grad:
+        if grad or broyden:
             logger.info("Using derivatives")
             print("Using derivatives")
-            result = least_squares(_f_proc0, x0, verbose=2, jac=_jac_proc0, args=(prob, mpi))
+            with timer.section('scipy.least_squares'):
+                result = least_squares(fun, x0, verbose=2, jac=jac,
+                                       bounds=bounds, args=(prob, mpi))
         else:
             logger.info("Using derivative-free method")
             print("Using derivative-free method")
-            result = least_squares(_f_proc0, x0, verbose=2, args=(prob, mpi))
-
+            with timer.section('scipy.least_squares'):
+                result = least_squares(fun, x0, verbose=2, bounds=bounds,
+                                       args=(prob, mpi))
+
+        if checkpoint_file is not None:
+            checkpoint.write()
+        if history_file is not None:
+            prob.history.flush()
+            prob.history = None
+        if broyden:
+            logger.info("Full Jacobians: %d, Broyden updates: %d",
+                        updater.nfull, updater.nbroyden)
         logger.info("Completed solve.")
         x = result.x
         
     # Stop loops for workers and group leaders:
     mpi.together()
 
+    if timer.enabled():
+        stats = timer.gather(mpi)
+        if mpi.proc0_world:
+            logger.info('Timing summary:\n%s', timer.summary(stats))
+
     # Finally, make sure all procs get the optimal state vector.
     mpi.comm_world.Bcast(x)
-    logger.debug('After Bcast, x={}'.format(x))
+    logger.debug('After Bcast, x=%s', x)
     #print("optimum x:",result.x)
     #print("optimum residuals:",result.fun)
     #print("optimum cost function:",result.cost)
     # Set Parameters to their values for the optimum
     prob.dofs.set(x)
 
+
+def _objective_proc0(x, prob, mpi):
+    """
+    This function is used for mpi_solve. It is similar to
+    OptimizationProblem.objective, except this version is called only
+    by proc 0 while workers are in the worker loop.
+    """
+    mpi.mobilize_workers(CALCULATE_F)
+    # Send workers the state vector:
+    with timer.section('MPI communication'):
+        _bcast_x(mpi.comm_groups, x)
+
+    start = time.time()
+    objective = prob.objective(x)
+    _log_if_slow(mpi, start)
+    return objective
+
+
+def _grad_proc0(x, prob, mpi, analytic, fd_kwargs=None):
+    """
+    This function is used for mpi_solve. It is similar to
+    OptimizationProblem.grad, except this version is called only by
+    proc 0 while workers are in the worker loop. Finite-difference
+    gradients are computed in parallel by fd_jac_mpi.
+    """
+    if analytic:
+        # proc0_world calling mobilize_workers will mobilize only group 0.
+        mpi.mobilize_workers(CALCULATE_JAC)
+        # Send workers the state vector:
+        with timer.section('MPI communication'):
+            _bcast_x(mpi.comm_groups, x)
+
+        return prob.grad(x, analytic=True)
+
+    else:
+        # Evaluate the Jacobian of the functions using fd_jac_mpi
+        mpi.mobilize_leaders(CALCULATE_FD_JAC)
+        # Send leaders the state vector:
+        with timer.section('MPI communication'):
+            _bcast_x(mpi.comm_leaders, x)
+
+        jmat = fd_jac_mpi(prob.dofs, mpi, x, fail=prob.fail,
+                          callback=prob.record_dofs_f, **(fd_kwargs or {}))
+        events.emit('jacobian', x=x, grad_avail=False)
+        return prob.scale_dofs_jac(jmat)
+
+
+def mpi_solve(prob, mpi, grad=None, method='L-BFGS-B', history_file=None,
+              fd_kwargs=None, **kwargs):
+    """
+    Solve a general minimization problem using scipy.optimize.minimize
+    and MPI. All MPI processes (including group leaders and workers)
+    should call this function.
+
+    prob should be an instance of OptimizationProblem.
+
+    mpi should be an instance of MpiPartition.
+
+    The gradient is always supplied to scipy. If grad is False, or if
+    any function lacks analytic derivatives, the gradient is computed
+    by finite differences with the evaluations shared among the
+    worker groups, using fd_jac_mpi().
+
+    The bound constraints given by the mins and maxs attributes of the
+    optimizable objects are passed to scipy, unless a "bounds"
+    argument is supplied in kwargs. The default method, L-BFGS-B, and
+    trust-constr both support bounds.
+
+    If history_file is given, proc0_world appends a record of every
+    function evaluation to this file. See EvaluationHistory.
+
+    fd_kwargs is a dict of arguments for fd_jac_mpi(), such as eps,
+    rel_eps or stencil, to control the finite-difference steps.
+
+    kwargs allows you to pass any arguments to scipy.optimize.minimize.
+    They are only used on proc0_world.
+    """
+    # scipy.optimize is imported here rather than at the top of the
+    # module to keep "import simsopt" fast:
+    from scipy.optimize import minimize
+    logger.info("Beginning solve.")
+    prob._init()
+    if grad is None:
+        grad = prob.dofs.grad_avail
+    analytic = bool(grad) and prob.dofs.grad_avail
+
+    x = np.copy(prob.x) # For use in Bcast later.
+
+    # Send group leaders and workers into their respective loops:
+    leaders_action = lambda mpi2, data: mpi_leaders_task(mpi, prob.dofs, data, fd_kwargs)
+    workers_action = lambda mpi2, data: mpi_workers_task(mpi, prob.dofs, data)
+    mpi.apart(leaders_action, workers_action)
+
+    if mpi.proc0_world:
+        # proc0_world does this block, running the optimization.
+        x0 = np.copy(prob.dofs.x)
+        kwargs.setdefault('bounds', _minimize_bounds(prob))
+        if history_file is not None:
+            prob.history = EvaluationHistory(history_file, prob.dofs.nparams)
+
+        logger.info("Using method %s with %s gradients", method,
+                    'analytic' if analytic else 'finite-difference')
+        with timer.section('scipy.minimize'):
+            result = minimize(_objective_proc0, x0, args=(prob, mpi),
+                              method=method,
+                              jac=lambda x, prob, mpi: _grad_proc0(x, prob, mpi, analytic, fd_kwargs),
+                              **kwargs)
+
+        if history_file is not None:
+            prob.history.flush()
+            prob.history = None
+        logger.info("Completed solve: %s", result.message)
+        x = result.x
+
+    # Stop loops for workers and group leaders:
+    mpi.together()
+
+    if timer.enabled():
+        stats = timer.gather(mpi)
+        if mpi.proc0_world:
+            logger.info('Timing summary:\n%s', timer.summary(stats))
+
+    # Finally, make sure all procs get the optimal state vector.
+    mpi.comm_world.Bcast(x)
+    logger.debug('After Bcast, x=%s', x)
+    # Set Parameters to their values for the optimum
+    prob.dofs.set(x)
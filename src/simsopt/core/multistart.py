@@ -0,0 +1,123 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides multistart_mpi_solve, which runs independent
+optimizations from many starting points in a single MPI job, by
+dividing the processes into super-groups that each run their own
+solves.
+"""
+
+import numpy as np
+import logging
+from mpi4py import MPI
+from .mpi import MpiHierarchy
+from .mpi_solve import least_squares_mpi_solve
+from .util import ObjectiveFailure
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+
+def uniform_sampler(mins, maxs, seed=0):
+    """
+    Return a function of the start index j that gives a point drawn
+    uniformly from the box between mins and maxs. The point depends
+    only on seed and j, so every process obtains the same point.
+    """
+    mins = np.array(mins, dtype=float)
+    maxs = np.array(maxs, dtype=float)
+
+    def sampler(j):
+        rng = np.random.default_rng([seed, j])
+        return rng.uniform(mins, maxs)
+    return sampler
+
+
+def multistart_mpi_solve(make_prob, starts, nstarts=None, nsupergroups=None,
+                         ngroups=None, solver=least_squares_mpi_solve,
+                         comm_world=MPI.COMM_WORLD, **kwargs):
+    """
+    Solve an optimization problem from several starting points. The
+    processes of comm_world are divided into nsupergroups super-groups
+    of consecutive ranks, each with its own MpiPartition of ngroups
+    groups, using an MpiHierarchy. The starting points are distributed among the super-groups
+    in turn, and each super-group solves from its points one after
+    another. All processes should call this function.
+
+    make_prob(mpi) is called once on every process of each
+    super-group, with the MpiPartition of the super-group, and should
+    return the problem, e.g. a LeastSquaresProblem. Objects that need
+    a communicator, such as Vmec, should be created here using mpi,
+    so each super-group creates them only once.
+
+    starts is either a 2D array with one starting point per row, or a
+    function of the start index j returning the starting point, such
+    as the one returned by uniform_sampler(). In the latter case,
+    nstarts must be given.
+
+    solver is called as solver(prob, mpi, **kwargs), and can be
+    least_squares_mpi_solve (the default) or mpi_solve.
+
+    The return value, on every process, is a list with one dict per
+    start, sorted by the final objective. Each dict has the keys
+    'start', 'x0', 'x', 'objective' and 'supergroup'. A start whose
+    final objective cannot be evaluated has objective inf. The dofs of
+    the problem on every process are set to the best x.
+    """
+    if callable(starts):
+        if nstarts is None:
+            raise ValueError('nstarts must be given if starts is a function')
+        sampler = starts
+    else:
+        starts = np.array(starts, dtype=float)
+        nstarts = len(starts)
+        sampler = lambda j: starts[j]
+
+    if nsupergroups is None:
+        nsupergroups = min(nstarts, comm_world.Get_size())
+    # Level 0 holds the super-groups, and level 1 the groups within
+    # each super-group:
+    hierarchy = MpiHierarchy([nsupergroups, ngroups], comm_world=comm_world)
+    nsupergroups = hierarchy.ngroups[0]
+    supergroup = hierarchy.groups[0]
+    mpi = hierarchy[1]
+    logger.info('Super-group %d of %d has %d processes', supergroup,
+                nsupergroups, mpi.nprocs_world)
+
+    prob = make_prob(mpi)
+
+    results = []
+    for j in range(supergroup, nstarts, nsupergroups):
+        x0 = np.array(sampler(j), dtype=float)
+        logger.info('Super-group %d beginning start %d', supergroup, j)
+        prob.x = x0
+        solver(prob, mpi, **kwargs)
+        x = np.copy(prob.x)
+        # Only the group of proc0_world evaluates the final objective,
+        # with its workers, so functions that communicate within groups
+        # work. The result is then sent to the rest of the super-group:
+        objective = None
+        if mpi.comm_groups.bcast(mpi.proc0_world, root=0):
+            try:
+                objective = prob.objective()
+            except ObjectiveFailure:
+                objective = np.inf
+        objective = mpi.comm_world.bcast(objective, root=0)
+        results.append({'start': j, 'x0': x0, 'x': x,
+                        'objective': float(objective),
+                        'supergroup': supergroup})
+
+    # Collect the results of every super-group:
+    if not mpi.proc0_world:
+        results = []
+    all_results = comm_world.allgather(results)
+    results = sorted((r for sublist in all_results for r in sublist),
+                     key=lambda r: (r['objective'], r['start']))
+
+    if hierarchy.proc0_world:
+        for r in results:
+            logger.info('Start %d (super-group %d): objective %s',
+                        r['start'], r['supergroup'], r['objective'])
+    prob.x = results[0]['x']
+    return results
@@ -14,10 +14,71 @@ from mpi4py import MPI
 
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
 
+def versioned(set_dofs):
+    """
+    Wrap a set_dofs method so that the version counter of the object is
+    incremented whenever the call actually changes the dofs, as
+    reported by get_dofs().
+    """
+    if getattr(set_dofs, 'versioned', False):
+        return set_dofs
+
+    def wrapper(self, x):
+        try:
+            old = np.array(self.get_dofs(), copy=True)
+        except NotImplementedError:
+            old = None
+        set_dofs(self, x)
+        new = np.asarray(self.get_dofs())
+        if old is None or old.shape != new.shape or np.any(old != new):
+            self.dofs_changed()
+
+    wrapper.__name__ = set_dofs.__name__
+    wrapper.__doc__ = set_dofs.__doc__
+    wrapper.versioned = True
+    return wrapper
+
 class Optimizable():
     """
     This base class provides some useful features for optimizable functions.
+
+    Each object carries a version counter, which is incremented every
+    time its dofs change. Objects that cache results computed from
+    their own dofs or from the dofs of the objects they depend on can
+    store the combined version (see combined_version() in dofs.py) at
+    the time of the computation, and recompute only when it differs.
+    Replacing one of the objects listed in depends_on by a different
+    object also counts as a change of the dofs, since the new object
+    may have the same version counter as the old one.
     """
+    def __init_subclass__(cls, **kwargs):
+        # Make every set_dofs defined in a subclass update the version
+        # counter:
+        super().__init_subclass__(**kwargs)
+        if 'set_dofs' in cls.__dict__:
+            cls.set_dofs = versioned(cls.__dict__['set_dofs'])
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__.get('depends_on', ()) \
+           and self.__dict__.get(name, value) is not value:
+            self.dofs_changed()
+        super().__setattr__(name, value)
+
+    @property
+    def version(self):
+        """
+        Number of times the dofs of this object have changed.
+        """
+        return getattr(self, '_version', 0)
+
+    def dofs_changed(self):
+        """
+        Increment the version counter. set_dofs() does this
+        automatically, but methods that change the dofs in other ways,
+        such as set_rc() for surfaces, should call this method.
+        """
+        self._version = getattr(self, '_version', 0) + 1
+
     def get_dofs(self):
         raise NotImplementedError
     
@@ -124,6 +185,10 @@ def optimizable(obj):
         obj.get_dofs = types.MethodType(get_dofs, obj)
     if not hasattr(obj, 'set_dofs'):
         obj.set_dofs = types.MethodType(set_dofs, obj)
+    elif not getattr(obj.set_dofs, 'versioned', False) \
+         and hasattr(obj.set_dofs, '__func__'):
+        # Make set_dofs update the version counter of the object:
+        obj.set_dofs = types.MethodType(versioned(obj.set_dofs.__func__), obj)
             
     n = len(obj.get_dofs())
     if not hasattr(obj, 'fixed'):
@@ -133,7 +198,8 @@ def optimizable(obj):
     if not hasattr(obj, 'maxs'):
         obj.maxs = np.full(n, np.Inf)
     # Add the following methods from the Optimizable class:
-    for method in ['index', 'get', 'set', 'get_fixed', 'set_fixed', 'all_fixed']:
+    for method in ['index', 'get', 'set', 'get_fixed', 'set_fixed', 'all_fixed',
+                   'dofs_changed']:
         # See https://stackoverflow.com/questions/972/adding-a-method-to-an-existing-object-instance
         setattr(obj, method, types.MethodType(getattr(Optimizable, method), obj))
 
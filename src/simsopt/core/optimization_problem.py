@@ -0,0 +1,206 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides the OptimizationProblem class, for minimizing a
+general scalar objective function that is not necessarily a sum of
+squares.
+"""
+
+import numpy as np
+import logging
+import warnings
+
+from mpi4py import MPI
+from . import events
+from . import timer
+from .dofs import Dofs
+from .util import isnumber, ObjectiveFailure
+from .optimizable import function_from_user, Target
+
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+
+class OptimizationProblem:
+    """
+    This class represents a general optimization problem, in which the
+    objective function is a weighted sum of terms,
+
+    objective = sum_j weight_j * f_j,
+
+    where each f_j is a scalar function (or a function returning a 1D
+    array, in which case its elements are summed). Unlike in a
+    LeastSquaresProblem, the terms are not squared, so any kind of
+    penalty can be used.
+    """
+
+    def __init__(self, terms, fail=1.0e12):
+        """
+        The argument "terms" must be convertable to a list by the list()
+        subroutine. Each entry of the resulting list must either be a
+        function or an object with a J() function, in which case its
+        weight is 1, or else a list or tuple of the form (function,
+        weight) or (object, attribute_str, weight).
+
+        fail is the value given to every function when an evaluation
+        raises ObjectiveFailure, e.g. if VMEC does not converge.
+        """
+        self.funcs = []
+        self.weights = []
+        msg = 'Each term must be either (1) a function or an object with a ' \
+              'J() function, or (2) a list or tuple of the form (function, ' \
+              'weight) or (object, attribute_str, weight)'
+        for term in terms:
+            if isinstance(term, (list, tuple)):
+                if len(term) == 3:
+                    func = Target(*term[:2])
+                elif len(term) == 2:
+                    func = term[0]
+                else:
+                    raise ValueError(msg)
+                weight = term[-1]
+            else:
+                func = term
+                weight = 1.0
+            if not isnumber(weight):
+                raise TypeError('Weight must be a float or int')
+            self.funcs.append(function_from_user(func))
+            self.weights.append(float(weight))
+
+        if not len(self.funcs):
+            raise ValueError("At least 1 term must be given as argument")
+
+        self.fail = fail
+        self.nfailures = 0
+        # If history is set to an EvaluationHistory, every function
+        # evaluation is recorded in it:
+        self.history = None
+        self._init()
+
+    def _init(self):
+        """
+        Collect the dofs of the functions. This is done both when the
+        object is created, so 'objective' works immediately, and also
+        at the start of solve().
+        """
+        self.dofs = Dofs(self.funcs)
+
+    @property
+    def x(self):
+        """
+        Return the state vector.
+        """
+        # Delegate to Dofs:
+        return self.dofs.x
+
+    @x.setter
+    def x(self, x):
+        """
+        Sets the global state vector to x.
+        """
+        # Delegate to Dofs:
+        if x is not None:
+            self.dofs.set(x)
+        else:
+            warnings.warn("Supplied a null object as state vector. Ignoring it")
+
+    def row_weights(self):
+        """
+        Return the weight of each element of the vector returned by
+        Dofs.f().
+        """
+        return np.repeat(self.weights, self.dofs.nvals_per_func)
+
+    def combine(self, f_unscaled):
+        """
+        Given the vector of function values returned by Dofs.f(), return
+        the weighted sum that forms the objective function.
+        """
+        return float(np.dot(self.row_weights(), f_unscaled))
+
+    def objective(self, x=None):
+        """
+        Return the value of the objective function for a given state
+        vector x. This function is passed to scipy.optimize.
+
+        If the argument x is not supplied, the objective will be
+        evaluated for the present state vector. If x is supplied, then
+        first set_dofs() will be called for each object to set the
+        global state vector to x.
+        """
+        logger.debug("objective() called with x=%s", x)
+        self.x = x
+
+        # Importantly for MPI, the next line calls the functions in
+        # the same order that Dofs.f() does. Proc0 calls this function
+        # whereas worker procs call Dofs.f().
+        try:
+            f_unscaled = self.dofs.f()
+        except ObjectiveFailure as err:
+            self.nfailures += 1
+            logger.warning('Function evaluation failed: %s', err)
+            if self.dofs.nvals is not None:
+                self.record_dofs_f(self.x, np.full(self.dofs.nvals, self.fail),
+                                   success=False)
+            return self.fail
+
+        self.record_dofs_f(self.x, f_unscaled)
+        return self.combine(f_unscaled)
+
+    def record_dofs_f(self, x, f_unscaled, success=True, group=0):
+        """
+        Add a function evaluation to the history, if there is one, and
+        to the event channel, if it is switched on. This method can be
+        passed as the callback argument of Dofs.fd_jac() and
+        fd_jac_mpi().
+        """
+        if self.history is None and not events.enabled():
+            return
+        objective = self.combine(f_unscaled) if success else self.fail
+        if self.history is not None:
+            self.history.record(x, f_unscaled, objective,
+                                group=group, success=success)
+        events.emit('evaluation', x=x, objective=objective, success=success,
+                    group=group)
+
+    @timer.timed('Jacobian assembly')
+    def scale_dofs_jac(self, jmat):
+        """
+        Given a Jacobian matrix jmat for the Dofs() associated to this
+        problem, return the gradient of the objective function.
+        """
+        return self.row_weights() @ jmat
+
+    def grad(self, x=None, analytic=None, **kwargs):
+        """
+        Return the gradient of the objective function with respect to
+        the parameters for a given state vector x. This function is
+        passed to scipy.optimize.
+
+        If analytic is None, analytic derivatives are used if all the
+        functions provide them, and finite differences are used
+        otherwise. If analytic is False, finite differences are always
+        used.
+
+        kwargs is passed to Dofs.fd_jac().
+        """
+        logger.debug("grad() called with x=%s", x)
+        self.x = x
+
+        if analytic is None:
+            analytic = self.dofs.grad_avail
+        if analytic:
+            logger.debug('Calling analytic Jacobian')
+            jmat = self.dofs.jac()
+        else:
+            logger.debug('Calling finite_difference Jacobian')
+            kwargs.setdefault('fail', self.fail)
+            kwargs.setdefault('callback', self.record_dofs_f)
+            jmat = self.dofs.fd_jac(**kwargs)
+
+        if events.enabled():
+            events.emit('jacobian', x=self.dofs.x, grad_avail=analytic)
+
+        return self.scale_dofs_jac(jmat)
@@ -0,0 +1,290 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides derivative-free global optimizers based on a
+population of points, differential_evolution_mpi_solve and
+cmaes_mpi_solve. All points of a generation are evaluated at once,
+shared among the worker groups of an MpiPartition, so the number of
+groups that can be kept busy is set by the population size rather
+than by the number of parameters.
+"""
+
+import numpy as np
+import logging
+from mpi4py import MPI
+from . import timer
+from .least_squares_problem import LeastSquaresProblem
+from .history import EvaluationHistory
+from .mpi_solve import mpi_leaders_task, mpi_workers_task, evaluate_mpi, \
+    CALCULATE_POPULATION
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+
+def objective_from_dofs_f(prob, f_unscaled):
+    """
+    Given the vector of function values returned by Dofs.f() for a
+    LeastSquaresProblem or an OptimizationProblem, return the value of
+    the objective function.
+    """
+    if isinstance(prob, LeastSquaresProblem):
+        residuals = prob.residuals(f_unscaled)
+        return float(np.dot(residuals, residuals))
+    return prob.combine(f_unscaled)
+
+
+def _population_objectives(prob, mpi, xs):
+    """
+    Evaluate the objective function at each row of xs, in parallel.
+    This function is called only by proc0_world while the group
+    leaders and workers are in their loops.
+    """
+    xs = np.array(xs, dtype=float)
+    mpi.mobilize_leaders(CALCULATE_POPULATION)
+    evals, failed = evaluate_mpi(prob.dofs, mpi, xs.T,
+                                 callback=prob.record_dofs_f)
+    objectives = np.zeros(len(xs))
+    for j in range(len(xs)):
+        if failed[j]:
+            prob.nfailures += 1
+            if isinstance(prob, LeastSquaresProblem):
+                objectives[j] = prob.dofs.nvals * prob.fail * prob.fail
+            else:
+                objectives[j] = prob.fail
+        else:
+            objectives[j] = objective_from_dofs_f(prob, evals[:, j])
+    return objectives
+
+
+def _finite_bounds(prob):
+    """
+    Return the bounds of the dofs of prob, raising ValueError if any is
+    infinite.
+    """
+    mins = prob.dofs.mins
+    maxs = prob.dofs.maxs
+    if not (np.all(np.isfinite(mins)) and np.all(np.isfinite(maxs))):
+        raise ValueError('Finite mins and maxs must be set for every dof')
+    return mins, maxs
+
+
+def _population_solve(prob, mpi, run, history_file=None):
+    """
+    Send the group leaders and workers into their loops, let
+    proc0_world call run(evaluate), where evaluate(xs) returns the
+    objective at each row of xs, and finally set the dofs on all
+    procs to the x returned by run.
+    """
+    logger.info("Beginning solve.")
+    prob._init()
+    x = np.copy(prob.x) # For use in Bcast later.
+
+    # Send group leaders and workers into their respective loops:
+    leaders_action = lambda mpi2, data: mpi_leaders_task(mpi, prob.dofs, data)
+    workers_action = lambda mpi2, data: mpi_workers_task(mpi, prob.dofs, data)
+    mpi.apart(leaders_action, workers_action)
+
+    if mpi.proc0_world:
+        if history_file is not None:
+            prob.history = EvaluationHistory(history_file, prob.dofs.nparams)
+        x = run(lambda xs: _population_objectives(prob, mpi, xs))
+        if history_file is not None:
+            prob.history.flush()
+            prob.history = None
+        logger.info("Completed solve.")
+
+    # Stop loops for workers and group leaders:
+    mpi.together()
+
+    if timer.enabled():
+        stats = timer.gather(mpi)
+        if mpi.proc0_world:
+            logger.info('Timing summary:\n%s', timer.summary(stats))
+
+    # Finally, make sure all procs get the optimal state vector.
+    x = np.array(x, dtype=float)
+    mpi.comm_world.Bcast(x)
+    logger.debug('After Bcast, x=%s', x)
+    prob.dofs.set(x)
+
+
+def differential_evolution_mpi_solve(prob, mpi, history_file=None, **kwargs):
+    """
+    Minimize the objective of prob, a LeastSquaresProblem or an
+    OptimizationProblem, using scipy.optimize.differential_evolution,
+    with each generation evaluated in parallel across the groups of
+    mpi. All MPI processes should call this function.
+
+    Finite mins and maxs are required for every dof, and define the
+    search region.
+
+    If history_file is given, proc0_world appends a record of every
+    function evaluation to this file. See EvaluationHistory.
+
+    kwargs allows you to pass any other arguments to
+    differential_evolution, such as popsize, maxiter, tol, or seed.
+    They are only used on proc0_world. The final local polish is
+    switched off by default.
+    """
+    # scipy.optimize is imported here rather than at the top of the
+    # module to keep "import simsopt" fast:
+    from scipy.optimize import differential_evolution
+
+    # Check the bounds on all procs, before the workers are sent into
+    # their loop:
+    prob._init()
+    mins, maxs = _finite_bounds(prob)
+
+    def run(evaluate):
+        kwargs.setdefault('polish', False)
+        # All members of a generation must be evaluated together:
+        kwargs['updating'] = 'deferred'
+        kwargs['workers'] = lambda func, xs: evaluate(list(xs))
+        with timer.section('scipy.differential_evolution'):
+            result = differential_evolution(lambda x: evaluate([x])[0],
+                                            list(zip(mins, maxs)), **kwargs)
+        logger.info('differential_evolution: %s', result.message)
+        return result.x
+
+    _population_solve(prob, mpi, run, history_file=history_file)
+
+
+class CMAES:
+    """
+    This class implements the covariance matrix adaptation evolution
+    strategy (CMA-ES) of Hansen, in its standard (mu/mu_w, lambda)
+    form, through an ask/tell interface: ask() returns the points of
+    the next generation, and tell() updates the search distribution
+    from their objective values.
+
+    Points are clipped to the bounds mins and maxs, if given.
+    """
+    def __init__(self, x0, sigma0, popsize=None, mins=None, maxs=None, seed=None):
+        x0 = np.array(x0, dtype=float)
+        n = len(x0)
+        self.n = n
+        self.mean = x0
+        self.sigma = float(sigma0)
+        self.mins = mins
+        self.maxs = maxs
+        self.rng = np.random.default_rng(seed)
+        if popsize is None:
+            popsize = 4 + int(3 * np.log(n))
+        self.popsize = popsize
+        self.mu = popsize // 2
+        weights = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / np.sum(weights)
+        mueff = 1.0 / np.sum(self.weights ** 2)
+        self.mueff = mueff
+
+        # Learning rates:
+        self.cc = (4 + mueff / n) / (n + 4 + 2 * mueff / n)
+        self.cs = (mueff + 2) / (n + mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + mueff)
+        self.cmu = min(1 - self.c1, 2 * (mueff - 2 + 1 / mueff) / ((n + 2) ** 2 + mueff))
+        self.damps = 1 + 2 * max(0, np.sqrt((mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chin = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n * n))
+
+        # Evolution paths and covariance matrix C = B D^2 B^T:
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.B = np.eye(n)
+        self.D = np.ones(n)
+        self.C = np.eye(n)
+        self.generation = 0
+
+    def ask(self):
+        """
+        Return a (popsize, n) array with the points of the next
+        generation.
+        """
+        z = self.rng.standard_normal((self.popsize, self.n))
+        xs = self.mean + self.sigma * (z * self.D) @ self.B.T
+        if self.mins is not None:
+            xs = np.maximum(xs, self.mins)
+        if self.maxs is not None:
+            xs = np.minimum(xs, self.maxs)
+        return xs
+
+    def tell(self, xs, objectives):
+        """
+        Update the mean, step size and covariance matrix from the points
+        xs returned by ask() and their objective values.
+        """
+        n = self.n
+        order = np.argsort(objectives)[:self.mu]
+        old_mean = self.mean
+        y = (xs[order] - old_mean) / self.sigma
+        yw = self.weights @ y
+        self.mean = old_mean + self.sigma * yw
+        self.generation += 1
+
+        # Step-size path, using C^(-1/2) = B D^-1 B^T:
+        invsqrt_yw = self.B @ ((self.B.T @ yw) / self.D)
+        self.ps = (1 - self.cs) * self.ps \
+            + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * invsqrt_yw
+        norm_ps = np.linalg.norm(self.ps)
+        hsig = norm_ps / np.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) / self.chin \
+            < 1.4 + 2 / (n + 1)
+        # Covariance path:
+        self.pc = (1 - self.cc) * self.pc \
+            + hsig * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * yw
+        # Rank-one and rank-mu updates of the covariance matrix:
+        self.C = (1 - self.c1 - self.cmu) * self.C \
+            + self.c1 * (np.outer(self.pc, self.pc)
+                         + (1 - hsig) * self.cc * (2 - self.cc) * self.C) \
+            + self.cmu * (y.T * self.weights) @ y
+        self.sigma *= np.exp((self.cs / self.damps) * (norm_ps / self.chin - 1))
+
+        # Update B and D from C:
+        self.C = np.triu(self.C) + np.triu(self.C, 1).T
+        D2, self.B = np.linalg.eigh(self.C)
+        self.D = np.sqrt(np.maximum(D2, 1e-300))
+
+
+def cmaes_mpi_solve(prob, mpi, sigma0=0.1, popsize=None, maxiter=100,
+                    ftol=1e-11, xtol=1e-11, seed=None, history_file=None):
+    """
+    Minimize the objective of prob, a LeastSquaresProblem or an
+    OptimizationProblem, using CMA-ES, with each generation evaluated
+    in parallel across the groups of mpi. All MPI processes should
+    call this function.
+
+    The search starts from the present state vector with step size
+    sigma0. Points are clipped to any finite mins and maxs of the
+    dofs. popsize is the number of points per generation, and is
+    best chosen as a multiple of the number of groups. The iteration
+    stops after maxiter generations, when the objective values of a
+    generation differ by less than ftol, or when the step size falls
+    below xtol.
+
+    If history_file is given, proc0_world appends a record of every
+    function evaluation to this file. See EvaluationHistory.
+    """
+
+    def run(evaluate):
+        es = CMAES(prob.x, sigma0, popsize=popsize, mins=prob.dofs.mins,
+                   maxs=prob.dofs.maxs, seed=seed)
+        best_x = np.copy(prob.x)
+        best_objective = np.inf
+        for generation in range(maxiter):
+            xs = es.ask()
+            objectives = evaluate(xs)
+            es.tell(xs, objectives)
+            j = np.argmin(objectives)
+            if objectives[j] < best_objective:
+                best_objective = objectives[j]
+                best_x = np.copy(xs[j])
+            logger.info('CMA-ES generation %d: best objective %s, sigma %s',
+                        generation, best_objective, es.sigma)
+            if np.max(objectives) - np.min(objectives) < ftol:
+                logger.info('CMA-ES stopping since objective range < ftol')
+                break
+            if es.sigma * np.max(es.D) < xtol:
+                logger.info('CMA-ES stopping since step size < xtol')
+                break
+        return best_x
+
+    _population_solve(prob, mpi, run, history_file=history_file)
@@ -3,26 +3,61 @@
 # Distributed under the terms of the LGPL License
 
 """
-This module provides the least_squares_serial_solve
-function. Eventually I can also put a serial_solve function here for
-general optimization problems.
+This module provides the least_squares_serial_solve function, and the
+serial_solve function for general optimization problems.
 """
 
 import numpy as np
-from scipy.optimize import least_squares
 import logging
+from . import timer
+from .checkpoint import Checkpoint
+from .history import EvaluationHistory
+from .broyden import BroydenJacobian
 
 logger = logging.getLogger(__name__)
 
-def least_squares_serial_solve(prob, grad=None, **kwargs):
+def least_squares_serial_solve(prob, grad=None, checkpoint_file=None,
+                               checkpoint_interval=1, history_file=None,
+                               broyden=False, broyden_max_updates=10,
+                               fd_kwargs=None, **kwargs):
     """
     Solve a nonlinear-least-squares minimization problem using
     scipy.optimize, and without using any parallelization.
 
     prob should be a LeastSquaresProblem object.
 
+    The bound constraints given by the mins and maxs attributes of the
+    optimizable objects are passed to scipy, unless a "bounds"
+    argument is supplied in kwargs.
+
+    If checkpoint_file is given, the progress is saved to this file
+    and to checkpoint_file + '.history', flushing to disk after every
+    checkpoint_interval evaluations. See Checkpoint. If the files
+    already exist, the optimization resumes from the best point in
+    them, and points in their history are not evaluated again.
+
+    If history_file is given, a record of every function evaluation,
+    including those for finite-difference derivatives, is appended to
+    this file. See EvaluationHistory.
+
+    If broyden is True, a full Jacobian (analytic, or by finite
+    differences if no gradient is available) is computed only at the
+    first iteration, after broyden_max_updates iterations, or when
+    progress stalls. At other iterations, the previous Jacobian is
+    corrected with a rank-one Broyden update. See BroydenJacobian.
+
+    fd_kwargs is a dict of arguments for Dofs.fd_jac(), such as eps,
+    rel_eps or stencil, used if finite-difference derivatives are
+    needed.
+
+    If timing is switched on (see the timer module), a summary table of
+    the times is logged at the end.
+
     kwargs allows you to pass any arguments to scipy.optimize.least_squares.
     """
+    # scipy.optimize is imported here rather than at the top of the
+    # module to keep "import simsopt" fast:
+    from scipy.optimize import least_squares
     logger.info("Beginning solve.")
     prob._init() # In case 'fixed', 'mins', etc have changed since the problem was created.
     if grad is None:
@@ -31,19 +66,145 @@ def least_squares_serial_solve(prob, grad=None, **kwargs):
     #if not 'verbose' in kwargs:
         
     x0 = np.copy(prob.x)
-    if grad:
+    kwargs.setdefault('bounds', _least_squares_bounds(prob))
+    fun = prob.f
+    jac = lambda x: prob.jac(x, **(fd_kwargs or {}))
+    if checkpoint_file is not None:
+        checkpoint = Checkpoint(checkpoint_file, prob.dofs.nparams,
+                                interval=checkpoint_interval)
+        if checkpoint.best_x is not None:
+            logger.info("Resuming from checkpoint.")
+            x0 = np.copy(checkpoint.best_x)
+        fun = checkpoint.wrap_fun(fun)
+        jac = checkpoint.wrap_jac(jac)
+    if history_file is not None:
+        prob.history = EvaluationHistory(history_file, prob.dofs.nparams)
+    if broyden:
+        updater = BroydenJacobian(max_updates=broyden_max_updates)
+        fun = updater.wrap_fun(fun)
+        jac = updater.wrap_jac(jac)
+
+    if grad or broyden:
         logger.info("Using derivatives")
         print("Using derivatives")
-        result = least_squares(prob.f, x0, verbose=2, jac=prob.jac, **kwargs)
+        with timer.section('scipy.least_squares'):
+            result = least_squares(fun, x0, verbose=2, jac=jac, **kwargs)
     else:
         logger.info("Using derivative-free method")
         print("Using derivative-free method")
-        result = least_squares(prob.f, x0, verbose=2, **kwargs)
+        with timer.section('scipy.least_squares'):
+            result = least_squares(fun, x0, verbose=2, **kwargs)
 
+    if checkpoint_file is not None:
+        checkpoint.write()
+    if history_file is not None:
+        prob.history.flush()
+        prob.history = None
+    if broyden:
+        logger.info("Full Jacobians: %d, Broyden updates: %d",
+                    updater.nfull, updater.nbroyden)
     logger.info("Completed solve.")
+    if timer.enabled():
+        logger.info('Timing summary:\n%s', timer.summary())
 
     #print("optimum x:",result.x)
     #print("optimum residuals:",result.fun)
     #print("optimum cost function:",result.cost)
     # Set Parameters to their values for the optimum
     prob.x = result.x
+
+
+def _least_squares_bounds(prob):
+    """
+    Return the (mins, maxs) bounds of the dofs of prob for
+    scipy.optimize.least_squares, which requires mins < maxs, with the
+    initial state vector in between. A ValueError naming the offending
+    dofs is raised otherwise. In the MPI solver every process calls
+    this function, so they all raise the error together, instead of
+    scipy raising it on proc0_world only.
+    """
+    mins = prob.dofs.mins
+    maxs = prob.dofs.maxs
+    bad = np.nonzero(~(mins < maxs))[0]
+    if len(bad) > 0:
+        raise ValueError('Each dof must have min < max for least_squares. Fix these '
+                         'dofs instead: ' + ', '.join(prob.dofs.names[j] for j in bad))
+    x = prob.dofs.x
+    bad = np.nonzero((x < mins) | (x > maxs))[0]
+    if len(bad) > 0:
+        raise ValueError('The initial values of these dofs are outside their bounds: '
+                         + ', '.join('{} = {} not in [{}, {}]'.format(
+                             prob.dofs.names[j], x[j], mins[j], maxs[j]) for j in bad))
+    return (mins, maxs)
+
+
+def _minimize_bounds(prob):
+    """
+    Return a scipy.optimize.Bounds object for the mins and maxs of the
+    dofs of prob, or None if no dof is bounded.
+    """
+    from scipy.optimize import Bounds
+    mins = prob.dofs.mins
+    maxs = prob.dofs.maxs
+    if np.all(np.isinf(mins)) and np.all(np.isinf(maxs)):
+        return None
+    return Bounds(mins, maxs)
+
+
+def serial_solve(prob, grad=None, method='L-BFGS-B', history_file=None,
+                 fd_kwargs=None, **kwargs):
+    """
+    Solve a general minimization problem using scipy.optimize.minimize,
+    and without using any parallelization.
+
+    prob should be an OptimizationProblem object.
+
+    The gradient is always supplied to scipy. If grad is False, or if
+    any function lacks analytic derivatives, the gradient is computed
+    by finite differences using Dofs.fd_jac().
+
+    The bound constraints given by the mins and maxs attributes of the
+    optimizable objects are passed to scipy, unless a "bounds"
+    argument is supplied in kwargs. The default method, L-BFGS-B, and
+    trust-constr both support bounds.
+
+    If history_file is given, a record of every function evaluation,
+    including those for finite-difference derivatives, is appended to
+    this file. See EvaluationHistory.
+
+    fd_kwargs is a dict of arguments for Dofs.fd_jac(), such as eps,
+    rel_eps or stencil, used for finite-difference gradients.
+
+    kwargs allows you to pass any arguments to scipy.optimize.minimize.
+    """
+    # scipy.optimize is imported here rather than at the top of the
+    # module to keep "import simsopt" fast:
+    from scipy.optimize import minimize
+    logger.info("Beginning solve.")
+    prob._init()
+    if grad is None:
+        grad = prob.dofs.grad_avail
+    analytic = bool(grad) and prob.dofs.grad_avail
+
+    x0 = np.copy(prob.x)
+    kwargs.setdefault('bounds', _minimize_bounds(prob))
+    if history_file is not None:
+        prob.history = EvaluationHistory(history_file, prob.dofs.nparams)
+
+    logger.info("Using method %s with %s gradients", method,
+                'analytic' if analytic else 'finite-difference')
+    with timer.section('scipy.minimize'):
+        result = minimize(prob.objective, x0, method=method,
+                          jac=lambda x: prob.grad(x, analytic=analytic,
+                                                **(fd_kwargs or {})),
+                          **kwargs)
+
+    if history_file is not None:
+        prob.history.flush()
+        prob.history = None
+    logger.info("Completed solve: %s", result.message)
+    if timer.enabled():
+        logger.info('Timing summary:\n%s', timer.summary())
+
+    # Set Parameters to their values for the optimum
+    prob.x = result.x
@@ -6,29 +6,45 @@
 This module provides several classes for representing toroidal
 surfaces.  There is a base class Surface, and several child classes
 corresponding to different discrete representations.
-"""
-
-# These next 2 lines Use double precision:
-from jax.config import config
-config.update("jax_enable_x64", True)
 
-import jax.numpy as jnp
-from jax import jacrev, jit
+jax is only imported when the first area or volume calculation is
+done, so programs that do not use these calculations do not pay the
+cost of importing it.
+"""
 
 import numpy as np
 import logging
 from mpi4py import MPI
 from .util import isbool
+from . import timer
 from .optimizable import Optimizable
 
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
 
+_jnp = None
+_darea_volume_pure = None
+
+def _jax_numpy():
+    """
+    Import jax.numpy on first use, switching on double precision before
+    any jax arrays are created.
+    """
+    global _jnp
+    if _jnp is None:
+        logger.debug('Importing jax')
+        from jax.config import config
+        config.update("jax_enable_x64", True)
+        import jax.numpy
+        _jnp = jax.numpy
+    return _jnp
+
 #@jit(static_argnums=(4, 5, 6, 7, 8, 9))
 def area_volume_pure(rc, rs, zc, zs, stelsym, nfp, mpol, ntor, ntheta, nphi):
     """
     Compute the area and volume of a surface. This pure function is
     designed for automatic differentiation.
     """
+    jnp = _jax_numpy()
     mdim = mpol + 1
     ndim = 2 * ntor + 1
     theta1d = jnp.linspace(0, 2 * jnp.pi, ntheta, endpoint=False)
@@ -102,7 +118,20 @@ def area_volume_pure(rc, rs, zc, zs, stelsym, nfp, mpol, ntor, ntheta, nphi):
 #jit_area_volume_pure = jit(area_volume_pure, static_argnums=(4, 5, 6, 7, 8, 9))
 #jit_area_volume_pure = jit(area_volume_pure, static_argnums=(8, 9))
 jit_area_volume_pure = area_volume_pure
-darea_volume_pure = jacrev(area_volume_pure, argnums=(0, 1, 2, 3))
+
+def darea_volume_pure(rc, rs, zc, zs, stelsym, nfp, mpol, ntor, ntheta, nphi):
+    """
+    Compute the derivatives of the area and volume of a surface with
+    respect to rc, rs, zc, and zs, using automatic differentiation of
+    area_volume_pure. The jax derivative function is built on first
+    use.
+    """
+    global _darea_volume_pure
+    if _darea_volume_pure is None:
+        _jax_numpy()
+        from jax import jacrev
+        _darea_volume_pure = jacrev(area_volume_pure, argnums=(0, 1, 2, 3))
+    return _darea_volume_pure(rc, rs, zc, zs, stelsym, nfp, mpol, ntor, ntheta, nphi)
 
 # Here I have Surface subclass Optimizable, which is convenient while
 # surface.py is part of simsopt instead of being in a separate simsgeo
@@ -163,8 +192,10 @@ class SurfaceRZFourier(Surface):
         self.mpol = mpol
         self.ntor = ntor
         self.allocate()
-        self.recalculate = True
-        self.recalculate_derivs = True
+        # Versions of the dofs for which area_volume() and
+        # darea_volume() were last computed:
+        self._area_volume_version = None
+        self._darea_volume_version = None
 
         # Initialize to an axisymmetric torus with major radius 1m and
         # minor radius 0.1m
@@ -270,8 +301,7 @@ class SurfaceRZFourier(Surface):
         """
         self._validate_mn(m, n)
         self.rc[m, n + self.ntor] = val
-        self.recalculate = True
-        self.recalculate_derivs = True
+        self.dofs_changed()
 
     def set_rs(self, m, n, val):
         """
@@ -282,8 +312,7 @@ class SurfaceRZFourier(Surface):
                 'rs does not exist for this stellarator-symmetric surface.')
         self._validate_mn(m, n)
         self.rs[m, n + self.ntor] = val
-        self.recalculate = True
-        self.recalculate_derivs = True
+        self.dofs_changed()
 
     def set_zc(self, m, n, val):
         """
@@ -294,8 +323,7 @@ class SurfaceRZFourier(Surface):
                 'zc does not exist for this stellarator-symmetric surface.')
         self._validate_mn(m, n)
         self.zc[m, n + self.ntor] = val
-        self.recalculate = True
-        self.recalculate_derivs = True
+        self.dofs_changed()
 
     def set_zs(self, m, n, val):
         """
@@ -303,20 +331,20 @@ class SurfaceRZFourier(Surface):
         """
         self._validate_mn(m, n)
         self.zs[m, n + self.ntor] = val
-        self.recalculate = True
-        self.recalculate_derivs = True
+        self.dofs_changed()
 
+    @timer.timed('surface geometry')
     def area_volume(self):
         """
         Compute the surface area and the volume enclosed by the surface.
         """
-        if self.recalculate:
+        if self._area_volume_version != self.version:
             logger.info('Running calculation of area and volume')
         else:
-            logger.info('area_volume called, but no need to recalculate')
+            logger.debug('area_volume called, but no need to recalculate')
             return
 
-        self.recalculate = False
+        self._area_volume_version = self.version
 
         if self.stelsym:
             rs = None
@@ -423,18 +451,19 @@ class SurfaceRZFourier(Surface):
         self.area_volume()
         return self._volume
 
+    @timer.timed('surface geometry')
     def darea_volume(self):
         """
         Compute the derivative of the surface area and the volume enclosed
         by the surface.
         """
-        if self.recalculate_derivs:
+        if self._darea_volume_version != self.version:
             logger.info('Running calculation of derivative of area and volume')
         else:
-            logger.info('darea_volume called, but no need to recalculate')
+            logger.debug('darea_volume called, but no need to recalculate')
             return
 
-        self.recalculate_derivs = False
+        self._darea_volume_version = self.version
 
         if self.stelsym:
             rs = None
@@ -586,12 +615,10 @@ class SurfaceRZFourier(Surface):
         
         # Check whether any elements actually change:
         if np.all(np.abs(self.get_dofs() - np.array(v)) == 0):
-            logger.info('set_dofs called, but no dofs actually changed')
+            logger.debug('set_dofs called, but no dofs actually changed')
             return
 
-        logger.info('set_dofs called, and at least one dof changed')
-        self.recalculate = True
-        self.recalculate_derivs = True
+        logger.debug('set_dofs called, and at least one dof changed')
         
         mpol = self.mpol # Shorthand
         ntor = self.ntor
@@ -660,8 +687,10 @@ class SurfaceGarabedian(Surface):
         self.nmin = nmin
         self.nmax = nmax
         self.allocate()
-        self.recalculate = True
-        self.recalculate_derivs = True
+        # Versions of the dofs for which area_volume() and
+        # darea_volume() were last computed:
+        self._area_volume_version = None
+        self._darea_volume_version = None
 
         # Initialize to an axisymmetric torus with major radius 1m and
         # minor radius 0.1m
@@ -699,8 +728,7 @@ class SurfaceGarabedian(Surface):
         Set a particular Delta_{m,n} coefficient.
         """
         self.Delta[m - self.mmin, n - self.nmin] = val
-        self.recalculate = True
-        self.recalculate_derivs = True
+        self.dofs_changed()
 
     def get_dofs(self):
         """
@@ -721,12 +749,10 @@ class SurfaceGarabedian(Surface):
         
         # Check whether any elements actually change:
         if np.all(np.abs(self.get_dofs() - np.array(v)) == 0):
-            logger.info('set_dofs called, but no dofs actually changed')
+            logger.debug('set_dofs called, but no dofs actually changed')
             return
 
-        logger.info('set_dofs called, and at least one dof changed')
-        self.recalculate = True
-        self.recalculate_derivs = True
+        logger.debug('set_dofs called, and at least one dof changed')
 
         self.Delta = v.reshape((self.mmax - self.mmin + 1, self.nmax - self.nmin + 1), order='F')
 
@@ -757,17 +783,18 @@ class SurfaceGarabedian(Surface):
 
         return s
 
+    @timer.timed('surface geometry')
     def area_volume(self):
         """
         Compute the surface area and the volume enclosed by the surface.
         """
-        if self.recalculate:
+        if self._area_volume_version != self.version:
             logger.info('Running calculation of area and volume')
         else:
-            logger.info('area_volume called, but no need to recalculate')
+            logger.debug('area_volume called, but no need to recalculate')
             return
 
-        self.recalculate = False
+        self._area_volume_version = self.version
 
         # Delegate to the area and volume calculations of SurfaceRZFourier():
         s = self.to_RZFourier()
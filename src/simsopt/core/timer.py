@@ -0,0 +1,200 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides a lightweight registry of timers with
+hierarchical sections, for finding out where the time in an
+optimization goes. Timing is off by default. In that case section()
+returns a shared do-nothing context manager, so instrumented code
+pays only for one function call and one global lookup.
+
+Usage:
+
+    from simsopt.core import timer
+
+    @timer.timed('my function')
+    def f():
+        ...
+
+    timer.enable()
+    with timer.section('my stage'):
+        f()
+    print(timer.summary(timer.gather(mpi)))
+
+Sections nest, and the time of each section is recorded under the
+path of the enclosing sections, e.g. 'solve/fd_jac/Dofs.f'.
+"""
+
+import time
+import logging
+import functools
+from mpi4py import MPI
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+_enabled = False
+# Names of the sections that are currently open:
+_stack = []
+# For each section path, a list [number of calls, total time]:
+_totals = {}
+
+
+class _NullSection:
+    """
+    The context manager used when timing is off.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_section = _NullSection()
+
+
+class _Section:
+    """
+    The context manager used when timing is on.
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        path = '/'.join(_stack)
+        _stack.pop()
+        entry = _totals.get(path)
+        if entry is None:
+            _totals[path] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+        return False
+
+
+def section(name):
+    """
+    Return a context manager that times the enclosed code as a section
+    with the given name, nested inside any sections already open.
+    """
+    if not _enabled:
+        return _null_section
+    return _Section(name)
+
+
+def timed(name):
+    """
+    Return a decorator that times every call of a function as a
+    section with the given name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Section(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enabled():
+    """
+    Return True if timing is switched on.
+    """
+    return _enabled
+
+
+def enable():
+    """
+    Switch on timing.
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """
+    Switch off timing. The times recorded so far are kept.
+    """
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    """
+    Discard all the times recorded so far.
+    """
+    _totals.clear()
+
+
+def totals():
+    """
+    Return a dict mapping each section path to a tuple (number of
+    calls, total time in seconds) for this process.
+    """
+    return {path: tuple(entry) for path, entry in _totals.items()}
+
+
+def gather(mpi):
+    """
+    Combine the times from all processes of the MpiPartition mpi. All
+    processes must call this function. On proc0_world, the result is a
+    dict mapping each section path to a dict with the total number of
+    calls, the number of processes that used the section, and the
+    minimum, mean and maximum over those processes of the total time.
+    Other processes receive None.
+    """
+    all_totals = mpi.comm_world.gather(totals(), root=0)
+    if not mpi.proc0_world:
+        return None
+    return combine(all_totals)
+
+
+def combine(all_totals):
+    """
+    Given a list with the result of totals() for each process, form
+    the statistics returned by gather().
+    """
+    stats = {}
+    for proc_totals in all_totals:
+        for path, (calls, elapsed) in proc_totals.items():
+            s = stats.setdefault(path, {'calls': 0, 'nprocs': 0, 'min': elapsed,
+                                        'max': elapsed, 'mean': 0.0})
+            s['calls'] += calls
+            s['nprocs'] += 1
+            s['min'] = min(s['min'], elapsed)
+            s['max'] = max(s['max'], elapsed)
+            s['mean'] += elapsed
+    for s in stats.values():
+        s['mean'] /= s['nprocs']
+    return stats
+
+
+def summary(stats=None):
+    """
+    Return a table of the times as a string. stats should be the result
+    of gather() or combine(). If it is None, the times for this process
+    alone are used. Sections are listed in hierarchical order, with
+    nested sections indented below their parent.
+    """
+    if stats is None:
+        stats = combine([totals()])
+    lines = ['{:<44} {:>8} {:>6} {:>11} {:>11} {:>11}'.format(
+        'Section', 'Calls', 'Procs', 'Min (s)', 'Mean (s)', 'Max (s)')]
+    for path in sorted(stats, key=lambda p: p.split('/')):
+        s = stats[path]
+        parts = path.split('/')
+        name = '  ' * (len(parts) - 1) + parts[-1]
+        lines.append('{:<44} {:>8d} {:>6d} {:>11.4g} {:>11.4g} {:>11.4g}'.format(
+            name, s['calls'], s['nprocs'], s['min'], s['mean'], s['max']))
+    return '\n'.join(lines)
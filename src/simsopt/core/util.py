@@ -48,3 +48,14 @@ def unique(inlist):
             outlist.append(j)
             seen.add(j)
     return outlist
+
+
+class ObjectiveFailure(Exception):
+    """
+    Exception raised when an objective function cannot be evaluated,
+    e.g. because an equilibrium code such as VMEC did not
+    converge. The simsopt solvers catch this exception (and no others)
+    and replace the function values by a large penalty, so the
+    optimizer backs away from the offending point instead of using
+    stale or meaningless data.
+    """
@@ -4,36 +4,61 @@
 
 """
 This module provides a class that handles the VMEC equilibrium code.
+
+The VMEC python extension is only imported when the first Vmec object
+that runs VMEC in this process is created.
 """
 
 import logging
 import os.path
+import importlib.machinery
 import numpy as np
 from mpi4py import MPI
-from monty.dev import requires
-
-from simsopt.core import Optimizable, optimizable, SurfaceRZFourier, MpiPartition
-try:
-    from simsopt.mhd.vmec_f90wrap import VMEC # May need to edit this path.
-    vmec_found = True
-except ImportError as err:
-    vmec_found = False
-    print('Unable to load VMEC module, so some functionality will not be available.')
-    print('Reason VMEC module was not loaded:')
-    print(err)
+
+from simsopt.core import Optimizable, optimizable, SurfaceRZFourier, MpiPartition, \
+    ObjectiveFailure
+from simsopt.core import timer
+from simsopt.core.dofs import combined_version
+from .vmec_output import VmecOutput
 
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
 
-@requires(vmec_found,
-          "Running VMEC from simsopt requires VMEC python extension. "
-          "Install the VMEC python extension from <link>.")
+# Check whether the compiled VMEC extension is present, without
+# importing it:
+vmec_found = importlib.machinery.PathFinder.find_spec(
+    '_vmec_f90wrap', [os.path.join(os.path.dirname(__file__), 'vmec_f90wrap')]) is not None
+if not vmec_found:
+    logger.info('VMEC python extension not found, so Vmec objects can only '
+                'run VMEC through a VmecPool.')
+
+
+def _vmec_class():
+    """
+    Import the VMEC python extension, and return its VMEC class. The
+    extension may be present but fail to import, e.g. if a library it
+    links to is missing, so the ImportError is turned into the same
+    RuntimeError as when the extension is not found.
+    """
+    try:
+        from .vmec_f90wrap import VMEC # May need to edit this path.
+    except ImportError as err:
+        raise RuntimeError("Running VMEC from simsopt requires VMEC python extension. "
+                           "Install the VMEC python extension from <link>.") from err
+    return VMEC
+
+
 class Vmec(Optimizable):
     """
     This class represents the VMEC equilibrium code.
     """
-    def __init__(self, filename=None, mpi=None):
+    def __init__(self, filename=None, mpi=None, pool=None):
         """
         Constructor
+
+        If pool is a VmecPool, VMEC runs in one of the pool's worker
+        processes instead of in this process, so several Vmec objects
+        can be live at the same time. In this case mpi is not used for
+        running VMEC.
         """
         if filename is None:
             # Read default input file, which should be in the same
@@ -52,8 +77,16 @@ class Vmec(Optimizable):
         comm = self.mpi.comm_groups
         self.fcomm = comm.py2f()
 
-        self.VMEC = VMEC(input_file=filename, comm=self.fcomm, \
-                             verbose=MPI.COMM_WORLD.rank==0, group=self.mpi.group)
+        self.pool = pool
+        if pool is None:
+            if not vmec_found:
+                raise RuntimeError("Running VMEC from simsopt requires VMEC python extension. "
+                                   "Install the VMEC python extension from <link>.")
+            VMEC = _vmec_class()
+            self.VMEC = VMEC(input_file=filename, comm=self.fcomm, \
+                                 verbose=MPI.COMM_WORLD.rank==0, group=self.mpi.group)
+        else:
+            self.VMEC = pool.acquire(filename)
         objstr = " for Vmec " + str(hex(id(self)))
         # nfp and stelsym are initialized by the Equilibrium constructor:
         #Equilibrium.__init__(self)
@@ -88,7 +121,24 @@ class Vmec(Optimizable):
                 self.boundary.zs[m, n + vi.ntor] = vi.zbs[101 + n, m]
         # Handle a few variables that are not Parameters:
         self.depends_on = ["boundary"]
-        self.need_to_run_code = True
+        # Combined version of the dofs of this object and the boundary
+        # for which VMEC was last run:
+        self._run_version = None
+
+        # Policy for handling runs that fail to converge. Each retry
+        # multiplies delt by retry_delt_factor and the number of
+        # iterations by retry_niter_factor, relative to the previous
+        # attempt. Every failed attempt is appended to failures.
+        self.max_retries = 2
+        self.retry_delt_factor = 0.5
+        self.retry_niter_factor = 2
+        self.failures = []
+        self.success = None
+        # Snapshot of the results of the most recent converged run:
+        self.output = None
+        # Combined version of the dofs for which a run was started by
+        # submit() but not yet collected:
+        self._submitted_version = None
 
         self.fixed = np.full(len(self.get_dofs()), True)
         self.names = ['delt', 'tcon0', 'phiedge', 'curtor', 'gamma']
@@ -97,21 +147,25 @@ class Vmec(Optimizable):
         return np.array([self.delt, self.tcon0, self.phiedge, self.curtor, self.gamma])
 
     def set_dofs(self, x):
-        self.need_to_run_code = True
         self.delt = x[0]
         self.tcon0 = x[1]
         self.phiedge = x[2]
         self.curtor = x[3]
         self.gamma = x[4]
+
+    @property
+    def need_to_run_code(self):
+        """
+        True if the dofs of this object or of the boundary have changed
+        since VMEC was last run.
+        """
+        return self._run_version != combined_version(self)
     
-    def run(self):
+    def _set_indata(self):
         """
-        Run VMEC, if needed.
+        Transfer the dofs of this object and of the boundary to VMEC's
+        input quantities.
         """
-        if not self.need_to_run_code:
-            logger.info("run() called but no need to re-run VMEC.")
-            return
-        logger.info("Preparing to run VMEC.")
         # Transfer values from Parameters to VMEC's fortran modules:
         vi = self.VMEC.indata
         vi.nfp = self.nfp
@@ -146,41 +200,141 @@ class Vmec(Optimizable):
         vi.zaxis_cc[:] = 0
         vi.zaxis_cs[:] = 0
 
+    def submit(self):
+        """
+        Start VMEC for the present dofs in this object's VmecPool
+        worker, if needed, without waiting for it to finish. The next
+        call to run(), or to any function that needs the output, waits
+        for the result. This allows several Vmec objects that use the
+        same pool to run at the same time; see VmecPool.run().
+        """
+        if self.pool is None:
+            raise RuntimeError('submit() requires a Vmec object that uses a VmecPool')
+        version = combined_version(self)
+        if version in (self._run_version, self._submitted_version):
+            return
+        logger.info("Submitting VMEC run to the pool.")
+        self._set_indata()
         self.VMEC.reinit()
-        logger.info("Running VMEC.")
-        self.VMEC.run()
+        self.VMEC.submit()
+        self._submitted_version = version
+
+    @timer.timed('Vmec.run')
+    def run(self):
+        """
+        Run VMEC, if needed.
+
+        If VMEC does not converge, it is run again up to max_retries
+        times with a smaller time step and more iterations. If it
+        still does not converge, ObjectiveFailure is raised, both now
+        and on any further call before the dofs change, so no stale
+        output from a previous run is ever returned.
+
+        If a run for the present dofs was started by submit(), its
+        result is collected as the first attempt.
+        """
+        version = combined_version(self)
+        if version == self._run_version:
+            logger.info("run() called but no need to re-run VMEC.")
+            if not self.success:
+                raise ObjectiveFailure("VMEC did not converge for the present dofs.")
+            return
+        submitted = version == self._submitted_version
+        self._submitted_version = None
+        if not submitted:
+            logger.info("Preparing to run VMEC.")
+            self._set_indata()
+
+        vi = self.VMEC.indata
+        self.output = None
+        niter_array = np.copy(vi.niter_array)
+        delt = self.delt
+        for attempt in range(self.max_retries + 1):
+            if attempt == 0 and submitted:
+                logger.info("Collecting submitted VMEC run.")
+                with timer.section('run'):
+                    self.success = self.VMEC.collect()
+            else:
+                vi.delt = delt
+                with timer.section('reinit'):
+                    self.VMEC.reinit()
+                logger.info("Running VMEC, attempt {}.".format(attempt))
+                with timer.section('run'):
+                    self.success = self.VMEC.run()
+            if self.success:
+                break
+            ier = int(self.VMEC.ictrl[1])
+            logger.warning("VMEC did not converge (ier={}) with delt={}"
+                           .format(ier, delt))
+            self.failures.append({'attempt': attempt,
+                                  'ier': ier,
+                                  'delt': delt,
+                                  'niter_array': np.copy(vi.niter_array),
+                                  'x': np.concatenate((self.get_dofs(),
+                                                       self.boundary.get_dofs()))})
+            delt *= self.retry_delt_factor
+            vi.niter_array[:] = np.where(vi.niter_array > 0,
+                                         vi.niter_array * self.retry_niter_factor,
+                                         vi.niter_array)
+        # Restore the iteration counts for the next run:
+        vi.niter_array[:] = niter_array
+        self._run_version = version
+
+        if not self.success:
+            raise ObjectiveFailure("VMEC did not converge after {} attempts."
+                                   .format(self.max_retries + 1))
+
         logger.info("VMEC run complete. Now loading output.")
-        self.VMEC.load()
+        with timer.section('load'):
+            ierr = self.VMEC.load()
+        if ierr != 0:
+            self.success = False
+            raise ObjectiveFailure("Unable to read VMEC output file "
+                                   + self.VMEC.output_file)
+        self.output = VmecOutput(self.VMEC.wout)
         logger.info("Done loading VMEC output.")
-        self.need_to_run_code = False
 
     def aspect(self):
         """
         Return the plasma aspect ratio.
         """
         self.run()
-        return self.VMEC.wout.aspect
+        return self.output.aspect
         
     def volume(self):
         """
         Return the volume inside the VMEC last closed flux surface.
         """
         self.run()
-        return self.VMEC.wout.volume
+        return self.output.volume
         
     def iota_axis(self):
         """
         Return the rotational transform on axis
         """
         self.run()
-        return self.VMEC.wout.iotaf[0]
+        return self.output.iotaf[0]
 
     def iota_edge(self):
         """
         Return the rotational transform at the boundary
         """
         self.run()
-        return self.VMEC.wout.iotaf[-1]
+        return self.output.iotaf[-1]
+
+    def iota(self, s):
+        """
+        Return the rotational transform at normalized toroidal flux s.
+        """
+        self.run()
+        return self.output.iota(s)
+
+    def iota_prime(self, s):
+        """
+        Return the magnetic shear d iota / d s at normalized toroidal flux s.
+        """
+        self.run()
+        return self.output.iota_prime(s)
 
     def get_max_mn(self):
         """
@@ -0,0 +1,132 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides the VmecOutput class, a snapshot of the results
+of a single VMEC run.
+
+This module does not depend on the VMEC python extension, so it can be
+used (and tested) without it.
+"""
+
+import logging
+import numpy as np
+from mpi4py import MPI
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+
+class VmecOutput:
+    """
+    This class holds the output of one converged VMEC run. It is built
+    from the f90wrap read_wout_mod module (or any object with the same
+    attributes) right after the wout file is read. Quantities are
+    copied into numpy arrays the first time they are accessed, so each
+    quantity is read from the fortran module at most once per run, no
+    matter how many target functions use it. Since the fortran arrays
+    are reallocated by the next run, the wout object must not be used
+    after the next run starts; call load_all() first if the snapshot
+    needs to outlive the run.
+
+    Any wout variable can be accessed as an attribute, e.g.
+    output.aspect or output.iotaf. Radial profiles can be interpolated
+    at arbitrary normalized toroidal flux s using the helper methods
+    below. Following VMEC conventions, full-mesh arrays have ns
+    entries at s = 0, 1/(ns-1), ..., 1, and half-mesh arrays have ns
+    entries of which the first is unused.
+    """
+    def __init__(self, wout):
+        self._wout = wout
+        self._cache = {}
+
+    def __getattr__(self, name):
+        # This method is only called when normal attribute lookup
+        # fails, i.e. for wout quantities.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        if self._wout is None:
+            raise AttributeError('{} was not loaded into this VmecOutput'.format(name))
+        value = getattr(self._wout, name)
+        if isinstance(value, np.ndarray):
+            # Copy, since the fortran memory will be reused by the next run:
+            value = np.array(value)
+        self._cache[name] = value
+        return value
+
+    def __getstate__(self):
+        return {'_wout': None, '_cache': self._cache}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def load_all(self, names):
+        """
+        Copy the quantities in the list names from wout now, and detach
+        from the wout object. Afterwards, only these quantities (and
+        any accessed earlier) are available.
+        """
+        for name in names:
+            getattr(self, name)
+        self._wout = None
+
+    @property
+    def s_full(self):
+        """
+        Normalized toroidal flux on the full radial mesh.
+        """
+        return np.linspace(0, 1, self.ns)
+
+    @property
+    def s_half(self):
+        """
+        Normalized toroidal flux on the half radial mesh, excluding the
+        unused first point.
+        """
+        s_full = self.s_full
+        return 0.5 * (s_full[1:] + s_full[:-1])
+
+    def interp_full(self, name, s):
+        """
+        Linearly interpolate the full-mesh profile name to the
+        normalized toroidal flux s, which may be a float or an array.
+        """
+        return np.interp(s, self.s_full, getattr(self, name))
+
+    def interp_half(self, name, s):
+        """
+        Linearly interpolate the half-mesh profile name to the
+        normalized toroidal flux s, which may be a float or an
+        array. Values outside the range of the half mesh are
+        extrapolated as constants.
+        """
+        return np.interp(s, self.s_half, getattr(self, name)[1:])
+
+    def iota(self, s):
+        """
+        Rotational transform at normalized toroidal flux s.
+        """
+        return self.interp_full('iotaf', s)
+
+    def iota_prime(self, s):
+        """
+        Radial derivative d iota / d s at normalized toroidal flux s,
+        a measure of the magnetic shear.
+        """
+        return np.interp(s, self.s_half, np.diff(self.iotaf) * (self.ns - 1))
+
+    def pressure(self, s):
+        """
+        Pressure at normalized toroidal flux s.
+        """
+        return self.interp_full('presf', s)
+
+    def vprime(self, s):
+        """
+        dV/ds (up to VMEC's normalization) at normalized toroidal flux s.
+        """
+        return self.interp_half('vp', s)
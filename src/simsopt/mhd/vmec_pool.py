@@ -0,0 +1,327 @@
+# coding: utf-8
+# Copyright (c) HiddenSymmetries Development Team.
+# Distributed under the terms of the LGPL License
+
+"""
+This module provides VmecPool, a pool of persistent worker processes
+each of which owns its own copy of VMEC's fortran module state. This
+allows several independent Vmec objects to be live in one python
+process. The VMEC python extension is only imported by the worker
+processes.
+"""
+
+import os
+import logging
+import multiprocessing
+import numpy as np
+from mpi4py import MPI
+
+from simsopt.core.util import Struct, ObjectiveFailure
+from .vmec_output import VmecOutput
+
+logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
+
+# Requests that can be sent to a worker. Each request is a tuple
+# (command, payload), and each response is a tuple (status, payload)
+# where status is OK or ERROR.
+INIT = 1
+RUN = 2
+FINALIZE = 3
+EXIT = 4
+OK = 0
+ERROR = 1
+
+# Input quantities that are copied between the parent process and
+# the worker's vmec_input module:
+INDATA_NAMES = ['nfp', 'lasym', 'mpol', 'ntor', 'delt', 'tcon0', 'phiedge',
+                'curtor', 'gamma', 'ncurr', 'lfreeb', 'niter_array',
+                'rbc', 'zbs', 'rbs', 'zbc',
+                'raxis_cc', 'raxis_cs', 'zaxis_cc', 'zaxis_cs']
+
+# Output quantities that are sent back from the worker after each
+# converged run:
+WOUT_NAMES = ['ns', 'nfp', 'mpol', 'ntor', 'aspect', 'volume', 'betatot',
+              'rmajor', 'aminor', 'iotaf', 'iotas', 'presf', 'pres', 'vp',
+              'phi', 'xm', 'xn', 'rmnc', 'zmns']
+
+
+def _default_backend(**kwargs):
+    """
+    Create a VMEC instance using the f90wrap VMEC python extension.
+    """
+    from .vmec_f90wrap import VMEC
+    return VMEC(**kwargs)
+
+
+def _get_indata(vmec):
+    """
+    Return a Struct holding copies of the input quantities of a VMEC
+    backend.
+    """
+    indata = Struct()
+    for name in INDATA_NAMES:
+        value = getattr(vmec.indata, name)
+        if isinstance(value, np.ndarray):
+            value = np.array(value)
+        setattr(indata, name, value)
+    return indata
+
+
+def _set_indata(vmec, indata):
+    """
+    Transfer input quantities from a Struct to a VMEC backend.
+    """
+    for name in INDATA_NAMES:
+        value = getattr(indata, name)
+        if isinstance(value, np.ndarray):
+            getattr(vmec.indata, name)[...] = value
+        else:
+            setattr(vmec.indata, name, value)
+
+
+def _worker_main(conn, backend, worker):
+    """
+    Main loop of a worker process: wait for requests, handle them, and
+    send back responses until EXIT is received.
+
+    VMEC names its input and wout files after the input file and its
+    group, in the current directory, so each worker uses its index in
+    the pool as the group. Otherwise workers started from the same
+    input file would overwrite each other's files.
+    """
+    vmec = None
+    while True:
+        command, payload = conn.recv()
+        if command == EXIT:
+            conn.send((OK, None))
+            break
+        try:
+            if command == INIT:
+                vmec = backend(input_file=payload, comm=MPI.COMM_SELF.py2f(),
+                               verbose=False, group=worker)
+                result = _get_indata(vmec)
+            elif command == RUN:
+                _set_indata(vmec, payload)
+                vmec.reinit()
+                success = vmec.run()
+                output = None
+                if success:
+                    vmec.load()
+                    output = VmecOutput(vmec.wout)
+                    output.load_all([name for name in WOUT_NAMES
+                                     if hasattr(vmec.wout, name)])
+                result = (success, int(vmec.ictrl[1]), vmec.output_file, output)
+            elif command == FINALIZE:
+                vmec.finalize()
+                vmec = None
+                result = None
+            else:
+                raise ValueError('Unknown request {}'.format(command))
+        except Exception as err:
+            conn.send((ERROR, repr(err)))
+        else:
+            conn.send((OK, result))
+
+
+class VmecProcess:
+    """
+    This class is a proxy for a VMEC instance that lives in a worker
+    process of a VmecPool. It has the same interface as the VMEC
+    class from vmec_f90wrap that is used by the Vmec class, so a Vmec
+    object can use either one. The input quantities in indata are a
+    local copy, which is sent to the worker at each run.
+
+    Besides the blocking run(), a run can be split into submit() and
+    collect(), so several VmecProcesses in the same pool can run at the
+    same time: submit to all of them first, then collect from each.
+    """
+    def __init__(self, pool, worker, input_file):
+        self.pool = pool
+        self.worker = worker
+        self.input_file = input_file
+        self.indata = self._request(INIT, input_file)
+        self.wout = None
+        self.success = False
+        self.output_file = None
+        self.ictrl = np.zeros(5, dtype=np.int32)
+        self.pending = False
+
+    def _request(self, command, payload=None):
+        return self.pool._request(self.worker, command, payload)
+
+    def reinit(self):
+        """
+        Nothing to do here, since the worker re-initializes VMEC at the
+        start of each run.
+        """
+
+    def run(self):
+        """
+        Send the input quantities to the worker, run VMEC there, and
+        receive the output. Returns True if VMEC converged.
+        """
+        self.submit()
+        return self.collect()
+
+    def submit(self):
+        """
+        Send the input quantities to the worker and start VMEC there,
+        without waiting for it to finish. If a previous run was
+        submitted but not collected, its result is discarded.
+        """
+        if self.pending:
+            self.collect()
+        self.pool._send(self.worker, RUN, self.indata)
+        self.pending = True
+
+    def collect(self):
+        """
+        Wait for the run started by submit() to finish, and receive the
+        output. Returns True if VMEC converged.
+        """
+        if not self.pending:
+            raise RuntimeError('collect() called without a submitted run')
+        self.pending = False
+        self.success, self.ictrl[1], self.output_file, self.wout = \
+            self.pool._receive(self.worker)
+        return self.success
+
+    def load(self):
+        """
+        The output was already received by run(), so there is nothing
+        to do here.
+        """
+        return 0 if self.success else 1
+
+    def finalize(self):
+        """
+        Deallocate VMEC's arrays in the worker, and return the worker to
+        the pool.
+        """
+        if self.worker is not None:
+            if self.pending:
+                self.collect()
+            self._request(FINALIZE)
+            self.pool._release(self.worker)
+            self.worker = None
+
+
+class VmecPool:
+    """
+    This class manages a pool of persistent worker processes, each
+    owning its own VMEC fortran module state. Use acquire() to get a
+    VmecProcess, or pass the pool to the Vmec constructor. Each worker
+    serves one VmecProcess at a time, until the latter is finalized.
+    Workers run at the same time when their runs are started with
+    submit() before any result is collected, e.g. by run().
+
+    Worker processes are started with the "spawn" method, since
+    forking a process that has initialized MPI is not safe. Each
+    worker runs VMEC on MPI.COMM_SELF.
+    """
+    def __init__(self, nworkers=1, backend=_default_backend):
+        """
+        nworkers is the number of worker processes. backend is a
+        picklable callable that creates a VMEC instance in a worker,
+        given the keywords input_file, comm, verbose, and group.
+        """
+        if nworkers < 1:
+            raise ValueError('nworkers must be at least 1')
+        context = multiprocessing.get_context('spawn')
+        self.connections = []
+        self.processes = []
+        for j in range(nworkers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker_main,
+                                      args=(child_conn, backend, j), daemon=True)
+            process.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(process)
+        self.free = list(range(nworkers))
+        logger.info('Started VmecPool with {} workers'.format(nworkers))
+
+    @property
+    def nworkers(self):
+        return len(self.processes)
+
+    def _send(self, worker, command, payload=None):
+        """
+        Send one request to a worker without waiting for the response.
+        """
+        self.connections[worker].send((command, payload))
+
+    def _receive(self, worker):
+        """
+        Wait for the response to the last request sent to a worker.
+        """
+        status, result = self.connections[worker].recv()
+        if status == ERROR:
+            raise RuntimeError('VMEC worker {} failed: {}'.format(worker, result))
+        return result
+
+    def _request(self, worker, command, payload=None):
+        """
+        Send one request to a worker and wait for the response.
+        """
+        self._send(worker, command, payload)
+        return self._receive(worker)
+
+    def _release(self, worker):
+        self.free.append(worker)
+
+    def acquire(self, input_file):
+        """
+        Initialize VMEC from input_file in a free worker, and return a
+        VmecProcess bound to that worker.
+        """
+        if not self.free:
+            raise RuntimeError('All {} VMEC workers are in use'.format(self.nworkers))
+        worker = self.free.pop(0)
+        try:
+            return VmecProcess(self, worker, os.path.abspath(input_file))
+        except Exception:
+            self._release(worker)
+            raise
+
+    def run(self, vmecs):
+        """
+        Run several Vmec objects that use this pool at the same time.
+        VMEC is started in the workers of all of them before waiting for
+        any, and then the results are collected in turn. If VMEC fails
+        for any of them, the first ObjectiveFailure is raised once all
+        the results have been collected.
+        """
+        for vmec in vmecs:
+            vmec.submit()
+        failure = None
+        for vmec in vmecs:
+            try:
+                vmec.run()
+            except ObjectiveFailure as err:
+                if failure is None:
+                    failure = err
+        if failure is not None:
+            raise failure
+
+    def close(self):
+        """
+        Stop all the worker processes.
+        """
+        for worker, conn in enumerate(self.connections):
+            try:
+                self._request(worker, EXIT)
+            except (EOFError, OSError):
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+        self.free = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
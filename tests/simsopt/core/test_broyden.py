@@ -0,0 +1,69 @@
+import unittest
+import numpy as np
+from simsopt.core.broyden import BroydenJacobian, broyden_update
+from simsopt.core.least_squares_problem import LeastSquaresProblem
+from simsopt.core.serial_solve import least_squares_serial_solve
+from simsopt.core.mpi import MpiPartition
+from simsopt.core.mpi_solve import least_squares_mpi_solve
+from simsopt.core.functions import Rosenbrock
+
+def mpi_solve_1group(prob, **kwargs):
+    least_squares_mpi_solve(prob, MpiPartition(ngroups=1), **kwargs)
+
+class BroydenTests(unittest.TestCase):
+    def test_update(self):
+        """
+        The updated Jacobian should satisfy the secant condition, and
+        be unchanged in directions orthogonal to the step.
+        """
+        np.random.seed(0)
+        jac = np.random.rand(3, 2)
+        dx = np.array([0.3, -0.1])
+        df = np.array([1.0, 2.0, -1.0])
+        new_jac = broyden_update(jac, dx, df)
+        np.testing.assert_allclose(new_jac @ dx, df)
+        orthogonal = np.array([0.1, 0.3])
+        np.testing.assert_allclose(new_jac @ orthogonal, jac @ orthogonal)
+
+    def test_wrap(self):
+        """
+        A full Jacobian should be computed only at the first point,
+        after max_updates updates, and when progress stalls.
+        """
+        matrix = np.array([[1.0, 2.0], [3.0, -1.0], [0.5, 0.5]])
+        fun = lambda x: matrix @ x
+        njac = [0]
+        def jac(x):
+            njac[0] += 1
+            return matrix
+        b = BroydenJacobian(max_updates=2)
+        fun = b.wrap_fun(fun)
+        jac = b.wrap_jac(jac)
+        for x in [[1.0, 1.0], [0.5, 0.4], [0.2, 0.1], [0.1, 0.05], [0.05, 0.01]]:
+            fun(np.array(x))
+            # For a linear function, the updates preserve the exact
+            # Jacobian:
+            np.testing.assert_allclose(jac(np.array(x)), matrix)
+        self.assertEqual(njac[0], 2)
+        self.assertEqual(b.nfull, 2)
+        self.assertEqual(b.nbroyden, 3)
+        # No reduction in the objective:
+        fun(np.array([0.05, -0.01]))
+        jac(np.array([0.05, -0.01]))
+        self.assertEqual(b.nfull, 3)
+
+    def test_solve(self):
+        """
+        The Rosenbrock minimum should still be found when most
+        Jacobians come from Broyden updates.
+        """
+        for solver in [least_squares_serial_solve, mpi_solve_1group]:
+            for grad in [True, False]:
+                r = Rosenbrock()
+                prob = LeastSquaresProblem([(r.terms, 0, 1)])
+                solver(prob, grad=grad, broyden=True, broyden_max_updates=5)
+                np.testing.assert_allclose(prob.x, [1.0, 1.0], atol=1e-5)
+                self.assertAlmostEqual(prob.objective(), 0, places=8)
+
+if __name__ == "__main__":
+    unittest.main()
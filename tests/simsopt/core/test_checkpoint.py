@@ -0,0 +1,131 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+from mpi4py import MPI
+from simsopt.core.checkpoint import Checkpoint
+from simsopt.core.least_squares_problem import LeastSquaresProblem
+from simsopt.core.serial_solve import least_squares_serial_solve
+from simsopt.core.mpi import MpiPartition
+from simsopt.core.mpi_solve import least_squares_mpi_solve
+
+class Interrupted(Exception):
+    pass
+
+class RecordingRosenbrock:
+    """
+    The Rosenbrock function, which records every point at which it is
+    evaluated, and which can simulate a crash after a given number of
+    evaluations.
+    """
+    def __init__(self, max_evals=None):
+        self.x = np.array([-1.2, 1.0])
+        self.max_evals = max_evals
+        self.evaluated = []
+
+    def get_dofs(self):
+        return self.x
+
+    def set_dofs(self, x):
+        self.x = np.array(x)
+
+    def terms(self):
+        if self.max_evals is not None and len(self.evaluated) >= self.max_evals:
+            raise Interrupted()
+        self.evaluated.append(self.x.tobytes())
+        return np.array([self.x[0] - 1, (self.x[0] ** 2 - self.x[1]) / 10])
+
+def mpi_solve_1group(prob, **kwargs):
+    # Each process solves on its own, with its own temporary
+    # directory, so the test also works under mpiexec:
+    least_squares_mpi_solve(prob, MpiPartition(ngroups=1, comm_world=MPI.COMM_SELF),
+                            **kwargs)
+
+class CheckpointTests(unittest.TestCase):
+    def test_write_load(self):
+        """
+        Data written to a checkpoint should be recovered when it is read.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'checkpoint.npz')
+            history_filename = filename + '.history'
+            c = Checkpoint(filename, 2, interval=2)
+            c.record_f([1.0, 2.0], [3.0, 4.0])
+            # Not written yet:
+            self.assertFalse(os.path.exists(history_filename))
+            c.record_f([1.5, 2.0], [1.0, -1.0])
+            self.assertTrue(os.path.exists(history_filename))
+            c.record_f([2.0, 2.0], [2.0, 1.0])
+            c.record_jac([1.5, 2.0], np.eye(2))
+            c.write()
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['checkpoint.npz', 'checkpoint.npz.history'])
+
+            c2 = Checkpoint(filename, 2)
+            self.assertEqual(c2.nevals, 3)
+            np.testing.assert_allclose(c2.x, [2.0, 2.0])
+            np.testing.assert_allclose(c2.best_x, [1.5, 2.0])
+            self.assertAlmostEqual(c2.best_objective, 2.0)
+            np.testing.assert_allclose(c2.lookup_f([1.0, 2.0]), [3.0, 4.0])
+            self.assertIsNone(c2.lookup_f([1.0, 2.1]))
+            np.testing.assert_allclose(c2.lookup_jac([1.5, 2.0]), np.eye(2))
+            self.assertIsNone(c2.lookup_jac([1.0, 2.0]))
+
+            # The number of parameters must match:
+            with self.assertRaises(ValueError):
+                Checkpoint(filename, 3)
+
+    def test_append(self):
+        """
+        New evaluations should be appended to the file rather than
+        rewriting it, and a record torn by a crash should be dropped.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'checkpoint.npz')
+            history_filename = filename + '.history'
+            c = Checkpoint(filename, 2)
+            c.record_f([1.0, 2.0], [3.0, 4.0])
+            size1 = os.path.getsize(history_filename)
+            c.record_f([1.5, 2.0], [1.0, -1.0])
+            record_size = os.path.getsize(history_filename) - size1
+            c.record_f([2.0, 2.0], [2.0, 1.0])
+            self.assertEqual(os.path.getsize(history_filename), size1 + 2 * record_size)
+
+            # Simulate a crash in the middle of writing a record:
+            with open(history_filename, 'ab') as f:
+                f.write(b'\0' * (record_size // 2))
+            c2 = Checkpoint(filename, 2)
+            self.assertEqual(c2.nevals, 3)
+            c2.record_f([3.0, 2.0], [0.5, 0.5])
+            c3 = Checkpoint(filename, 2)
+            self.assertEqual(c3.nevals, 4)
+            np.testing.assert_allclose(c3.best_x, [3.0, 2.0])
+
+    def test_resume(self):
+        """
+        Interrupt an optimization, then resume it from the checkpoint.
+        No point in the history should be evaluated again.
+        """
+        for solver in [least_squares_serial_solve, mpi_solve_1group]:
+            for grad in [True, False]:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    filename = os.path.join(tmpdir, 'checkpoint.npz')
+                    r = RecordingRosenbrock(max_evals=8)
+                    prob = LeastSquaresProblem([(r.terms, 0, 1)])
+                    with self.assertRaises(Interrupted):
+                        solver(prob, grad=grad, checkpoint_file=filename)
+                    c = Checkpoint(filename, 2)
+                    nevals_first = c.nevals
+                    self.assertGreater(nevals_first, 1)
+
+                    r = RecordingRosenbrock()
+                    prob = LeastSquaresProblem([(r.terms, 0, 1)])
+                    solver(prob, grad=grad, checkpoint_file=filename)
+                    np.testing.assert_allclose(r.x, [1, 1], atol=1e-6)
+                    c = Checkpoint(filename, 2)
+                    self.assertGreater(c.nevals, nevals_first)
+                    self.assertEqual(len(c.f_lookup), c.nevals)
+                    np.testing.assert_allclose(c.best_x, [1, 1], atol=1e-6)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,37 @@
 import unittest
 import numpy as np
-from simsopt.core.dofs import get_owners, Dofs
-from simsopt.core.functions import Identity, Adder, TestObject2, Rosenbrock, Affine
+from simsopt.core.dofs import get_owners, Dofs, fd_steps, color_columns, \
+    ecnoise, noise_points, fd_rel_eps, fd_weights, fd_offsets, stencil_nodes, \
+    stencil_order
+from simsopt.core.functions import Identity, Adder, TestObject1, TestObject2, Rosenbrock, Affine
 from simsopt.core.optimizable import Target
 
+class CountingAffine(Affine):
+    """
+    An Affine function that counts its evaluations.
+    """
+    def __init__(self, nparams, nvals):
+        Affine.__init__(self, nparams, nvals)
+        self.nevals = 0
+
+    def J(self):
+        self.nevals += 1
+        return Affine.J(self)
+
+class NoisyAffine(Affine):
+    """
+    An Affine function with random noise of the given relative size
+    added to every evaluation.
+    """
+    def __init__(self, nparams, nvals, noise):
+        Affine.__init__(self, nparams, nvals)
+        self.noise = noise
+        self.rng = np.random.default_rng(1)
+
+    def J(self):
+        f = Affine.J(self)
+        return f * (1 + self.noise * self.rng.standard_normal(len(f)))
+
 class GetOwnersTests(unittest.TestCase):
     def test_no_dependents(self):
         """
@@ -310,5 +338,230 @@ class DofsTests(unittest.TestCase):
                 self.assertEqual(list(dofs.nvals_per_func), nvals_per_func)
                 
 
+    def test_fd_jac_bounds(self):
+        """
+        At a bound, the finite-difference Jacobian should step into the
+        feasible region and still be accurate.
+        """
+        for centered in [False, True]:
+            r = Rosenbrock(b=3.0, x=0.5, y=-0.2)
+            r.mins = np.array([-np.inf, -0.2])
+            r.maxs = np.array([0.5, np.inf])
+            dofs = Dofs([r.terms])
+            jac = dofs.jac()
+            fd_jac = dofs.fd_jac(centered=centered)
+            np.testing.assert_allclose(jac, fd_jac, rtol=1e-6, atol=1e-6)
+            np.testing.assert_allclose(r.get_dofs(), [0.5, -0.2])
+
+    def test_fd_steps(self):
+        """
+        Check the finite-difference steps near bounds.
+        """
+        x0 = np.array([0.0, 1.0, 2.0])
+        mins = np.array([-1.0, 1.0, -np.inf])
+        maxs = np.array([1.0, 3.0, 2.0])
+        hplus, hminus = fd_steps(x0, 0.1, mins, maxs)
+        np.testing.assert_allclose(hplus, [0.1, 0.1, -0.1])
+        np.testing.assert_allclose(hminus, [0, 0, 0])
+        hplus, hminus = fd_steps(x0, 0.1, mins, maxs, centered=True)
+        np.testing.assert_allclose(hplus, [0.1, 0.1, 0])
+        np.testing.assert_allclose(hminus, [0.1, 0, 0.1])
+        # Per-dof and relative steps:
+        hplus, hminus = fd_steps(x0, [0.1, 0.2, 0.3], mins, maxs)
+        np.testing.assert_allclose(hplus, [0.1, 0.2, -0.3])
+        hplus, hminus = fd_steps(x0, 0.01, mins, maxs, rel_eps=0.1)
+        np.testing.assert_allclose(hplus, [0.01, 0.1, -0.2])
+        # Bounds closer together than the step, which is then shrunk:
+        x0 = np.array([0.0, 1.0])
+        mins = np.array([-1e-4, 0.9998])
+        maxs = np.array([1e-4, 1.0001])
+        hplus, hminus = fd_steps(x0, 1e-3, mins, maxs)
+        np.testing.assert_allclose(hplus, [1e-4, -2e-4])
+        hplus, hminus = fd_steps(x0, 1e-3, mins, maxs, centered=True)
+        np.testing.assert_allclose(hplus, [1e-4, 0])
+        np.testing.assert_allclose(hminus, [0, 2e-4])
+        with self.assertRaises(ValueError):
+            fd_steps(np.array([1.0]), 1e-3, np.array([1.0]), np.array([1.0]))
+
+    def test_stencils(self):
+        """
+        Check the weights and orders of the stencils, and their
+        placement near bounds.
+        """
+        np.testing.assert_allclose(fd_weights(stencil_nodes('richardson')),
+                                   [-1.5, 2, -0.5])
+        np.testing.assert_allclose(fd_weights(0.1 * stencil_nodes('4-point')),
+                                   [5 / 6, -20 / 3, 20 / 3, -5 / 6])
+        self.assertEqual([stencil_order(stencil_nodes(name)) for name in
+                          ['forward', 'centered', 'richardson', '4-point']],
+                         [1, 2, 2, 4])
+        np.testing.assert_allclose(stencil_nodes(centered=True), [-1, 1])
+        with self.assertRaises(ValueError):
+            stencil_nodes('foo')
+        with self.assertRaises(ValueError):
+            stencil_nodes([1, 1])
+
+        x0 = np.array([0.0, 1.0, 2.0])
+        mins = np.array([-1.0, 0.9, -np.inf])
+        maxs = np.array([1.0, 3.0, 2.0])
+        offsets = fd_offsets(x0, 0.1, mins, maxs, stencil_nodes('4-point'))
+        np.testing.assert_allclose(offsets, [[-0.2, -0.1, 0.1, 0.2],
+                                             [0, 0.1, 0.2, 0.3],
+                                             [0, -0.1, -0.2, -0.3]])
+
+    def test_fd_jac_stencils(self):
+        """
+        With a large step, the wider stencils should be more accurate,
+        and they should respect bounds.
+        """
+        r = Rosenbrock(b=3.0, x=0.5, y=-0.2)
+        dofs = Dofs([r.terms])
+        jac = dofs.jac()
+        errors = {}
+        for stencil in ['forward', 'richardson', 'centered', '4-point']:
+            fd_jac = dofs.fd_jac(eps=0.01, stencil=stencil)
+            errors[stencil] = np.max(np.abs(fd_jac - jac))
+        # The functions are quadratic, so all stencils but the forward
+        # one are exact:
+        self.assertLess(errors['richardson'], 1e-10)
+        self.assertGreater(errors['forward'], 1e-3)
+        self.assertLess(errors['centered'], 1e-10)
+        self.assertLess(errors['4-point'], 1e-10)
+
+        r.mins = np.array([-np.inf, -0.2])
+        r.maxs = np.array([0.5, np.inf])
+        dofs = Dofs([r.terms])
+        for stencil in ['richardson', '4-point']:
+            calls = []
+            fd_jac = dofs.fd_jac(eps=0.01, stencil=stencil,
+                                 callback=lambda x, f, success: calls.append(x))
+            np.testing.assert_allclose(fd_jac, jac, atol=1e-10)
+            self.assertTrue(np.all(np.array(calls) <= [0.5, np.inf]))
+            self.assertTrue(np.all(np.array(calls) >= [-np.inf, -0.2]))
+
+    def test_ecnoise(self):
+        """
+        The noise level of a smooth function plus random noise should be
+        estimated to within a small factor.
+        """
+        x0 = np.array([1.0, -2.0, 0.0])
+        xs = noise_points(x0, np.full(3, -np.inf), np.full(3, np.inf))
+        self.assertEqual(xs.shape, (3, 8))
+        np.testing.assert_allclose(xs[:, 0], x0)
+        rng = np.random.default_rng(0)
+        smooth = np.sin(xs[0]) + xs[1] ** 2 + np.exp(xs[2])
+        for sigma in [1e-6, 1e-9]:
+            noise = ecnoise(smooth + sigma * rng.standard_normal(8))
+            self.assertGreater(noise[0], sigma / 3)
+            self.assertLess(noise[0], sigma * 3)
+        # The points should stay within the bounds on both sides. The
+        # last dof has no room for the full span either way:
+        x0 = np.array([1.0, -2.0, 0.0])
+        mins = np.array([1.0, -np.inf, -1e-6])
+        maxs = np.array([np.inf, -2.0, 2e-6])
+        xs = noise_points(x0, mins, maxs)
+        np.testing.assert_allclose(xs[:, 0], x0)
+        self.assertTrue(np.all(xs >= mins.reshape((-1, 1))))
+        self.assertTrue(np.all(xs <= maxs.reshape((-1, 1))))
+        self.assertTrue(np.all(np.diff(xs, axis=1)[:2] != 0))
+        np.testing.assert_allclose(xs[2, -1], 2e-6)
+        # No noise can be seen if the points are too far apart:
+        self.assertTrue(np.isnan(ecnoise(np.arange(8.0) ** 3 + 1)[0]))
+        self.assertEqual(fd_rel_eps(np.nan), 0)
+        self.assertAlmostEqual(fd_rel_eps(1e-12, centered=True), 1e-4)
+
+    def test_fd_jac_auto(self):
+        """
+        With noisy functions, automatic steps should give a much more
+        accurate Jacobian than the default small absolute step.
+        """
+        np.random.seed(0)
+        a = NoisyAffine(3, 4, noise=1e-8)
+        a.set_dofs(np.array([1.0, 2.0, -0.5]))
+        dofs = Dofs([a.J])
+        fixed_error = np.max(np.abs(dofs.fd_jac() - a.A))
+        auto_error = np.max(np.abs(dofs.fd_jac(rel_eps='auto') - a.A))
+        self.assertGreater(dofs.fd_noise, 1e-9)
+        self.assertLess(dofs.fd_noise, 1e-7)
+        self.assertLess(auto_error, 1e-3)
+        self.assertLess(auto_error, 0.01 * fixed_error)
+
+    def test_color_columns(self):
+        """
+        Columns in the same group must not share a nonzero row.
+        """
+        dependence = np.array([[1, 1, 0, 0, 0],
+                               [0, 0, 1, 0, 1],
+                               [0, 1, 0, 1, 0]], dtype=bool)
+        groups = color_columns(dependence)
+        self.assertEqual([list(g) for g in groups], [[0, 2, 3], [1, 4]])
+        # A dense pattern needs one group per column:
+        groups = color_columns(np.full((2, 3), True))
+        self.assertEqual([list(g) for g in groups], [[0], [1], [2]])
+
+    def test_sparse_fd_jac(self):
+        """
+        For functions that depend on disjoint sets of dofs, the
+        finite-difference Jacobian should use fewer function evaluations
+        and still agree with the analytic Jacobian.
+        """
+        np.random.seed(0)
+        a1 = Affine(2, 3)
+        a2 = Affine(3, 2)
+        t = TestObject1(0.7)
+        t.adder1.set_dofs([0.1, 0.2, 0.3])
+        t.adder2.set_dofs([0.4, -0.5])
+        dofs = Dofs([a1.J, a2.J, t.J])
+        self.assertEqual(dofs.nparams, 11)
+        self.assertEqual([list(g) for g in dofs.fd_groups],
+                         [[0, 2, 5], [1, 3, 6], [4, 7], [8], [9], [10]])
+        with self.assertRaises(RuntimeError):
+            dofs.sparsity()
+        jac = dofs.jac()
+        sparsity = dofs.sparsity()
+        self.assertEqual(sparsity.shape, (6, 11))
+        np.testing.assert_equal(sparsity[:3, :2], True)
+        np.testing.assert_equal(sparsity[:3, 2:], False)
+        np.testing.assert_equal(sparsity[5, :5], False)
+        np.testing.assert_equal(sparsity[5, 5:], True)
+
+        for centered in [False, True]:
+            calls = []
+            fd_jac = dofs.fd_jac(centered=centered,
+                                 callback=lambda x, f, success: calls.append(x))
+            np.testing.assert_allclose(jac, fd_jac, rtol=1e-6, atol=1e-6)
+            self.assertEqual(len(calls), 12 if centered else 7)
+            np.testing.assert_equal(fd_jac[~sparsity], 0)
+
+            calls = []
+            fd_jac = dofs.fd_jac(centered=centered, grouped=False,
+                                 callback=lambda x, f, success: calls.append(x))
+            np.testing.assert_allclose(jac, fd_jac, rtol=1e-6, atol=1e-6)
+            self.assertEqual(len(calls), 22 if centered else 12)
+
+    def test_fd_jac_reuse(self):
+        """
+        During finite differencing, only the functions that depend on the
+        perturbed dofs should be re-evaluated.
+        """
+        np.random.seed(0)
+        a1 = CountingAffine(2, 3)
+        a2 = CountingAffine(3, 2)
+        a3 = CountingAffine(6, 1)
+        dofs = Dofs([a1.J, a2.J, a3.J])
+        self.assertEqual(dofs.func_owners, [[a1], [a2], [a3]])
+        jac = dofs.jac()
+        # (centered, reuse): expected evaluations of a1, a2, a3
+        expected = {(False, True): [3, 4, 7],
+                    (True, True): [5, 7, 12],
+                    (False, False): [7, 7, 7],
+                    (True, False): [12, 12, 12]}
+        for (centered, reuse), nevals in expected.items():
+            for a in [a1, a2, a3]:
+                a.nevals = 0
+            fd_jac = dofs.fd_jac(centered=centered, reuse=reuse)
+            np.testing.assert_allclose(jac, fd_jac, rtol=1e-6, atol=1e-6)
+            self.assertEqual([a1.nevals, a2.nevals, a3.nevals], nevals)
+
 if __name__ == "__main__":
     unittest.main()
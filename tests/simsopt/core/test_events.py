@@ -0,0 +1,64 @@
+import unittest
+import json
+import logging
+import numpy as np
+from mpi4py import MPI
+from simsopt.core import events
+from simsopt.core.functions import Rosenbrock, Failer
+from simsopt.core.least_squares_problem import LeastSquaresProblem
+
+class ListHandler(logging.Handler):
+    """
+    A logging handler that keeps the formatted messages in a list.
+    """
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+class EventsTests(unittest.TestCase):
+    def tearDown(self):
+        events.disable()
+
+    def test_disabled(self):
+        """
+        Nothing should be written when the channel is off.
+        """
+        handler = ListHandler()
+        events.event_logger.addHandler(handler)
+        self.assertFalse(events.enabled())
+        prob = LeastSquaresProblem([(Rosenbrock().terms, 0, 1)])
+        prob.f()
+        prob.jac()
+        self.assertEqual(handler.messages, [])
+
+    def test_evaluations(self):
+        """
+        Each function and Jacobian evaluation should produce one JSON
+        event.
+        """
+        handler = events.enable(handler=ListHandler())
+        self.assertTrue(events.enabled())
+        failer = Failer(fail_indices=(1,))
+        prob = LeastSquaresProblem([(failer, 0, 1)], fail=100.0)
+        prob.f()
+        prob.jac()
+        records = [json.loads(m) for m in handler.messages]
+        self.assertEqual([r['event'] for r in records], ['evaluation'] * 4 + ['jacobian'])
+        self.assertEqual([r['success'] for r in records[:4]], [True, False, True, True])
+        np.testing.assert_allclose([r['objective'] for r in records[:4]],
+                                   [3.0, 30000.0, 3.0, 3.0])
+        np.testing.assert_allclose(records[2]['x'], [1e-7, 0])
+        self.assertFalse(records[4]['grad_avail'])
+        for r in records:
+            self.assertEqual(r['rank'], MPI.COMM_WORLD.Get_rank())
+
+        events.disable()
+        self.assertFalse(events.enabled())
+        prob.f()
+        self.assertEqual(len(handler.messages), 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import contextlib
+import os
+import shutil
+import tempfile
+import numpy as np
+from mpi4py import MPI
+from simsopt.core.history import EvaluationHistory, read_history
+from simsopt.core.functions import Rosenbrock, Failer
+from simsopt.core.least_squares_problem import LeastSquaresProblem
+from simsopt.core.serial_solve import least_squares_serial_solve
+from simsopt.core.mpi import MpiPartition
+from simsopt.core.mpi_solve import least_squares_mpi_solve
+
+@contextlib.contextmanager
+def shared_tmpdir(comm=MPI.COMM_WORLD):
+    """
+    A temporary directory that is created on rank 0 of comm and shared
+    by all its processes, so tests also work under mpiexec.
+    """
+    tmpdir = tempfile.mkdtemp() if comm.rank == 0 else None
+    tmpdir = comm.bcast(tmpdir)
+    try:
+        yield tmpdir
+    finally:
+        comm.barrier()
+        if comm.rank == 0:
+            shutil.rmtree(tmpdir)
+
+class EvaluationHistoryTests(unittest.TestCase):
+    def test_write_read(self):
+        """
+        Records should be written in batches and read back correctly.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'history.bin')
+            h = EvaluationHistory(filename, 2, batch_size=2)
+            h.record([1.0, 2.0], [3.0, 4.0, 5.0], 50.0)
+            # Not written yet:
+            self.assertFalse(os.path.exists(filename))
+            h.record([1.5, 2.0], [0.0, 1.0, 0.0], 1.0, group=1, success=False)
+            data = read_history(filename)
+            self.assertEqual(len(data), 2)
+            h.record([2.0, 2.0], [1.0, 1.0, 1.0], 3.0)
+            self.assertEqual(len(read_history(filename)), 2)
+            h.flush()
+
+            data = read_history(filename)
+            self.assertEqual(len(data), 3)
+            np.testing.assert_allclose(data['x'], [[1.0, 2.0], [1.5, 2.0], [2.0, 2.0]])
+            np.testing.assert_allclose(data['f'][0], [3.0, 4.0, 5.0])
+            np.testing.assert_allclose(data['objective'], [50.0, 1.0, 3.0])
+            np.testing.assert_equal(data['group'], [0, 1, 0])
+            np.testing.assert_equal(data['success'], [1, 0, 1])
+            self.assertTrue(np.all(np.diff(data['time']) >= 0))
+
+            # Re-opening the file should append to it:
+            h = EvaluationHistory(filename, 2)
+            h.record([3.0, 2.0], [0.0, 0.0, 0.0], 0.0)
+            h.flush()
+            self.assertEqual(len(read_history(filename)), 4)
+
+            # The number of parameters must match:
+            with self.assertRaises(ValueError):
+                EvaluationHistory(filename, 3)
+
+    def test_failures_recorded(self):
+        """
+        Failed evaluations should be recorded with the penalty value.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'history.bin')
+            failer = Failer(fail_indices=(1,))
+            prob = LeastSquaresProblem([(failer, 0, 1)], fail=100.0)
+            prob.history = EvaluationHistory(filename, 2)
+            prob.f()
+            prob.jac()
+            prob.history.flush()
+            data = read_history(filename)
+            # 1 direct evaluation, then 3 for the 1-sided FD Jacobian:
+            self.assertEqual(len(data), 4)
+            np.testing.assert_equal(data['success'], [1, 0, 1, 1])
+            np.testing.assert_allclose(data['f'][1], [100.0, 100.0, 100.0])
+            np.testing.assert_allclose(data['objective'], [3.0, 30000.0, 3.0, 3.0])
+
+    def test_solve(self):
+        """
+        Every function evaluation of an optimization should be recorded.
+        """
+        for solver in ['serial', 'mpi']:
+            for grad in [True, False]:
+                with shared_tmpdir() as tmpdir:
+                    r = Rosenbrock()
+                    prob = LeastSquaresProblem([(r.terms, 0, 1)])
+                    if solver == 'serial':
+                        # Every process solves on its own, so each needs
+                        # its own file:
+                        filename = os.path.join(tmpdir, 'history{}.bin'.format(
+                            MPI.COMM_WORLD.rank))
+                        least_squares_serial_solve(prob, grad=grad, history_file=filename)
+                    else:
+                        # Only proc0_world writes the file:
+                        filename = os.path.join(tmpdir, 'history.bin')
+                        least_squares_mpi_solve(prob, MpiPartition(ngroups=1), grad=grad,
+                                                history_file=filename)
+                        MPI.COMM_WORLD.barrier()
+                    self.assertIsNone(prob.history)
+                    data = read_history(filename)
+                    self.assertGreaterEqual(len(data), 3)
+                    self.assertTrue(np.all(data['success'] == 1))
+                    best = np.argmin(data['objective'])
+                    np.testing.assert_allclose(data['x'][best], [1, 1], atol=1e-6)
+                    for j in range(len(data)):
+                        self.assertAlmostEqual(data['objective'][j],
+                                               np.dot(data['f'][j], data['f'][j]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
 import logging
-from simsopt.core.functions import Identity, Rosenbrock
+import numpy as np
+from simsopt.core.functions import Identity, Rosenbrock, Failer
+from simsopt.core.util import ObjectiveFailure
 from simsopt.core.optimizable import Target
 from simsopt.core.least_squares_problem import LeastSquaresProblem, LeastSquaresTerm
 
@@ -185,5 +187,35 @@ class LeastSquaresProblemTests(unittest.TestCase):
         with self.assertRaises(TypeError):
             prob = LeastSquaresProblem([7, 1])
 
+    def test_failures(self):
+        """
+        Verify that a failed function evaluation gives the penalty value
+        for every residual.
+        """
+        failer = Failer(nparams=2, nvals=3, fail_indices=[1])
+        prob = LeastSquaresProblem([(failer, 0, 1)], fail=1.0e8)
+        np.testing.assert_allclose(prob.f(), [1, 1, 1])
+        np.testing.assert_allclose(prob.f(), [1.0e8, 1.0e8, 1.0e8])
+        np.testing.assert_allclose(prob.f(), [1, 1, 1])
+        self.assertEqual(prob.nfailures, 1)
+
+        # If the very first evaluation fails, the number of residuals
+        # is unknown, so the failure is propagated:
+        failer = Failer(fail_indices=[0])
+        prob = LeastSquaresProblem([(failer, 0, 1)])
+        with self.assertRaises(ObjectiveFailure):
+            prob.f()
+
+    def test_failures_fd_jac(self):
+        """
+        Verify that a failed evaluation during finite differencing gives
+        a Jacobian column based on the penalty value.
+        """
+        failer = Failer(nparams=2, nvals=3, fail_indices=[2])
+        prob = LeastSquaresProblem([(failer, 0, 1)], fail=2.0)
+        prob.f()
+        jac = prob.jac(eps=0.5)
+        np.testing.assert_allclose(jac, [[2, 0], [2, 0], [2, 0]])
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 import logging
+import numpy as np
 from simsopt.core.functions import Identity, Rosenbrock
 from simsopt.core.optimizable import Target
 from simsopt.core.least_squares_problem import LeastSquaresProblem, LeastSquaresTerm
@@ -177,5 +178,39 @@ class LeastSquaresProblemTests(unittest.TestCase):
                 self.assertAlmostEqual(v[0], 1)
                 self.assertAlmostEqual(v[1], 1)
 
+    def test_solve_quadratic_bounds(self):
+        """
+        Minimize f(x,y) = (x - 1) ^ 2 + (y - 2) ^ 2 subject to x <= 0.5
+        and y >= 2.5. The optimum is at the corner (x,y)=(0.5,2.5).
+        """
+        for solver in solvers:
+            for grad in [True, False]:
+                iden1 = Identity()
+                iden2 = Identity(3.0)
+                iden1.maxs = np.array([0.5])
+                iden2.mins = np.array([2.5])
+                prob = LeastSquaresProblem([(iden1.J, 1, 1), (iden2.J, 2, 1)])
+                np.testing.assert_allclose(prob.dofs.maxs, [0.5, np.inf])
+                np.testing.assert_allclose(prob.dofs.mins, [-np.inf, 2.5])
+                solver(prob, grad=grad)
+                self.assertAlmostEqual(iden1.x, 0.5)
+                self.assertAlmostEqual(iden2.x, 2.5)
+                self.assertAlmostEqual(prob.objective(), 0.5)
+
+    def test_equal_bounds(self):
+        """
+        A dof with min == max cannot be passed to least_squares, so a
+        clear error should be raised before the optimization starts.
+        """
+        for solver in solvers:
+            iden1 = Identity()
+            iden2 = Identity()
+            iden2.names = ['y']
+            iden2.mins = np.array([1.0])
+            iden2.maxs = np.array([1.0])
+            prob = LeastSquaresProblem([(iden1.J, 1, 1), (iden2.J, 2, 1)])
+            with self.assertRaisesRegex(ValueError, 'y of'):
+                solver(prob)
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,16 @@
 import logging
+import time
 import unittest
 import numpy as np
 from mpi4py import MPI
 from simsopt.core.dofs import Dofs
 from simsopt.core.least_squares_problem import LeastSquaresProblem
-from simsopt.core.mpi import MpiPartition
-from simsopt.core.mpi_solve import fd_jac_mpi, least_squares_mpi_solve
+from simsopt.core.mpi import MpiPartition, MpiHierarchy, node_aware_groups, \
+    sizes_from_weights
+from simsopt.core.optimization_problem import OptimizationProblem
+from simsopt.core.mpi_solve import fd_jac_mpi, least_squares_mpi_solve, mpi_solve
+from simsopt.core.util import ObjectiveFailure
+from simsopt.core.functions import Affine
 
 #logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('[{}]'.format(MPI.COMM_WORLD.Get_rank()) + __name__)
@@ -74,7 +79,46 @@ class TestFunction3:
         self.comm.bcast(self.dummy)
         self.comm.barrier()
         return self.x[0] ** 2 - self.x[1]
+
+    def f(self):
+        return self.f0() ** 2 + self.f1() ** 2
     
+class TestFunction4:
+    """
+    This function fails whenever x[1] > 2, to test failure handling
+    in the parallel finite-difference Jacobian.
+    """
+    def __init__(self):
+        self.x = np.array([1.0, 2.0])
+
+    def get_dofs(self):
+        return self.x
+
+    def set_dofs(self, x):
+        self.x = x
+
+    def J(self):
+        if self.x[1] > 2.0:
+            raise ObjectiveFailure('x[1] is too large')
+        return np.array(self.x)
+
+class TestFunction5(TestFunction4):
+    """
+    Like TestFunction4, except that instead of failing, the function
+    takes delay seconds whenever x[0] > threshold, and always on the
+    process with rank slow_rank, to test time limits.
+    """
+    def __init__(self, slow_rank=None, delay=1.0, threshold=np.inf):
+        super().__init__()
+        self.slow_rank = slow_rank
+        self.delay = delay
+        self.threshold = threshold
+
+    def J(self):
+        if self.x[0] > self.threshold or MPI.COMM_WORLD.Get_rank() == self.slow_rank:
+            time.sleep(self.delay)
+        return np.array(self.x)
+
 class MpiPartitionTests(unittest.TestCase):
     def test_ngroups1(self):
         """
@@ -174,6 +218,135 @@ class MpiPartitionTests(unittest.TestCase):
                 m.comm_world.send(m.nprocs_groups, 0, tag=m.rank_world)
         m.write()
 
+    def test_node_aware_groups(self):
+        """
+        Groups should not span nodes when there are enough groups, and
+        should consist of whole nodes otherwise.
+        """
+        # 2 nodes with 4 processes each:
+        nodes = [0, 0, 0, 0, 1, 1, 1, 1]
+        np.testing.assert_equal(node_aware_groups(nodes, 1), [0] * 8)
+        np.testing.assert_equal(node_aware_groups(nodes, 2), [0, 0, 0, 0, 1, 1, 1, 1])
+        np.testing.assert_equal(node_aware_groups(nodes, 4), [0, 0, 1, 1, 2, 2, 3, 3])
+        # Block assignment would put ranks 2-4 in one group here:
+        np.testing.assert_equal(node_aware_groups(nodes, 3), [0, 0, 1, 1, 2, 2, 2, 2])
+        np.testing.assert_equal(node_aware_groups(nodes, 8), np.arange(8))
+        # Unequal nodes get groups in proportion to their size:
+        nodes = [0] * 6 + [1] * 2 + [2] * 4
+        groups = node_aware_groups(nodes, 6)
+        np.testing.assert_equal(groups, [0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5])
+        # Fewer groups than nodes:
+        groups = node_aware_groups(nodes, 2)
+        np.testing.assert_equal(groups, [0] * 6 + [0] * 2 + [1] * 4)
+
+    def test_node_aware(self):
+        """
+        On a single node, node-aware groups match the usual layout.
+        """
+        nprocs = MPI.COMM_WORLD.Get_size()
+        for ngroups in range(1, nprocs + 1):
+            m1 = MpiPartition(ngroups=ngroups)
+            m2 = MpiPartition(ngroups=ngroups, node_aware=True)
+            self.assertEqual(m2.nnodes, len(set(MPI.COMM_WORLD.allgather(MPI.Get_processor_name()))))
+            if m2.nnodes == 1:
+                self.assertEqual(m1.group, m2.group)
+                self.assertEqual(m2.nprocs_node, nprocs)
+            # Groups never span nodes:
+            nodes = m2.comm_groups.allgather(m2.node)
+            self.assertEqual(len(set(nodes)), 1)
+            m2.write()
+
+    def test_group_sizes(self):
+        """
+        Groups of different sizes can be requested explicitly or by
+        weights.
+        """
+        nprocs = MPI.COMM_WORLD.Get_size()
+        np.testing.assert_equal(sizes_from_weights([3, 1], 8), [6, 2])
+        np.testing.assert_equal(sizes_from_weights([100, 1, 1], 4), [2, 1, 1])
+        with self.assertRaises(ValueError):
+            sizes_from_weights([1, 1], 1)
+
+        sizes = [nprocs - 1, 1] if nprocs > 1 else [1]
+        m = MpiPartition(group_sizes=sizes)
+        self.assertEqual(m.ngroups, len(sizes))
+        self.assertEqual(m.nprocs_groups, sizes[m.group])
+        np.testing.assert_equal(m.group_sizes, sizes)
+        np.testing.assert_allclose(m.throughput, sizes)
+        m = MpiPartition(group_weights=[1] * nprocs)
+        self.assertEqual(m.nprocs_groups, 1)
+        with self.assertRaises(ValueError):
+            MpiPartition(group_sizes=[nprocs, 1])
+        with self.assertRaises(ValueError):
+            MpiPartition(group_sizes=[nprocs], group_weights=[1])
+
+    def test_schedule(self):
+        """
+        Faster groups should be given more evaluations.
+        """
+        nprocs = MPI.COMM_WORLD.Get_size()
+        m = MpiPartition()
+        np.testing.assert_equal(m.schedule(7), np.mod(np.arange(7), nprocs))
+        if nprocs < 2:
+            return
+        m = MpiPartition(ngroups=2, throughput=[1.0, 3.0])
+        owners = m.schedule(12)
+        self.assertEqual(owners[0], 0)
+        np.testing.assert_equal(np.bincount(owners), [3, 9])
+        # A Jacobian computed with unequal groups should be correct:
+        for sizes in [[1, nprocs - 1], [nprocs - 1, 1]]:
+            m = MpiPartition(group_sizes=sizes)
+            np.random.seed(0)
+            a = Affine(nparams=7, nvals=3)
+            jac = fd_jac_mpi(Dofs([a.J]), m)
+            if m.proc0_world:
+                np.testing.assert_allclose(jac, a.A, rtol=1e-6, atol=1e-6)
+
+    def test_summary(self):
+        """
+        The summary should describe the groups and leaders on proc0_world
+        only.
+        """
+        nprocs = MPI.COMM_WORLD.Get_size()
+        m = MpiPartition(ngroups=nprocs)
+        summary = m.summary()
+        if not m.proc0_world:
+            self.assertIsNone(summary)
+            return
+        lines = summary.split('\n')
+        self.assertIn('{} processes'.format(nprocs), lines[0])
+        self.assertIn('{} groups'.format(nprocs), lines[0])
+        self.assertIn('groups of each size: {} of 1'.format(nprocs), summary)
+        self.assertIn('groups spanning more than one node: 0', summary)
+        self.assertIn('leaders (rank_world): ' + ' '.join(str(j) for j in range(nprocs)), summary)
+
+    def test_shared_array(self):
+        """
+        A shared array should have the same values on every process, and
+        a write by one process should be seen by the others on the same
+        node.
+        """
+        m = MpiPartition()
+        data = np.arange(12.0).reshape(3, 4) if m.proc0_world else None
+        a = m.shared_array((3, 4), data=data)
+        np.testing.assert_equal(a, np.arange(12.0).reshape(3, 4))
+
+        b = m.shared_array(5, dtype=int)
+        self.assertEqual(b.shape, (5,))
+        if m.rank_node == m.nprocs_node - 1:
+            b[:] = 7
+        m.comm_node.Barrier()
+        np.testing.assert_equal(b, 7)
+        m.comm_node.Barrier()
+        m.free_shared()
+        self.assertFalse(hasattr(m, '_comm_node_leaders'))
+        m.free_shared()
+
+        # Shared arrays can be created again after free_shared():
+        c = m.shared_array(2, data=np.array([1.0, 2.0]) if m.proc0_world else None)
+        np.testing.assert_equal(c, [1.0, 2.0])
+        m.free_shared()
+
     def test_fd_jac(self):
         """
         Test the parallel finite-difference Jacobian calculation.
@@ -236,6 +409,129 @@ class MpiPartitionTests(unittest.TestCase):
             jac = d.fd_jac(centered=True, eps=1e-7)
             np.testing.assert_allclose(jac, jac_reference, rtol=1e-13, atol=1e-13)
             
+    def test_fd_jac_failure(self):
+        """
+        Verify that failed evaluations in the parallel finite-difference
+        Jacobian are replaced by the penalty value.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            o = TestFunction4()
+            d = Dofs([o])
+            d.f()
+            jac = fd_jac_mpi(d, mpi, eps=0.5, fail=10.0)
+            if mpi.proc0_world:
+                np.testing.assert_allclose(jac, [[1, 18], [0, 16]])
+
+    def test_fd_jac_timeout(self):
+        """
+        Points of a group that is late should be given to another
+        group, so proc0_world does not wait for the slow group.
+        """
+        nprocs = MPI.COMM_WORLD.Get_size()
+        slow_rank = nprocs - 1 if nprocs > 1 else None
+        delay = 2.0
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups, eval_timeout=0.2)
+            o = TestFunction5(slow_rank, delay=delay)
+            d = Dofs([o])
+            groups = []
+            callback = lambda x, f, success, group: groups.append((group, success))
+            start = time.time()
+            jac = fd_jac_mpi(d, mpi, eps=0.5, centered=True, callback=callback)
+            if mpi.proc0_world:
+                self.assertLess(time.time() - start, delay)
+                np.testing.assert_allclose(jac, np.eye(2))
+                self.assertEqual(len(groups), 4)
+                self.assertTrue(all(success for group, success in groups))
+
+    def test_fd_jac_auto(self):
+        """
+        With automatic steps, the noise level should be estimated once,
+        and the parallel Jacobian should match the serial one.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            np.random.seed(0)
+            a = Affine(nparams=3, nvals=2)
+            a.set_dofs(np.array([1.0, 2.0, -0.5]))
+            d = Dofs([a.J])
+            calls = []
+            callback = lambda x, f, success, group: calls.append(x)
+            jac = fd_jac_mpi(d, mpi, rel_eps='auto', callback=callback)
+            if not mpi.proc0_groups:
+                continue
+            self.assertGreater(d.fd_noise, 0)
+            self.assertLess(d.fd_noise, 1e-13)
+            if mpi.proc0_world:
+                self.assertEqual(len(calls), 8 + 4)
+                np.testing.assert_allclose(jac, a.A, rtol=1e-6, atol=1e-6)
+                np.testing.assert_allclose(jac, Dofs([a.J]).fd_jac(rel_eps='auto'))
+
+    def test_fd_jac_stencils(self):
+        """
+        The points of wide stencils should be shared among all groups, and
+        give the same Jacobian as the serial calculation.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            np.random.seed(0)
+            a = Affine(nparams=3, nvals=2)
+            d = Dofs([a.J])
+            for stencil, nevals in [('richardson', 7), ('4-point', 12)]:
+                calls = []
+                callback = lambda x, f, success, group: calls.append(group)
+                jac = fd_jac_mpi(d, mpi, stencil=stencil, eps=1e-3, callback=callback)
+                if mpi.proc0_world:
+                    self.assertEqual(len(calls), nevals)
+                    self.assertEqual(set(calls), set(range(mpi.ngroups)))
+                    np.testing.assert_allclose(jac, a.A, rtol=1e-10)
+                    np.testing.assert_allclose(jac, d.fd_jac(stencil=stencil, eps=1e-3))
+
+    def test_fd_jac_sparse(self):
+        """
+        For functions of disjoint sets of dofs, the parallel
+        finite-difference Jacobian should perturb independent dofs
+        together and agree with the analytic Jacobian.
+        """
+        np.random.seed(0)
+        a1 = Affine(2, 3)
+        a2 = Affine(3, 2)
+        d = Dofs([a1.J, a2.J])
+        jac = d.jac()
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            for centered in [False, True]:
+                calls = []
+                callback = lambda x, f, success, group: calls.append(x)
+                fd_jac = fd_jac_mpi(d, mpi, centered=centered, callback=callback)
+                if mpi.proc0_world:
+                    np.testing.assert_allclose(fd_jac, jac, rtol=1e-6, atol=1e-6)
+                    self.assertEqual(len(calls), 6 if centered else 4)
+
+    def test_fd_jac_callback(self):
+        """
+        Verify that proc0_world reports every function evaluation of the
+        parallel finite-difference Jacobian to the callback.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            o = TestFunction4()
+            d = Dofs([o])
+            d.f()
+            calls = []
+            callback = lambda x, f, success, group: \
+                calls.append((np.copy(x), np.copy(f), success, group))
+            fd_jac_mpi(d, mpi, eps=0.5, fail=10.0, callback=callback)
+            if not mpi.proc0_world:
+                self.assertEqual(calls, [])
+                continue
+            self.assertEqual(len(calls), 3)
+            np.testing.assert_allclose(calls[2][0], [1.0, 2.5])
+            np.testing.assert_allclose(calls[2][1], [10.0, 10.0])
+            self.assertEqual([c[2] for c in calls], [True, True, False])
+            self.assertEqual([c[3] for c in calls], [j % mpi.ngroups for j in range(3)])
+
     def test_parallel_optimization(self):
         """
         Test a full least-squares optimization.
@@ -250,4 +546,106 @@ class MpiPartitionTests(unittest.TestCase):
                 least_squares_mpi_solve(prob, mpi, grad=grad)
                 self.assertAlmostEqual(prob.x[0], 1)
                 self.assertAlmostEqual(prob.x[1], 1)
-                
+
+    def test_parallel_optimization_bounds(self):
+        """
+        Test a full least-squares optimization with a bound constraint
+        that is active at the optimum.
+        """
+        for ngroups in range(1, 4):
+            for grad in [True, False]:
+                mpi = MpiPartition(ngroups=ngroups)
+                o = TestFunction3(mpi.comm_groups)
+                o.maxs = np.array([0.5, np.inf])
+                prob = LeastSquaresProblem([(o.f0, 0, 1), (o.f1, 0, 1)])
+                least_squares_mpi_solve(prob, mpi, grad=grad)
+                self.assertAlmostEqual(prob.x[0], 0.5)
+                self.assertAlmostEqual(prob.x[1], 0.25)
+
+    def test_parallel_optimization_infeasible(self):
+        """
+        If the initial state vector is outside the bounds, every process
+        should raise ValueError, rather than only proc0_world, which
+        would leave the other processes waiting in their loops.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            o = TestFunction3(mpi.comm_groups)
+            o.x = [2.0, 0.0]
+            o.maxs = np.array([1.0, np.inf])
+            o.names = ['x', 'y']
+            prob = LeastSquaresProblem([(o.f0, 0, 1), (o.f1, 0, 1)])
+            with self.assertRaisesRegex(ValueError, 'x of'):
+                least_squares_mpi_solve(prob, mpi)
+
+    def test_parallel_optimization_timeout(self):
+        """
+        Evaluations of the objective on proc0_world that take longer than
+        eval_timeout should be logged, but their results should be kept,
+        so the optimizer can still move through the region where the
+        evaluations are slow.
+        """
+        name = '[{}]simsopt.core.mpi_solve'.format(MPI.COMM_WORLD.Get_rank())
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups, eval_timeout=0.02)
+            o = TestFunction5(delay=0.05, threshold=0.5)
+            o.x = np.array([1.0, 0.0])
+            prob = LeastSquaresProblem([(o.J, 0, 1)])
+            if mpi.proc0_world:
+                with self.assertLogs(name, level='WARNING'):
+                    least_squares_mpi_solve(prob, mpi)
+                self.assertEqual(prob.nfailures, 0)
+            else:
+                least_squares_mpi_solve(prob, mpi)
+            np.testing.assert_allclose(prob.x, [0, 0], atol=1e-6)
+
+    def test_parallel_scalar_optimization(self):
+        """
+        Test a full optimization of a scalar objective with parallel
+        finite-difference gradients.
+        """
+        for ngroups in range(1, 4):
+            mpi = MpiPartition(ngroups=ngroups)
+            o = TestFunction3(mpi.comm_groups)
+            o.maxs = np.array([0.5, np.inf])
+            prob = OptimizationProblem([o.f])
+            mpi_solve(prob, mpi)
+            np.testing.assert_allclose(prob.x, [0.5, 0.25], atol=1e-4)
+
+class MpiHierarchyTests(unittest.TestCase):
+    def test_levels(self):
+        """
+        Each level should partition the groups of the level above.
+        """
+        nprocs = MPI.COMM_WORLD.Get_size()
+        for n0 in range(1, nprocs + 1):
+            for n1 in range(1, nprocs + 1):
+                h = MpiHierarchy([n0, n1, None])
+                self.assertEqual(len(h), 3)
+                self.assertEqual(h.ngroups[0], n0)
+                self.assertEqual(h[1].comm_world.Get_size(), h[0].nprocs_groups)
+                self.assertEqual(h[2].comm_world.Get_size(), h[1].nprocs_groups)
+                # The innermost groups have 1 process each:
+                self.assertEqual(h.comm_groups.Get_size(), 1)
+                # Every process belongs to exactly one path of groups:
+                paths = MPI.COMM_WORLD.allgather(h.groups)
+                self.assertEqual(len(set(paths)), nprocs)
+                self.assertEqual(len(set(p[0] for p in paths)), n0)
+
+    def test_nested_fd_jac(self):
+        """
+        Each top-level group should be able to compute a parallel
+        finite-difference Jacobian independently, using the next level.
+        """
+        nprocs = MPI.COMM_WORLD.Get_size()
+        for n0 in range(1, nprocs + 1):
+            h = MpiHierarchy([n0, None])
+            np.random.seed(0)
+            a = Affine(nparams=4, nvals=3)
+            # Each top-level group uses a different point:
+            x = np.full(4, float(h.groups[0]))
+            jac = fd_jac_mpi(Dofs([a.J]), h[1], x=x)
+            if h[1].proc0_world:
+                np.testing.assert_allclose(jac, a.A, rtol=1e-6, atol=1e-6)
+            else:
+                self.assertIsNone(jac)
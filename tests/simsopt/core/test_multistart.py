@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+from mpi4py import MPI
+from simsopt.core.least_squares_problem import LeastSquaresProblem
+from simsopt.core.optimization_problem import OptimizationProblem
+from simsopt.core.mpi_solve import mpi_solve
+from simsopt.core.multistart import multistart_mpi_solve, uniform_sampler
+
+class DoubleWell:
+    """
+    A function of one variable with a local minimum near x = -1 and
+    the global minimum at x = 1. Some MPI communication is added to
+    test that each super-group uses its own communicators.
+    """
+    def __init__(self, comm):
+        self.comm = comm
+        self.x = np.array([0.0])
+
+    def get_dofs(self):
+        return self.x
+
+    def set_dofs(self, x):
+        self.x = np.array(x)
+
+    def terms(self):
+        self.comm.barrier()
+        x = self.comm.bcast(self.x[0])
+        return np.array([x * x - 1, 0.3 * (x - 1)])
+
+    def f(self):
+        return np.sum(self.terms() ** 2)
+
+def make_prob(mpi):
+    return LeastSquaresProblem([(DoubleWell(mpi.comm_groups).terms, 0, 1)])
+
+class MultistartTests(unittest.TestCase):
+    def test_list(self):
+        """
+        Solve from a list of starting points, for every number of
+        super-groups.
+        """
+        starts = [[-2.0], [-0.5], [0.5], [2.0], [-1.5]]
+        for nsupergroups in range(1, MPI.COMM_WORLD.Get_size() + 1):
+            results = multistart_mpi_solve(make_prob, starts,
+                                           nsupergroups=nsupergroups)
+            self.assertEqual(sorted(r['start'] for r in results), list(range(5)))
+            self.assertAlmostEqual(results[0]['x'][0], 1.0, places=4)
+            self.assertAlmostEqual(results[0]['objective'], 0.0, places=8)
+            # Starts at negative x end in the local minimum:
+            for r in results:
+                if r['x0'][0] < -1:
+                    self.assertLess(r['x'][0], 0)
+                    self.assertGreater(r['objective'], 0.01)
+
+    def test_sampler(self):
+        """
+        Starting points can come from a sampler, with any solver.
+        """
+        sampler = uniform_sampler([-2.0], [2.0], seed=3)
+        np.testing.assert_allclose(sampler(4), sampler(4))
+        def make_scalar_prob(mpi):
+            return OptimizationProblem([DoubleWell(mpi.comm_groups).f])
+        results = multistart_mpi_solve(make_scalar_prob, sampler, nstarts=4,
+                                       solver=mpi_solve)
+        self.assertEqual(len(results), 4)
+        for r in results:
+            self.assertTrue(-2 <= r['x0'][0] <= 2)
+        self.assertLessEqual(results[0]['objective'], results[-1]['objective'])
+
+        with self.assertRaises(ValueError):
+            multistart_mpi_solve(make_prob, sampler)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,8 @@
 import unittest
 import numpy as np
-from simsopt.core.optimizable import Optimizable
-from simsopt.core.functions import Adder
+from simsopt.core.optimizable import Optimizable, optimizable
+from simsopt.core.functions import Adder, TestObject1
+from simsopt.core.dofs import combined_version
 
 class OptimizableTests(unittest.TestCase):
     def test_index(self):
@@ -39,6 +40,61 @@ class OptimizableTests(unittest.TestCase):
         self.assertTrue(o.get_fixed('gee'))
         o.set_fixed('gee', False)
         self.assertFalse(o.get_fixed('gee'))
+
+    def test_version(self):
+        """
+        The version counter should be incremented only when set_dofs()
+        actually changes the dofs.
+        """
+        o = Adder(3)
+        self.assertEqual(o.version, 0)
+        o.set_dofs([1.0, 2.0, 3.0])
+        self.assertEqual(o.version, 1)
+        o.set_dofs([1.0, 2.0, 3.0])
+        self.assertEqual(o.version, 1)
+        o.set_dofs([4.0, 2.0, 3.0])
+        self.assertEqual(o.version, 2)
+        o.dofs_changed()
+        self.assertEqual(o.version, 3)
+
+        # Objects made optimizable with optimizable() should also be
+        # tracked:
+        class Foo():
+            def __init__(self):
+                self.x = np.zeros(2)
+            def get_dofs(self):
+                return self.x
+            def set_dofs(self, x):
+                self.x = np.array(x)
+        f = optimizable(Foo())
+        f.set_dofs([1.0, 0.0])
+        self.assertEqual(f._version, 1)
+        f.set_dofs([1.0, 0.0])
+        self.assertEqual(f._version, 1)
+
+    def test_combined_version(self):
+        """
+        The combined version should change when the dofs of any object
+        in the dependency tree change.
+        """
+        o = TestObject1(1.0)
+        v0 = combined_version(o)
+        self.assertEqual(len(v0), 3)
+        o.set_dofs([1.0])
+        self.assertEqual(combined_version(o), v0)
+        o.adder2.set_dofs([1.0, 2.0])
+        v1 = combined_version(o)
+        self.assertNotEqual(v1, v0)
+        o.set_dofs([2.0])
+        v2 = combined_version(o)
+        self.assertNotEqual(v2, v1)
+        # Replacing a dependency by an object with the same version
+        # counter is also a change, but reassigning the same one is not:
+        o.adder1 = Adder(3)
+        v3 = combined_version(o)
+        self.assertNotEqual(v3, v2)
+        o.adder1 = o.adder1
+        self.assertEqual(combined_version(o), v3)
         
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import numpy as np
+from simsopt.core.optimization_problem import OptimizationProblem
+from simsopt.core.serial_solve import serial_solve
+from simsopt.core.mpi import MpiPartition
+from simsopt.core.mpi_solve import mpi_solve
+from simsopt.core.functions import Identity, Adder, Rosenbrock, Failer
+
+def mpi_solve_1group(prob, **kwargs):
+    mpi_solve(prob, MpiPartition(ngroups=1), **kwargs)
+
+class OptimizationProblemTests(unittest.TestCase):
+    def test_init(self):
+        """
+        Terms can be given as functions, objects with a J() function, or
+        tuples with a weight.
+        """
+        iden = Identity(2.0)
+        adder = Adder(2)
+        adder.set_dofs([1.0, 3.0])
+        prob = OptimizationProblem([iden, (adder.J, 2), (iden, 'f', -0.5)])
+        self.assertEqual(prob.weights, [1.0, 2.0, -0.5])
+        self.assertAlmostEqual(prob.objective(), 2.0 + 8.0 - 1.0)
+        self.assertEqual(prob.dofs.nparams, 3)
+
+        with self.assertRaises(TypeError):
+            OptimizationProblem([(iden, 'foo')])
+        with self.assertRaises(ValueError):
+            OptimizationProblem([(iden, 'f', 1, 2)])
+        with self.assertRaises(ValueError):
+            OptimizationProblem([])
+
+    def test_grad(self):
+        """
+        The analytic and finite-difference gradients should agree.
+        """
+        iden = Identity(1.5)
+        adder = Adder(3)
+        adder.set_dofs([1.0, -2.0, 0.5])
+        prob = OptimizationProblem([(adder, 2.0), (iden, -1.0)])
+        prob.objective()
+        np.testing.assert_allclose(prob.grad(), [2, 2, 2, -1])
+        np.testing.assert_allclose(prob.grad(analytic=False), [2, 2, 2, -1],
+                                   rtol=1e-6)
+
+    def test_failure(self):
+        """
+        A failed evaluation should return the fail value.
+        """
+        failer = Failer(nparams=2, nvals=2, fail_indices=(1,))
+        prob = OptimizationProblem([failer], fail=1.0e6)
+        self.assertAlmostEqual(prob.objective(), 2.0)
+        self.assertAlmostEqual(prob.objective(), 1.0e6)
+        self.assertAlmostEqual(prob.objective(), 2.0)
+        self.assertEqual(prob.nfailures, 1)
+
+    def test_solve_rosenbrock(self):
+        """
+        Minimize the Rosenbrock function, which is not posed as a
+        least-squares problem here.
+        """
+        for solver in [serial_solve, mpi_solve_1group]:
+            for grad in [True, False]:
+                r = Rosenbrock()
+                prob = OptimizationProblem([r.f])
+                solver(prob, grad=grad)
+                np.testing.assert_allclose(prob.x, [1.0, 1.0], atol=1e-3)
+            # Finite-difference steps can be chosen:
+            r = Rosenbrock()
+            prob = OptimizationProblem([r.f])
+            solver(prob, grad=False, fd_kwargs={'centered': True, 'rel_eps': 1e-6})
+            np.testing.assert_allclose(prob.x, [1.0, 1.0], atol=1e-3)
+
+    def test_solve_bounds(self):
+        """
+        Minimize a linear function with a bound constraint, using
+        analytic derivatives for some functions but not others.
+        """
+        for solver in [serial_solve, mpi_solve_1group]:
+            for method in ['L-BFGS-B', 'trust-constr']:
+                iden1 = Identity(3.0)
+                iden2 = Identity(1.0)
+                iden1.mins = np.array([2.0])
+                iden2.mins = np.array([-1.0])
+                iden2.maxs = np.array([1.0])
+                prob = OptimizationProblem([(iden1, 1.0), (iden2, 'f', -2.0)])
+                solver(prob, method=method)
+                np.testing.assert_allclose(prob.x, [2.0, 1.0], atol=1e-3)
+
+if __name__ == "__main__":
+    unittest.main()
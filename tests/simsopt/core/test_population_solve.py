@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+from mpi4py import MPI
+from simsopt.core.least_squares_problem import LeastSquaresProblem
+from simsopt.core.optimization_problem import OptimizationProblem
+from simsopt.core.mpi import MpiPartition
+from simsopt.core.population_solve import CMAES, cmaes_mpi_solve, \
+    differential_evolution_mpi_solve
+from simsopt.core.functions import Rosenbrock, Identity
+
+def bounded_rosenbrock():
+    r = Rosenbrock()
+    r.mins = np.array([-2.0, -2.0])
+    r.maxs = np.array([2.0, 2.0])
+    return r
+
+class CMAESTests(unittest.TestCase):
+    def test_quadratic(self):
+        """
+        The ask/tell interface should find the minimum of a quadratic.
+        """
+        center = np.array([1.0, -2.0, 0.5])
+        es = CMAES(np.zeros(3), 0.5, seed=0)
+        for j in range(150):
+            xs = es.ask()
+            es.tell(xs, np.sum((xs - center) ** 2, axis=1))
+        np.testing.assert_allclose(es.mean, center, atol=1e-5)
+
+    def test_bounds(self):
+        """
+        Points should never leave the bounds.
+        """
+        es = CMAES(np.zeros(2), 10.0, mins=np.array([-1.0, 0.0]),
+                   maxs=np.array([1.0, 0.5]), seed=1)
+        xs = es.ask()
+        self.assertTrue(np.all(xs[:, 0] >= -1) and np.all(xs[:, 0] <= 1))
+        self.assertTrue(np.all(xs[:, 1] >= 0) and np.all(xs[:, 1] <= 0.5))
+
+class PopulationSolveTests(unittest.TestCase):
+    def test_rosenbrock(self):
+        """
+        Both optimizers should find the minimum of the Rosenbrock
+        function, for any number of groups.
+        """
+        for ngroups in range(1, MPI.COMM_WORLD.Get_size() + 1):
+            mpi = MpiPartition(ngroups=ngroups)
+            r = bounded_rosenbrock()
+            prob = LeastSquaresProblem([(r.terms, 0, 1)])
+            cmaes_mpi_solve(prob, mpi, sigma0=0.5, popsize=8, maxiter=300, seed=0)
+            np.testing.assert_allclose(prob.x, [1.0, 1.0], atol=1e-4)
+
+            r = bounded_rosenbrock()
+            prob = OptimizationProblem([r.f])
+            differential_evolution_mpi_solve(prob, mpi, seed=0, tol=1e-10,
+                                             polish=True)
+            np.testing.assert_allclose(prob.x, [1.0, 1.0], atol=1e-4)
+
+    def test_unbounded(self):
+        """
+        Differential evolution requires finite bounds.
+        """
+        iden = Identity()
+        prob = OptimizationProblem([iden])
+        with self.assertRaises(ValueError):
+            differential_evolution_mpi_solve(prob, MpiPartition(ngroups=1))
+
+if __name__ == "__main__":
+    unittest.main()
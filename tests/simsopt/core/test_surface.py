@@ -1,10 +1,17 @@
 import unittest
 import os
+import sys
+import subprocess
+from mpi4py import MPI
 from simsopt.core.surface import *
 from simsopt.core.dofs import Dofs
 from simsopt.core.optimizable import optimizable
 from . import TEST_DIR
 
+# mpiexec sets these even for a single process:
+under_mpiexec = MPI.COMM_WORLD.Get_size() > 1 or \
+    any(name in os.environ for name in ('OMPI_COMM_WORLD_SIZE', 'PMI_SIZE', 'PMIX_RANK'))
+
 class SurfaceTests(unittest.TestCase):
     def test_init(self):
         """
@@ -33,6 +40,20 @@ class SurfaceTests(unittest.TestCase):
         self.assertEqual(s.nfp, 5)
         self.assertTrue(s.stelsym)
 
+    @unittest.skipIf(under_mpiexec, "A subprocess that imports mpi4py hangs under mpiexec")
+    def test_lazy_jax(self):
+        """
+        jax should not be imported until the first area or volume
+        calculation.
+        """
+        code = ("import sys, simsopt; "
+                "assert 'jax' not in sys.modules; "
+                "s = simsopt.SurfaceRZFourier(); "
+                "assert 'jax' not in sys.modules; "
+                "s.volume(); "
+                "assert 'jax' in sys.modules")
+        subprocess.run([sys.executable, '-c', code], check=True)
+
 class SurfaceRZFourierTests(unittest.TestCase):
     def test_init(self):
         s = SurfaceRZFourier(nfp=2, mpol=3, ntor=2)
@@ -59,6 +80,24 @@ class SurfaceRZFourierTests(unittest.TestCase):
         self.assertAlmostEqual(s.area(), true_area, places=4)
         self.assertAlmostEqual(s.volume(), true_volume, places=3)
 
+    def test_recalculate(self):
+        """
+        The area and volume should be recomputed only after the dofs
+        change.
+        """
+        s = SurfaceRZFourier()
+        volume0 = s.volume()
+        version = s.version
+        s.set_dofs(s.get_dofs())
+        self.assertEqual(s.version, version)
+        s.set_rc(1, 0, 0.2)
+        self.assertGreater(s.version, version)
+        self.assertAlmostEqual(s.volume(), 2 * volume0, places=6)
+        x = s.get_dofs()
+        x[0] = 2.0
+        s.set_dofs(x)
+        self.assertAlmostEqual(s.volume(), 4 * volume0, places=6)
+
     def test_get_dofs(self):
         """
         Test that we can convert the degrees of freedom into a 1D vector
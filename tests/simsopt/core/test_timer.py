@@ -0,0 +1,116 @@
+import unittest
+import time
+import numpy as np
+from simsopt.core import timer
+from simsopt.core.least_squares_problem import LeastSquaresProblem
+from simsopt.core.serial_solve import least_squares_serial_solve
+from simsopt.core.mpi import MpiPartition
+from simsopt.core.mpi_solve import least_squares_mpi_solve
+
+class Quadratic:
+    """
+    A function with no analytic gradient, so finite differences are used.
+    """
+    def __init__(self):
+        self.x = np.array([0.0, 0.0])
+
+    def get_dofs(self):
+        return self.x
+
+    def set_dofs(self, x):
+        self.x = np.array(x)
+
+    def J(self):
+        return self.x - np.array([1.0, 2.0])
+
+@timer.timed('sleeper')
+def sleeper():
+    time.sleep(0.01)
+
+class TimerTests(unittest.TestCase):
+    def setUp(self):
+        timer.reset()
+
+    def tearDown(self):
+        timer.disable()
+        timer.reset()
+
+    def test_disabled(self):
+        """
+        Nothing should be recorded when timing is off.
+        """
+        self.assertFalse(timer.enabled())
+        with timer.section('a'):
+            sleeper()
+        self.assertEqual(timer.totals(), {})
+
+    def test_sections(self):
+        """
+        Nested sections should be recorded under their paths.
+        """
+        timer.enable()
+        with timer.section('outer'):
+            sleeper()
+            with timer.section('inner'):
+                sleeper()
+                sleeper()
+        with self.assertRaises(ValueError):
+            with timer.section('outer'):
+                raise ValueError()
+        totals = timer.totals()
+        self.assertEqual(set(totals.keys()),
+                         {'outer', 'outer/sleeper', 'outer/inner',
+                          'outer/inner/sleeper'})
+        self.assertEqual(totals['outer'][0], 2)
+        self.assertEqual(totals['outer/sleeper'][0], 1)
+        self.assertEqual(totals['outer/inner/sleeper'][0], 2)
+        self.assertGreaterEqual(totals['outer/inner/sleeper'][1], 0.02)
+        self.assertGreaterEqual(totals['outer'][1], totals['outer/inner'][1])
+
+        # The table should list each section once, children after parents:
+        lines = timer.summary().split('\n')
+        self.assertEqual([l.split()[0] for l in lines[1:]],
+                         ['outer', 'inner', 'sleeper', 'sleeper'])
+
+    def test_combine(self):
+        """
+        Check the statistics across processes.
+        """
+        stats = timer.combine([{'a': (2, 1.0), 'a/b': (1, 0.5)},
+                               {'a': (3, 3.0)}])
+        self.assertEqual(stats['a']['calls'], 5)
+        self.assertEqual(stats['a']['nprocs'], 2)
+        self.assertAlmostEqual(stats['a']['min'], 1.0)
+        self.assertAlmostEqual(stats['a']['mean'], 2.0)
+        self.assertAlmostEqual(stats['a']['max'], 3.0)
+        self.assertEqual(stats['a/b']['nprocs'], 1)
+
+    def test_solve(self):
+        """
+        The main stages of a solve should be timed.
+        """
+        timer.enable()
+        for solver in ['serial', 'mpi']:
+            timer.reset()
+            prob = LeastSquaresProblem([(Quadratic(), 0, 1)])
+            if solver == 'serial':
+                least_squares_serial_solve(prob, grad=True)
+            else:
+                mpi = MpiPartition(ngroups=1)
+                least_squares_mpi_solve(prob, mpi, grad=True)
+            mpi = MpiPartition(ngroups=1)
+            stats = timer.gather(mpi)
+            if not mpi.proc0_world:
+                continue
+            for path in ['scipy.least_squares',
+                         'scipy.least_squares/Dofs.set',
+                         'scipy.least_squares/Dofs.f',
+                         'scipy.least_squares/Jacobian assembly']:
+                self.assertIn(path, stats)
+            if solver == 'serial':
+                self.assertIn('scipy.least_squares/fd_jac/Dofs.f', stats)
+            else:
+                self.assertIn('scipy.least_squares/fd_jac_mpi/Dofs.f', stats)
+
+if __name__ == "__main__":
+    unittest.main()
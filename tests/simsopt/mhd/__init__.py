@@ -1,4 +1,9 @@
 import os
+from mpi4py import MPI
 
 TEST_DIR = os.path.join(os.path.dirname(__file__), "..", "..", 
                         "test_files")
+
+# mpiexec sets these even for a single process:
+under_mpiexec = MPI.COMM_WORLD.Get_size() > 1 or \
+    any(name in os.environ for name in ('OMPI_COMM_WORLD_SIZE', 'PMI_SIZE', 'PMIX_RANK'))
@@ -1,8 +1,14 @@
 import unittest
+import copy
+from unittest import mock
+import sys
 import numpy as np
 import os
 from simsopt.mhd.vmec import *
+from simsopt.core.util import ObjectiveFailure
+from simsopt.mhd.vmec_pool import VmecPool
 from . import TEST_DIR
+from .test_vmec_pool import FakeVmec, BarrierFakeVmec, PoolTestCase
 
 @unittest.skipIf(not vmec_found, "Valid Python interface to VMEC not found")
 class VmecTests(unittest.TestCase):
@@ -55,6 +61,44 @@ class VmecTests(unittest.TestCase):
 
         v.finalize()
 
+    def test_failure(self):
+        """
+        Verify that a boundary for which VMEC cannot converge raises
+        ObjectiveFailure after the retries, rather than returning
+        stale output.
+        """
+        v = Vmec()
+        v.max_retries = 1
+        # Minor radius larger than the major radius:
+        v.boundary.set_rc(1, 0, 2.0)
+        with self.assertRaises(ObjectiveFailure):
+            v.aspect()
+        self.assertFalse(v.success)
+        self.assertEqual(len(v.failures), 2)
+        # A second request should fail without re-running VMEC:
+        with self.assertRaises(ObjectiveFailure):
+            v.volume()
+        self.assertEqual(len(v.failures), 2)
+        v.finalize()
+
+    def test_pool(self):
+        """
+        Two Vmec objects using a VmecPool can be live at the same time.
+        """
+        filename = os.path.join(TEST_DIR, 'input.li383_low_res')
+        with VmecPool(nworkers=2) as pool:
+            v1 = Vmec(filename, pool=pool)
+            v2 = Vmec(pool=pool)
+            self.assertEqual(v1.nfp, 3)
+            self.assertEqual(v2.nfp, 5)
+            v2.boundary.set_rc(0, 0, 2.0)
+            aspect1 = v1.aspect()
+            aspect2 = v2.aspect()
+            self.assertGreater(aspect1, 0)
+            self.assertNotAlmostEqual(aspect1, aspect2)
+            v1.finalize()
+            v2.finalize()
+
     #def test_stellopt_scenarios_1DOF_circularCrossSection_varyR0_targetVolume(self):
         """
         This script implements the "1DOF_circularCrossSection_varyR0_targetVolume"
@@ -125,5 +169,70 @@ class VmecTests(unittest.TestCase):
 
         equil.finalize()
 """     
+class VmecFakePoolTests(PoolTestCase):
+    """
+    Tests of Vmec objects that run through a VmecPool, using a fake
+    VMEC backend so they do not need the VMEC extension.
+    """
+    def test_pool(self):
+        """
+        Vmec objects using a pool should send their dofs to the worker
+        and report the output and failures of each run.
+        """
+        with VmecPool(nworkers=2, backend=FakeVmec) as pool:
+            v1 = Vmec('input.2', pool=pool)
+            v2 = Vmec('input.5', pool=pool)
+            self.assertEqual(v1.nfp, 2)
+            self.assertEqual(v2.nfp, 5)
+            self.assertAlmostEqual(v1.aspect(), 10.0)
+            v1.boundary.set_rc(1, 0, 0.25)
+            self.assertTrue(v1.need_to_run_code)
+            self.assertAlmostEqual(v1.aspect(), 4.0)
+            self.assertAlmostEqual(v2.iota_edge(), 1.5)
+
+            # A new boundary with the same version counter:
+            boundary = copy.deepcopy(v1.boundary)
+            boundary.rc[1, v1.ntor] = 0.5
+            v1.boundary = boundary
+            self.assertTrue(v1.need_to_run_code)
+            self.assertAlmostEqual(v1.aspect(), 2.0)
+
+            # A boundary that does not converge is retried, then fails:
+            v2.boundary.set_rc(1, 0, 2.0)
+            with self.assertRaises(ObjectiveFailure):
+                v2.aspect()
+            self.assertEqual(len(v2.failures), v2.max_retries + 1)
+            v1.finalize()
+            v2.finalize()
+
+    def test_pool_run(self):
+        """
+        VmecPool.run() should run several Vmec objects at the same time.
+        BarrierFakeVmec only converges if both runs overlap.
+        """
+        with VmecPool(nworkers=2, backend=BarrierFakeVmec) as pool:
+            v1 = Vmec('input.2', pool=pool)
+            v2 = Vmec('input.5', pool=pool)
+            v2.boundary.set_rc(1, 0, 0.5)
+            pool.run([v1, v2])
+            self.assertFalse(v1.need_to_run_code)
+            self.assertFalse(v2.need_to_run_code)
+            self.assertAlmostEqual(v1.aspect(), 10.0)
+            self.assertAlmostEqual(v2.aspect(), 2.0)
+
+class VmecImportTests(unittest.TestCase):
+    def test_import_error(self):
+        """
+        If the VMEC extension cannot be imported, creating a Vmec object
+        without a pool should raise RuntimeError, with the ImportError as
+        its cause.
+        """
+        # A None entry in sys.modules makes the import fail:
+        with mock.patch.dict(sys.modules, {'simsopt.mhd.vmec_f90wrap': None}):
+            with mock.patch('simsopt.mhd.vmec.vmec_found', True):
+                with self.assertRaises(RuntimeError) as context:
+                    Vmec()
+        self.assertIsInstance(context.exception.__cause__, ImportError)
+
 if __name__ == "__main__":
     unittest.main()
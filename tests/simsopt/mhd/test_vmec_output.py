@@ -0,0 +1,84 @@
+import unittest
+import pickle
+import numpy as np
+from simsopt.core.util import Struct
+from simsopt.mhd.vmec_output import VmecOutput
+
+class CountingWout:
+    """
+    A stand-in for VMEC's read_wout_mod module, which counts how many
+    times each quantity is read.
+    """
+    def __init__(self):
+        self.reads = {}
+        self.data = {'ns': 5,
+                     'aspect': 6.5,
+                     'iotaf': np.array([0.4, 0.45, 0.5, 0.55, 0.6]),
+                     'vp': np.array([0.0, 1.0, 2.0, 3.0, 4.0])}
+
+    def __getattr__(self, name):
+        if name in ('reads', 'data') or name not in self.data:
+            raise AttributeError(name)
+        self.reads[name] = self.reads.get(name, 0) + 1
+        return self.data[name]
+
+class VmecOutputTests(unittest.TestCase):
+    def test_lazy_cached(self):
+        """
+        Each quantity should be read from wout only once, and only when
+        it is first needed.
+        """
+        wout = CountingWout()
+        output = VmecOutput(wout)
+        self.assertEqual(wout.reads, {})
+        self.assertEqual(output.aspect, 6.5)
+        self.assertEqual(output.aspect, 6.5)
+        self.assertEqual(wout.reads, {'aspect': 1})
+        output.iotaf
+        output.iota(0.5)
+        output.iota_prime(0.5)
+        self.assertEqual(wout.reads['iotaf'], 1)
+        with self.assertRaises(AttributeError):
+            output.not_a_wout_quantity
+
+    def test_copy(self):
+        """
+        Arrays should be copied, so later changes to the fortran memory
+        do not affect the snapshot.
+        """
+        wout = CountingWout()
+        output = VmecOutput(wout)
+        iotaf = output.iotaf
+        wout.data['iotaf'][:] = 0
+        np.testing.assert_allclose(output.iotaf, iotaf)
+        self.assertGreater(output.iotaf[0], 0)
+
+    def test_profiles(self):
+        """
+        Check the interpolation helpers for radial profiles.
+        """
+        output = VmecOutput(CountingWout())
+        np.testing.assert_allclose(output.s_full, [0, 0.25, 0.5, 0.75, 1])
+        np.testing.assert_allclose(output.s_half, [0.125, 0.375, 0.625, 0.875])
+        self.assertAlmostEqual(output.iota(0), 0.4)
+        self.assertAlmostEqual(output.iota(1), 0.6)
+        np.testing.assert_allclose(output.iota([0.125, 0.6]), [0.425, 0.52])
+        np.testing.assert_allclose(output.iota_prime([0.1, 0.5, 0.9]), [0.2, 0.2, 0.2])
+        np.testing.assert_allclose(output.vprime([0.125, 0.5]), [1.0, 2.5])
+
+    def test_load_all(self):
+        """
+        After load_all, the snapshot no longer needs the wout object and
+        can be pickled.
+        """
+        wout = CountingWout()
+        output = VmecOutput(wout)
+        output.load_all(['ns', 'iotaf'])
+        output2 = pickle.loads(pickle.dumps(output))
+        self.assertEqual(output2.ns, 5)
+        self.assertAlmostEqual(output2.iota(0.5), 0.5)
+        with self.assertRaises(AttributeError):
+            output2.aspect
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+import unittest
+import os
+import time
+import tempfile
+import numpy as np
+from simsopt.core.util import Struct
+from simsopt.mhd.vmec_pool import VmecPool, VmecProcess
+from . import under_mpiexec
+
+# State shared by all FakeVmec instances in one process, like the
+# fortran module state of VMEC:
+_module_state = Struct()
+
+class FakeVmec:
+    """
+    A stand-in for the VMEC python extension. Like the real thing, it
+    keeps its input and output in module-level state, so only one
+    instance can be used per process, and it passes its results through
+    a wout file in the current directory named after the input file,
+    group and iteration.
+    """
+    def __init__(self, input_file='', comm=0, verbose=False, group=0):
+        _module_state.indata = Struct()
+        vi = _module_state.indata
+        vi.nfp = int(os.path.basename(input_file).split('.')[-1])
+        vi.lasym = 0
+        vi.mpol = 1
+        vi.ntor = 0
+        vi.delt = 0.5
+        vi.tcon0 = 2.0
+        vi.phiedge = 1.0
+        vi.curtor = 0.0
+        vi.gamma = 0.0
+        vi.ncurr = 1
+        vi.lfreeb = 0
+        vi.niter_array = np.full(100, -1)
+        for name in ['rbc', 'zbs', 'rbs', 'zbc']:
+            setattr(vi, name, np.zeros((203, 102)))
+        for name in ['raxis_cc', 'raxis_cs', 'zaxis_cc', 'zaxis_cs']:
+            setattr(vi, name, np.zeros(102))
+        vi.rbc[101, 0] = 1.0
+        vi.rbc[101, 1] = 0.1
+        self.indata = vi
+        self.wout = None
+        self.ictrl = np.zeros(5, dtype=np.int32)
+        self.input_file = input_file
+        self.group = group
+        self.iter = 0
+        self.output_file = None
+
+    def reinit(self):
+        pass
+
+    def run(self):
+        vi = _module_state.indata
+        self.iter += 1
+        self.output_file = os.path.join(os.getcwd(), os.path.basename(
+            self.input_file).replace('input.', 'wout_')
+            + '_{:03d}_{:06d}.txt'.format(self.group, self.iter))
+        success = vi.rbc[101, 1] < vi.rbc[101, 0]
+        self.ictrl[1] = 0 if success else 1
+        if success:
+            np.savetxt(self.output_file, [vi.rbc[101, 0] / vi.rbc[101, 1]])
+        return success
+
+    def load(self):
+        vi = _module_state.indata
+        _module_state.wout = Struct()
+        wout = _module_state.wout
+        wout.ns = 3
+        wout.nfp = vi.nfp
+        wout.aspect = float(np.loadtxt(self.output_file))
+        wout.iotaf = np.array([0.1, 0.2, 0.3]) * vi.nfp
+        wout.pid = os.getpid()
+        self.wout = wout
+        return 0
+
+    def finalize(self):
+        pass
+
+class BarrierFakeVmec(FakeVmec):
+    """
+    A FakeVmec whose run() only converges if nconcurrent runs overlap in
+    time. Each run writes its wout file, marks this with a file in the
+    current directory, and waits for the other runs to do the same
+    before its output is loaded.
+    """
+    nconcurrent = 2
+
+    def run(self):
+        success = super().run()
+        open('started.{}'.format(os.getpid()), 'w').close()
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            started = [f for f in os.listdir('.') if f.startswith('started.')]
+            if len(started) >= self.nconcurrent:
+                return success
+            time.sleep(0.01)
+        self.ictrl[1] = 1
+        return False
+
+class PoolTestCase(unittest.TestCase):
+    """
+    Base class for tests that start a VmecPool. The workers are started
+    with "spawn", which hangs under mpiexec, even with a single process,
+    so these tests are skipped there. Each test runs in its own temporary
+    directory, where the workers write their files.
+    """
+    def setUp(self):
+        if under_mpiexec:
+            self.skipTest('VmecPool workers cannot be spawned under mpiexec')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+class VmecPoolTests(PoolTestCase):
+    def test_independent_instances(self):
+        """
+        Two proxies in the same process should have independent VMEC
+        state, since they live in different worker processes.
+        """
+        with VmecPool(nworkers=2, backend=FakeVmec) as pool:
+            v1 = pool.acquire('input.2')
+            v2 = pool.acquire('input.5')
+            self.assertIsInstance(v1, VmecProcess)
+            self.assertEqual(v1.indata.nfp, 2)
+            self.assertEqual(v2.indata.nfp, 5)
+            # No workers are left:
+            with self.assertRaises(RuntimeError):
+                pool.acquire('input.3')
+
+            v1.indata.rbc[101, 1] = 0.25
+            self.assertTrue(v1.run())
+            self.assertTrue(v2.run())
+            self.assertEqual(v1.load(), 0)
+            self.assertAlmostEqual(v1.wout.aspect, 4.0)
+            self.assertAlmostEqual(v2.wout.aspect, 10.0)
+            np.testing.assert_allclose(v1.wout.iotaf, [0.2, 0.4, 0.6])
+            np.testing.assert_allclose(v2.wout.iotaf, [0.5, 1.0, 1.5])
+
+            # A failed run should be reported:
+            v2.indata.rbc[101, 1] = 2.0
+            self.assertFalse(v2.run())
+            self.assertEqual(v2.ictrl[1], 1)
+            self.assertIsNone(v2.wout)
+
+            # Finalizing returns the worker to the pool:
+            v1.finalize()
+            v3 = pool.acquire('input.3')
+            self.assertEqual(v3.indata.nfp, 3)
+
+    def test_errors(self):
+        """
+        Exceptions in a worker should be reported in the parent.
+        """
+        with VmecPool(nworkers=1, backend=FakeVmec) as pool:
+            with self.assertRaises(RuntimeError):
+                pool.acquire('input.not_an_int')
+            # The worker should be usable again afterwards:
+            v = pool.acquire('input.4')
+            self.assertEqual(v.indata.nfp, 4)
+        with self.assertRaises(ValueError):
+            VmecPool(nworkers=0)
+
+    def test_submit_collect(self):
+        """
+        Runs submitted to several workers before collecting should
+        overlap in time.
+        """
+        with VmecPool(nworkers=2, backend=BarrierFakeVmec) as pool:
+            v1 = pool.acquire('input.2')
+            v2 = pool.acquire('input.5')
+            with self.assertRaises(RuntimeError):
+                v1.collect()
+            v1.submit()
+            v2.submit()
+            self.assertTrue(v1.collect())
+            self.assertTrue(v2.collect())
+            self.assertAlmostEqual(v1.wout.aspect, 10.0)
+            np.testing.assert_allclose(v2.wout.iotaf, [0.5, 1.0, 1.5])
+            # A submitted run that is never collected should not stop
+            # the worker from being finalized and reused:
+            v1.submit()
+            v1.finalize()
+            v3 = pool.acquire('input.3')
+            self.assertEqual(v3.indata.nfp, 3)
+
+    def test_same_input_file(self):
+        """
+        Workers started from the same input file should not overwrite
+        each other's files, even when they run at the same time.
+        """
+        with VmecPool(nworkers=2, backend=BarrierFakeVmec) as pool:
+            v1 = pool.acquire('input.2')
+            v2 = pool.acquire('input.2')
+            v1.indata.rbc[101, 1] = 0.25
+            v2.indata.rbc[101, 1] = 0.5
+            v1.submit()
+            v2.submit()
+            self.assertTrue(v1.collect())
+            self.assertTrue(v2.collect())
+            self.assertNotEqual(v1.output_file, v2.output_file)
+            self.assertAlmostEqual(v1.wout.aspect, 4.0)
+            self.assertAlmostEqual(v2.wout.aspect, 2.0)
+
+if __name__ == "__main__":
+    unittest.main()